@@ -0,0 +1,132 @@
+# An asyncio front end for InsteonModem.
+
+# The serial port is still read by the InsteonModem's ModemReader
+# thread and commands are still sent by InsteonModem.exchange.  Those
+# blocking calls are run in an executor so that they don't block the
+# event loop.
+
+import asyncio
+import threading
+from modem import InsteonModem, UnexpectedResponse
+from pydispatch import dispatcher
+from translator import *
+
+
+class AsyncInsteonModem(object):
+  '''AsyncInsteonModem lets asyncio code talk to an InsteonModem.'''
+
+  def __init__(self, insteon_modem, executor=None):
+    assert isinstance(insteon_modem, InsteonModem)
+    self.modem = insteon_modem
+    # None means the event loop's default executor.
+    self.executor = executor
+    # (event loop, asyncio.Queue) for each status_messages iterator.
+    self.subscribers = []
+    # The _PendingRequest of the _request in progress, if any.
+    self.pending = None
+    self.subscribers_lock = threading.Lock()
+    self.modem.start_reader()
+    dispatcher.connect(self._incoming,
+                       signal='MODEM_RESPONSE',
+                       sender=self.modem,
+                       weak=False)
+
+  def __repr__(self):
+    return 'AsyncInsteonModem(%r)' % (self.modem,)
+
+  def close(self):
+    dispatcher.disconnect(self._incoming,
+                          signal='MODEM_RESPONSE',
+                          sender=self.modem,
+                          weak=False)
+
+  async def _run(self, function, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self.executor, function, *args)
+
+  async def send(self, command):
+    '''Sends command, a translator.Command, to the modem and returns the
+    interpreted echo.'''
+    return await self.request(command)
+
+  async def request(self, command, expect=Pattern):
+    '''Sends command, a translator.Command, to the modem and returns
+    the first message read back from the modem, starting with the echo,
+    that is an instance of expect.  For example
+      await am.request(GetModemInfo(), expect=ModemInfoResponse)
+    Raises UnexpectedResponse if no such message arrives.'''
+    encoded = command.encode()
+    return await self._run(self._request, encoded, expect)
+
+  def _request(self, encoded, expect):
+    # Runs in the executor.
+    parser = FrameParser(ReadFromModem)
+    with self.modem.command_lock:
+      with self.subscribers_lock:
+        self.pending = _PendingRequest(encoded, expect)
+      try:
+        response = self.modem.exchange(encoded)
+        messages = parser.feed(response)
+        while True:
+          for msg in messages:
+            if isinstance(msg, expect):
+              return msg
+          more = self.modem.readResponse()
+          if not more:
+            raise UnexpectedResponse(encoded, response)
+          response += more
+          messages = parser.feed(more)
+      finally:
+        with self.subscribers_lock:
+          self.pending = None
+
+  async def status_messages(self):
+    '''An asynchronous iterator of the StatusMessages that are read from
+    the modem, e.g. from wall switches, as they arrive.  The replies
+    that request() returns aren't included.'''
+    entry = (asyncio.get_running_loop(), asyncio.Queue())
+    with self.subscribers_lock:
+      self.subscribers.append(entry)
+    try:
+      while True:
+        yield await entry[1].get()
+    finally:
+      with self.subscribers_lock:
+        self.subscribers.remove(entry)
+
+  def _incoming(self, sender, signal, timestamp, bytes):
+    # Called on the ModemReader thread.
+    with self.subscribers_lock:
+      subscribers = list(self.subscribers)
+      pending = self.pending
+    if not subscribers and not pending:
+      return
+    for frame in FrameParser(ReadFromModem).feed_frames(bytes):
+      msg, _ = ReadFromModem.interpret(frame, 0)
+      if pending and pending.claims(frame, msg):
+        continue
+      if not isinstance(msg, StatusMessage):
+        continue
+      for loop, q in subscribers:
+        loop.call_soon_threadsafe(q.put_nowait, msg)
+
+
+class _PendingRequest(object):
+  '''Picks out the message that a _request will return, the first
+  instance of expect from the latest echo of encoded on, as the
+  ModemReader dispatches it.'''
+
+  def __init__(self, encoded, expect):
+    self.encoded = encoded
+    self.expect = expect
+    self.waiting = False
+
+  def claims(self, frame, msg):
+    if frame[:len(self.encoded)] == self.encoded:
+      # A NAKed command is sent again, and _request reads from the
+      # echo that exchange returns.
+      self.waiting = True
+    if self.waiting and isinstance(msg, self.expect):
+      self.waiting = False
+      return True
+    return False
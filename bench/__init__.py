@@ -0,0 +1,2 @@
+# Benchmarks for judging performance work and catching regressions.
+# See __main__.py for how to run them.
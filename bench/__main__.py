@@ -0,0 +1,51 @@
+# Runs the benchmarks and writes their timings as JSON:
+#
+#   python3 -m bench -o before.json
+#   python3 -m bench -o after.json
+#   python3 -m bench --compare before.json after.json
+#
+# Run it from the directory containing the package's modules.
+
+import argparse
+import sys
+from bench import runner
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+    prog='python3 -m bench',
+    description='Time the protocol layer and the web server.')
+  parser.add_argument('-o', '--output', metavar='FILE',
+                      help='write the results to FILE as JSON')
+  parser.add_argument('-k', dest='only', action='append', metavar='SUBSTRING',
+                      help='only run the benchmarks whose names contain SUBSTRING')
+  parser.add_argument('--repeat', type=int, default=runner.REPEAT)
+  parser.add_argument('--min-time', type=float, default=runner.MIN_TIME,
+                      help='the least time, in seconds, to spend on each run')
+  parser.add_argument('--devices', type=int, default=None)
+  parser.add_argument('--groups', type=int, default=None)
+  parser.add_argument('--events', type=int, default=None)
+  parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                      help='compare two result files rather than run')
+  args = parser.parse_args(argv)
+  if args.compare:
+    runner.compare(*(runner.read_report(path) for path in args.compare))
+    return
+  # Imported here so that --compare doesn't need the package.
+  from bench import protocol, web
+  sizes = dict((name, value) for name, value in (
+    ('devices', args.devices), ('groups', args.groups),
+    ('events', args.events)) if value is not None)
+  def benchmarks():
+    yield from protocol.benchmarks()
+    yield from web.benchmarks(**sizes)
+  report = runner.run(benchmarks(), args.repeat, args.min_time, args.only)
+  if args.output:
+    runner.write_report(report, args.output)
+  else:
+    runner.json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,158 @@
+# Benchmarks of the protocol layer: encoding commands, interpreting
+# what's read from the modem, matching and device message handling.
+
+import modem
+import random
+import translator
+from translator import *
+
+
+# One example of each kind of Command.
+COMMANDS = {
+  'GetModemInfo': lambda: GetModemInfo(),
+  'GetIMConfigurationCommand': lambda: GetIMConfigurationCommand(),
+  'SetIMConfigurationCommand': lambda: SetIMConfigurationCommand(
+    IMConfigurationFlags(monitor_mode=True)),
+  'Get1stLinkCommand': lambda: Get1stLinkCommand(),
+  'GetNextLinkCommand': lambda: GetNextLinkCommand(),
+  'SendAllLinkCommand': lambda: SendAllLinkCommand(
+    LinkGroup(1), OnCmd(), Byte(0)),
+  'SendMessageCommand': lambda: SendMessageCommand(
+    InsteonAddress(0x0f, 0x83, 0x8f),
+    MessageFlags(extended=False, max_hops=3, hops_remaining=3),
+    OnCmd(), Command2(0xff))
+}
+
+# Messages as read from the modem, with how often each occurs in the
+# traffic of a typical installation.
+SAMPLE_FRAMES = {
+  'StandardMessageReceived': (
+    60, bytes.fromhex('02500f829e4993bf2f1300')),
+  'Echo(SendAllLinkCommand)': (
+    15, bytes.fromhex('026101110006')),
+  'Echo(SendMessageCommand)': (
+    10, bytes.fromhex('02620f838f0f11ff06')),
+  'ExtendedMessageReceived': (
+    4, bytes.fromhex('02510f829e4993bf1f2f00' + '00' * 14)),
+  'AllLinkRecordResponse': (
+    4, bytes.fromhex('0257e2010f829e010020')),
+  'AllLinkCleanupFailureReport': (
+    3, bytes.fromhex('025602010f829e')),
+  'ButtonEventReport': (
+    2, bytes.fromhex('025402')),
+  'AllLinkingCompleted': (
+    1, bytes.fromhex('025301010f829e011a41')),
+  'AllLinkCleanupStatus': (
+    1, bytes.fromhex('025806'))
+}
+
+CAPTURE_MESSAGES = 1000
+
+
+def mixed_capture(count=CAPTURE_MESSAGES, seed=0):
+  '''Returns count messages drawn from SAMPLE_FRAMES in proportion to
+  their frequencies, concatenated as they would be read from the
+  modem.'''
+  names = sorted(SAMPLE_FRAMES)
+  weights = [SAMPLE_FRAMES[name][0] for name in names]
+  chosen = random.Random(seed).choices(names, weights, k=count)
+  return b''.join(SAMPLE_FRAMES[name][1] for name in chosen)
+
+
+def encode_benchmarks():
+  for name, make in sorted(COMMANDS.items()):
+    yield 'encode/%s' % name, lambda make=make: make().encode()
+
+
+def interpret_benchmarks():
+  capture = mixed_capture()
+  yield ('interpret_all/mixed_%d' % CAPTURE_MESSAGES,
+         lambda: interpret_all(capture, ReadFromModem))
+  yield ('FrameParser.feed/mixed_%d' % CAPTURE_MESSAGES,
+         lambda: FrameParser(ReadFromModem).feed(capture))
+  for name, (_, frame) in sorted(SAMPLE_FRAMES.items()):
+    yield ('interpret/%s' % name,
+           lambda frame=frame: ReadFromModem.interpret(frame, 0))
+
+
+def _no_match(cls, frame):
+  def function():
+    try:
+      translator._interpret_as_subclass(cls, frame, 0)
+    except NoMatch:
+      pass
+  return function
+
+
+def interpret_as_subclass_benchmarks():
+  # The worst cases are those in which every candidate subclass has to
+  # be tried.
+  yield ('_interpret_as_subclass/unknown_message_code',
+         _no_match(ReadFromModem, bytes.fromhex('027f00000000')))
+  yield ('_interpret_as_subclass/truncated_message',
+         _no_match(ReadFromModem, bytes.fromhex('02500f829e4993bf')))
+  yield ('_interpret_as_subclass/unknown_command_byte',
+         _no_match(StandardDirectOrExtendedCommand, bytes((0xfe,))))
+  yield ('_interpret_as_subclass/not_a_start_byte',
+         _no_match(ReadFromModem, bytes.fromhex('ff50')))
+  # Echo has no fixed length, so each Echoed subclass is a candidate.
+  echo = SAMPLE_FRAMES['Echo(SendMessageCommand)'][1]
+  yield ('_interpret_as_subclass/echo',
+         lambda: translator._interpret_as_subclass(ReadFromModem, echo, 0))
+
+
+def match_benchmarks():
+  frame = SAMPLE_FRAMES['StandardMessageReceived'][1]
+  msg, _ = ReadFromModem.interpret(frame, 0)
+  exact, _ = ReadFromModem.interpret(frame, 0)
+  variables = StandardMessageReceived(
+    FromAddress(0x0f, 0x82, 0x9e), MatchVariable('to'),
+    MatchVariable('flags'), MatchVariable('cmd1'), MatchVariable('cmd2'))
+  other = StandardMessageReceived(
+    FromAddress(0x0f, 0x83, 0x8f), MatchVariable('to'),
+    MatchVariable('flags'), MatchVariable('cmd1'), MatchVariable('cmd2'))
+  yield 'match/exact', lambda: match(msg, exact)
+  yield 'match/variables', lambda: match(msg, variables)
+  yield 'match/variables_mismatch', lambda: match(msg, other)
+  compiled = compile_pattern(variables)
+  compiled_other = compile_pattern(other)
+  # What matching a frame as read costs end to end: interpreting it
+  # and then matching, or matching the raw bytes.
+  yield ('interpret_and_match/variables',
+         lambda: match(ReadFromModem.interpret(frame, 0)[0], variables))
+  yield 'compiled_match/variables', lambda: compiled.match(frame)
+  yield ('compiled_match/variables_mismatch',
+         lambda: compiled_other.match(frame))
+  index = PatternIndex()
+  for i in range(100):
+    index.add(StandardMessageReceived(
+      FromAddress(0x10, 0x00, i), MatchVariable('to'),
+      MatchVariable('flags'), OnCmd(), MatchVariable('cmd2')), i)
+  index.add(variables, 'device')
+  yield 'PatternIndex.match/101_rules', lambda: index.match(frame)
+
+
+def device_benchmarks():
+  device = modem.InsteonDevice.lookup(0x0f, 0x82, 0x9e)
+  if device is None:
+    device = modem.InsteonDevice(InsteonAddress(0x0f, 0x82, 0x9e))
+  for name in ('StandardMessageReceived', 'ExtendedMessageReceived',
+               'AllLinkCleanupFailureReport'):
+    frame = SAMPLE_FRAMES[name][1]
+    yield ('process_message_from_me/%s' % name,
+           lambda frame=frame: device.process_message_from_me(frame))
+  frame = SAMPLE_FRAMES['StandardMessageReceived'][1]
+  msg, _ = ReadFromModem.interpret(frame, 0)
+  yield ('process_message_from_me/interpreted',
+         lambda: device.process_message_from_me(msg))
+  other = bytes.fromhex('02500f838f4993bf2f1300')
+  yield ('process_message_from_me/other_device',
+         lambda: device.process_message_from_me(other))
+
+
+def benchmarks():
+  yield from encode_benchmarks()
+  yield from interpret_benchmarks()
+  yield from interpret_as_subclass_benchmarks()
+  yield from match_benchmarks()
+  yield from device_benchmarks()
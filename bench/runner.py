@@ -0,0 +1,94 @@
+# Timing benchmarks and reporting the results.
+
+import json
+import platform
+import statistics
+import sys
+import time
+import timeit
+
+
+# Each benchmark is timed REPEAT times, each time for as many calls as
+# take at least MIN_TIME seconds.
+REPEAT = 5
+MIN_TIME = 0.2
+
+
+def time_benchmark(function, repeat=REPEAT, min_time=MIN_TIME):
+  '''Returns a dict describing the time per call of function, which
+  takes no arguments, in seconds.'''
+  timer = timeit.Timer(function)
+  loops = 1
+  while True:
+    if timer.timeit(loops) >= min_time:
+      break
+    loops *= 2
+  runs = [t / loops for t in timer.repeat(repeat, loops)]
+  return {
+    'loops': loops,
+    'best': min(runs),
+    'median': statistics.median(runs),
+    'stdev': statistics.stdev(runs) if len(runs) > 1 else 0.0,
+    'runs': runs
+  }
+
+
+def run(benchmarks, repeat=REPEAT, min_time=MIN_TIME, only=None,
+        progress=sys.stderr):
+  '''benchmarks is an iterable of (name, function) pairs.  Returns the
+  report, a dict that can be written as JSON, with the timings of
+  those whose names contain one of the strings in only, or all of them
+  if only is None.'''
+  results = {}
+  for name, function in benchmarks:
+    if only and not any(s in name for s in only):
+      continue
+    result = time_benchmark(function, repeat, min_time)
+    results[name] = result
+    if progress:
+      print('%-50s %s' % (name, format_time(result['best'])), file=progress)
+  return {
+    'python': platform.python_version(),
+    'implementation': platform.python_implementation(),
+    'machine': platform.machine(),
+    'platform': platform.platform(),
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    'repeat': repeat,
+    'min_time': min_time,
+    'benchmarks': results
+  }
+
+
+def write_report(report, path):
+  with open(path, 'w') as f:
+    json.dump(report, f, indent=2, sort_keys=True)
+    f.write('\n')
+
+
+def read_report(path):
+  with open(path) as f:
+    return json.load(f)
+
+
+def format_time(seconds):
+  for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+    if seconds >= scale:
+      return '%.3g %s' % (seconds / scale, unit)
+  return '%.3g ns' % (seconds / 1e-9)
+
+
+def compare(before, after, out=sys.stdout):
+  '''Writes a comparison of the best times of the benchmarks in two
+  reports to out.'''
+  b = before['benchmarks']
+  a = after['benchmarks']
+  for name in sorted(set(b) | set(a)):
+    if name not in b or name not in a:
+      print('%-50s %s' % (name, 'only in ' +
+                          ('after' if name in a else 'before')), file=out)
+      continue
+    tb = b[name]['best']
+    ta = a[name]['best']
+    print('%-50s %10s %10s %6.2fx' % (name, format_time(tb),
+                                       format_time(ta), tb / ta),
+          file=out)
@@ -0,0 +1,128 @@
+# Benchmarks of startup time, each measured in a fresh interpreter:
+#
+#   python3 -m bench.startup -o startup.json
+#   python3 -m bench.startup --importtime
+#
+# import/<module> is the time to import each module.  ready is the
+# time from starting the interpreter until a command has been sent to
+# a FakeInsteonModem and its echo interpreted, which is what the time
+# from rebooting until the lights can be controlled comes down to,
+# less the time to boot and open the serial port.  --importtime shows
+# the modules that take longest to import, from python -X importtime.
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from bench import runner
+
+
+MODULES = ('translator', 'config', 'modem', 'schedule', 'solar',
+           'insteon_logging', 'webserver')
+
+READY = '''
+import fake_modem
+import modem
+from translator import *
+im = modem.InsteonModem(fake_modem.FakeInsteonModem())
+im.exchange(SendAllLinkCommand(LinkGroup(1), OnCmd(), Byte(0)).encode())
+'''
+
+REPEAT = 10
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run(code, *options):
+  '''Runs code in a new interpreter in the package's directory and
+  returns how long that took, in seconds, and what it wrote to
+  stderr.'''
+  start = time.perf_counter()
+  done = subprocess.run([sys.executable] + list(options) + ['-c', code],
+                        cwd=PACKAGE_DIR, stderr=subprocess.PIPE,
+                        check=True, universal_newlines=True)
+  return time.perf_counter() - start, done.stderr
+
+
+def time_startup(code, repeat=REPEAT):
+  # The interpreter itself takes some of the time, which is reported
+  # as 'import/' for comparison.
+  runs = [_run(code)[0] for i in range(repeat)]
+  return {
+    'loops': 1,
+    'best': min(runs),
+    'median': statistics.median(runs),
+    'stdev': statistics.stdev(runs) if len(runs) > 1 else 0.0,
+    'runs': runs
+  }
+
+
+def benchmarks():
+  yield 'import/', 'pass'
+  for module in MODULES:
+    yield 'import/%s' % module, 'import %s' % module
+  yield 'ready', READY
+
+
+def run(repeat=REPEAT, only=None, progress=sys.stderr):
+  '''Returns a report in the format of runner.run.'''
+  results = {}
+  for name, code in benchmarks():
+    if only and not any(s in name for s in only):
+      continue
+    result = time_startup(code, repeat)
+    results[name] = result
+    if progress:
+      print('%-50s %s' % (name, runner.format_time(result['best'])),
+            file=progress)
+  report = runner.run((), repeat=repeat, progress=None)
+  report['benchmarks'] = results
+  return report
+
+
+IMPORTTIME = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+def import_times(code=READY):
+  '''Returns (self microseconds, cumulative microseconds, module) for
+  each module imported by code, as reported by python -X importtime.'''
+  _, stderr = _run(code, '-X', 'importtime')
+  times = []
+  for line in stderr.splitlines():
+    m = IMPORTTIME.match(line)
+    if m:
+      times.append((int(m.group(1)), int(m.group(2)), m.group(4)))
+  return times
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+    prog='python3 -m bench.startup',
+    description='Time importing the package and getting the modem ready.')
+  parser.add_argument('-o', '--output', metavar='FILE',
+                      help='write the results to FILE as JSON')
+  parser.add_argument('-k', dest='only', action='append', metavar='SUBSTRING',
+                      help='only run the benchmarks whose names contain SUBSTRING')
+  parser.add_argument('--repeat', type=int, default=REPEAT)
+  parser.add_argument('--importtime', action='store_true',
+                      help='show the slowest imports instead')
+  parser.add_argument('--top', type=int, default=20)
+  args = parser.parse_args(argv)
+  if args.importtime:
+    times = sorted(import_times(), reverse=True)
+    print('%10s %10s  %s' % ('self us', 'cumul. us', 'module'))
+    for self_us, cumulative_us, module in times[:args.top]:
+      print('%10d %10d  %s' % (self_us, cumulative_us, module))
+    return
+  report = run(args.repeat, args.only)
+  if args.output:
+    runner.write_report(report, args.output)
+  else:
+    runner.json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print()
+
+
+if __name__ == '__main__':
+  main()
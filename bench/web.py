@@ -0,0 +1,52 @@
+# Benchmarks of rendering the web server's main page.
+
+import datetime
+import config
+import fake_modem
+import modem
+import schedule
+import webserver
+from translator import *
+
+
+DEVICES = 50
+GROUPS = 10
+EVENTS = 50
+
+
+def populate(devices=DEVICES, groups=GROUPS, events=EVENTS):
+  '''Registers devices InsteonDevices, split among groups
+  InsteonLinkGroups, and schedules events Events far enough in the
+  future that they don't fire, as if read from the modem and
+  configured.'''
+  modem.InsteonDevice.devices.clear()
+  modem.InsteonDevice.routes.clear()
+  modem.InsteonLinkGroup.groups.clear()
+  link_groups = [modem.InsteonLinkGroup(LinkGroup(g + 1))
+                 for g in range(groups)]
+  timestamp = config.now()
+  for i in range(devices):
+    device = modem.InsteonDevice(
+      InsteonAddress(0x20, (i >> 8) & 0xff, i & 0xff))
+    device.location = 'Room %d' % i
+    device.category = Category(0x01)
+    device.cmd1 = (OnCmd(), OffCmd(), None)[i % 3]
+    device.received_timestamp = timestamp
+    if link_groups:
+      link_groups[i % groups].add_device(device)
+  im = modem.InsteonModem(fake_modem.FakeInsteonModem())
+  scheduler = schedule.Scheduler()
+  for i in range(events):
+    group = LinkGroup(i % max(groups, 1) + 1)
+    schedule.Event(
+      modem.InsteonCommandAction(
+        im, SendAllLinkCommand(group, (OnCmd(), OffCmd())[i % 2], Byte(0))),
+      schedule.Every(datetime.timedelta(days=365 + i))).schedule(
+        previous=config.now())
+  return scheduler
+
+
+def benchmarks(devices=DEVICES, groups=GROUPS, events=EVENTS):
+  populate(devices, groups, events)
+  yield ('main_page/%d_devices_%d_groups_%d_events' %
+         (devices, groups, events), webserver.main_page)
@@ -0,0 +1,218 @@
+# Capture the raw traffic to and from the Insteon modem in a compact
+# binary file that can be read back and replayed later.
+
+# The file starts with MAGIC and is followed by records.  Each record is
+# a RECORD header, a time.monotonic() timestamp, a direction and a
+# length, followed by that many bytes.  Each time a CaptureWriter opens
+# the file it first writes a SESSION record whose data is the offset
+# from time.monotonic() to time.time(), so that record timestamps can
+# be converted to the time of day.
+
+# Writing a record only packs a header and copies bytes into a buffer.
+# Interpreting the messages is left to the offline reader:
+#
+#   python3 capture.py modem.capture
+
+import argparse
+import collections
+import datetime
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import actions
+import config
+from pydispatch import dispatcher
+
+
+MAGIC = b'INSTCAP1'
+
+# time.monotonic(), direction, length
+RECORD = struct.Struct('<dBH')
+SESSION_DATA = struct.Struct('<d')
+
+# Directions
+HOST_TO_MODEM = 0    # MODEM_COMMAND
+MODEM_TO_HOST = 1    # MODEM_RESPONSE
+SESSION = 2
+
+SIGNAL_DIRECTIONS = {
+  'MODEM_COMMAND': HOST_TO_MODEM,
+  'MODEM_RESPONSE': MODEM_TO_HOST
+}
+
+DIRECTION_SIGNALS = dict((d, s) for s, d in SIGNAL_DIRECTIONS.items())
+
+CAPTURE_FILE = 'modem.capture'
+
+# The size of CaptureWriter's write buffer, and the longest, in seconds,
+# that a record waits in it before being written out.
+WRITE_BUFFER_SIZE = 64 * 1024
+FLUSH_INTERVAL = 5
+
+
+# time is the record's timestamp converted to seconds since the epoch.
+Record = collections.namedtuple('Record', 'monotonic time direction data')
+
+
+class CaptureWriter(object):
+  '''CaptureWriter appends records to a capture file.  Records are
+  buffered and written out when the buffer fills, at most
+  flush_interval seconds after they're written, and on flush or close.
+  If max_bytes isn't None, a file that would grow past max_bytes is
+  first renamed to path + '.1', replacing any earlier one, and a new
+  file is started.'''
+
+  def __init__(self, path, flush_interval=FLUSH_INTERVAL, max_bytes=None):
+    self.path = path
+    self.flush_interval = flush_interval
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    # Flushes the file flush_interval after the first record that
+    # hasn't been flushed.
+    self.timer = None
+    with self.lock:
+      self._open()
+
+  def __repr__(self):
+    return 'CaptureWriter(%r)' % (self.path,)
+
+  def _open(self):
+    self.file = open(self.path, 'ab', buffering=WRITE_BUFFER_SIZE)
+    self.size = self.file.tell()
+    if self.size == 0:
+      self.file.write(MAGIC)
+      self.size = len(MAGIC)
+    now = time.monotonic()
+    self._write(now, SESSION, SESSION_DATA.pack(time.time() - now))
+
+  def _write(self, now, direction, data):
+    self.file.write(RECORD.pack(now, direction, len(data)))
+    self.file.write(data)
+    self.size += RECORD.size + len(data)
+    if self.timer is None:
+      self.timer = threading.Timer(self.flush_interval, self._flush_later)
+      self.timer.daemon = True
+      self.timer.start()
+
+  def write(self, direction, data):
+    now = time.monotonic()
+    with self.lock:
+      if (self.max_bytes is not None and
+          self.size + RECORD.size + len(data) > self.max_bytes):
+        self._rotate()
+      self._write(now, direction, data)
+
+  def _rotate(self):
+    self.file.close()
+    os.replace(self.path, self.path + '.1')
+    self._open()
+
+  def _flush_later(self):
+    with self.lock:
+      self.timer = None
+      if not self.file.closed:
+        self.file.flush()
+
+  def flush(self):
+    with self.lock:
+      self.file.flush()
+
+  def close(self):
+    with self.lock:
+      if self.timer:
+        self.timer.cancel()
+        self.timer = None
+      self.file.close()
+
+
+class CaptureReader(object):
+  '''CaptureReader iterates over the records of a capture file,
+  excluding SESSION records.  The file is mapped into memory rather
+  than read, so records are only copied as they're reached.'''
+
+  def __init__(self, path):
+    self.path = path
+
+  def __repr__(self):
+    return 'CaptureReader(%r)' % (self.path,)
+
+  def __iter__(self):
+    with open(self.path, 'rb') as f:
+      if os.fstat(f.fileno()).st_size < len(MAGIC):
+        raise ValueError('%s is not a capture file' % self.path)
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        if m[:len(MAGIC)] != MAGIC:
+          raise ValueError('%s is not a capture file' % self.path)
+        offset = 0.0
+        index = len(MAGIC)
+        end = len(m)
+        while index + RECORD.size <= end:
+          monotonic, direction, length = RECORD.unpack_from(m, index)
+          index += RECORD.size
+          if index + length > end:
+            # The last record was only partly written.
+            break
+          data = m[index : index + length]
+          index += length
+          if direction == SESSION:
+            offset, = SESSION_DATA.unpack(data)
+            continue
+          yield Record(monotonic, monotonic + offset, direction, data)
+
+
+def render(path, out=sys.stdout):
+  '''Writes the records of the capture file at path to out as text, in
+  the format of insteon_logging's log entries.'''
+  import insteon_logging
+  zone = config.local_zone()
+  for record in CaptureReader(path):
+    timestamp = datetime.datetime.fromtimestamp(record.time, zone)
+    print(insteon_logging.format_traffic(
+      timestamp, DIRECTION_SIGNALS[record.direction], record.data),
+          file=out)
+
+
+_writer = None
+
+def _capture_traffic(sender, signal, timestamp, bytes):
+  writer = _writer
+  if writer:
+    writer.write(SIGNAL_DIRECTIONS[signal], bytes)
+
+def start(path=CAPTURE_FILE, max_bytes=config.CAPTURE_MAX_BYTES):
+  '''Starts capturing modem traffic to the file at path, which is
+  rotated when it reaches max_bytes.'''
+  global _writer
+  if _writer:
+    return
+  _writer = CaptureWriter(path, max_bytes=max_bytes)
+  dispatcher.connect(_capture_traffic, signal='MODEM_COMMAND')
+  dispatcher.connect(_capture_traffic, signal='MODEM_RESPONSE')
+
+def stop():
+  global _writer
+  writer = _writer
+  if not writer:
+    return
+  dispatcher.disconnect(_capture_traffic, signal='MODEM_COMMAND')
+  dispatcher.disconnect(_capture_traffic, signal='MODEM_RESPONSE')
+  _writer = None
+  writer.close()
+
+def _do_onStartup_capture():
+  # Capturing is off unless config.CAPTURE_PATH is set.
+  if config.CAPTURE_PATH:
+    start(config.CAPTURE_PATH, config.CAPTURE_MAX_BYTES)
+
+def _do_onShutdown_capture():
+  stop()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    description='Show the contents of a modem traffic capture file.')
+  parser.add_argument('path', nargs='?', default=CAPTURE_FILE)
+  render(parser.parse_args().path)
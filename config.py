@@ -2,12 +2,28 @@
 # modules.
 
 import datetime
-from tzlocal import get_localzone
 
 TIME_FORMAT = '%Y-%m-%d_%H:%M:%S_%Z'
 WEB_TIME_FORMAT = '%Y-%m-%d %H:%M:%S %Z'
 
+# The file to which capture.py records modem traffic once
+# actions.run('onStartup') has been called, or None not to record it.
+# When the file reaches CAPTURE_MAX_BYTES it's renamed to
+# CAPTURE_PATH + '.1' and a new one is started.
+CAPTURE_PATH = None
+CAPTURE_MAX_BYTES = 16 * 1024 * 1024
+
+_local_zone = None
+
+def local_zone():
+  '''Returns the local timezone.  It's only looked up the first time.'''
+  global _local_zone
+  if _local_zone is None:
+    from tzlocal import get_localzone
+    _local_zone = get_localzone()
+  return _local_zone
+
 def now():
   '''Returns the current time as a datetime.datetime, with local timezone.'''
-  return datetime.datetime.now(get_localzone())
+  return datetime.datetime.now(local_zone())
 
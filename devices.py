@@ -1,3 +1,10 @@
+# Insteon devices that have been seen through the Insteon modem.
+
+import config
+from errors import DeviceExists
+from translator import *
+
+
 class Device(object):
   def __init__(self):
     self.name = ""
@@ -6,6 +13,9 @@ class Device(object):
 
 class InsteonDevice(Device):
   devices = {}
+  # Maps the int value of each device's address to the method that
+  # handles the messages it sends.
+  routes = {}
 
   @classmethod
   def lookup(cls, *args):
@@ -30,7 +40,7 @@ class InsteonDevice(Device):
     assert isinstance(insteonAddress, InsteonAddress)
     super(InsteonDevice, self).__init__()
     if self.__class__.lookup(insteonAddress):
-      raise DeviceExists(id)
+      raise DeviceExists(insteonAddress)
     self.address = insteonAddress
     self.location = ''
     self.category = None
@@ -40,27 +50,64 @@ class InsteonDevice(Device):
     self.cmd1 = None
     self.cmd2 = None
     self.received_timestamp = None
+    # The group of the most recent AllLinkCleanupFailureReport
+    self.cleanup_failure_group = None
+    # The most recent ButtonEvent, for the modem's own device
+    self.button_event = None
+    # Matches the bytes of a StandardMessageReceived from this device.
+    self.status_pattern = compile_pattern(StandardMessageReceived(
+      StartByte(), StandardMessageReceivedCode(),
+      FromAddress(self.address), MatchVariable("to_address"),
+      MatchVariable("message_flags"),
+      MatchVariable("cmd1"), MatchVariable("cmd2")))
     self.__class__.devices[self.address] = self
+    self.__class__.routes[int(self.address)] = self.process_message_from_me
 
   def __repr__(self):
     return '%s(%r)' % (self.__class__.__name__, self.address)
 
-  def process_message_from_me(self, msg):
-    assert isinstance(msg, Translator)
-    pattern1 = StandardMessageReceived(
-      StartByte(), StandardMessageReceivedCode(),
-      FromAddress(self.address), MatchVariable("to_address"),
-      MatchVariable("message_flags"),
-      MatchVariable("cmd1"), MatchVariable("cmd2"))
-    m = match(msg, pattern1)
-    if m == False:
+  def process_message_from_me(self, frame):
+    '''frame is the bytes of a message from this device as read from
+    the modem, or its interpretation.'''
+    if isinstance(frame, Translator):
+      frame = frame.encode()
+    if len(frame) < 2:
+      return
+    if frame[1] == StandardMessageReceivedCode.byte_code:
+      # By far the most common case.  It doesn't need the message to
+      # be interpreted.
+      m = self.status_pattern.match(frame)
+      if m == False:
+        return
+      self.received_timestamp = config.now()
+      self.cmd1 = m["cmd1"]
+      self.cmd2 = m["cmd2"]
+      return
+    sender = sender_address(frame)
+    if sender is not None and sender != int(self.address):
+      return
+    try:
+      msg, length = StatusMessage.interpret(frame, 0)
+    except NoMatch:
+      return
+    if isinstance(msg, ExtendedMessageReceived):
+      self.cmd1 = msg.StandardExtendedCommand
+      self.cmd2 = msg.Byte
+    elif isinstance(msg, AllLinkingCompleted):
+      self.category = msg.Category
+      self.subcategory = msg.Subcategory
+      self.firmware_version = msg.FirmwareVersion
+    elif isinstance(msg, AllLinkCleanupFailureReport):
+      self.cleanup_failure_group = msg.LinkGroup
+    elif isinstance(msg, ButtonEventReport):
+      self.button_event = msg.ButtonEvent
+    else:
       return
     self.received_timestamp = config.now()
-    self.cmd1 = m["cmd1"]
-    self.cmd2 = m["cmd2"]
 
   def _simple_command(self, modem, cmd, cmd2):
-    response_index = 0
+    # modem imports this module, so it can't be imported at the top.
+    from modem import InsteonModem
     assert isinstance(modem, InsteonModem)
     assert isinstance(cmd, StandardDirectCommand)
     command = SendMessageCommand(self.address,
@@ -68,12 +115,13 @@ class InsteonDevice(Device):
                                               max_hops=3,
                                               hops_remaining=3),
                                  cmd, cmd2)
-    modem.sendCommand(bytearray(command.encode()))
-    response = modem.readResponse()
-    echoed, length = ReadFromModem.interpret(response, response_index)
-    response_index += length
-     ### Should check echo.
-    return echoed.AckNack is Ack(), response, response_index
+    encoded = command.encode()
+    response = modem.exchange(encoded)
+    span = modem.echo_span(encoded, response)
+    if span is None:
+      return False, response, len(response)
+    echoed, length = ReadFromModem.interpret(response, span[0])
+    return echoed.AckNack is Ack(), response, span[1]
 
   def ping(self, modem):
     return self._simple_command(modem, PingCmd(), Command2(0x01))
@@ -82,12 +130,14 @@ class InsteonDevice(Device):
     return self._simple_command(modem, IdRequestCmd(), Command2(0x01))
 
   def status(self, modem):
-    acked, response, _ = self._simple_command(modem, StatusRequestCmd(), Command2(0x00))
-    if not acked:
-      return
-    rfm, length1 = ReadFromModem.interpret(response, 0)
-    smr, length2 = StandardMessageReceived.interpret(response, length1)
-    assert len(response) == length1 + length2
+    with modem.command_lock:
+      acked, response, index = self._simple_command(modem, StatusRequestCmd(), Command2(0x00))
+      if not acked:
+        return
+      # The device's reply comes over the power line after the echo.
+      # Other messages can arrive first.
+      reply = modem.awaitResponse(self.status_pattern, response, index)
+    smr, length = StandardMessageReceived.interpret(reply, 0)
     return smr.Byte.byte
 
   def on(self, modem):
@@ -0,0 +1,16 @@
+# Exceptions shared by modem, devices and link_groups.  This module
+# imports nothing from the package, so any of them can import it.
+
+
+class DeviceExists(Exception):
+  def __init__(self, id):
+    self.id = id
+  def __str__(self):
+    return "device %s already exists" % self.id
+
+
+class GroupExists(Exception):
+  def __init__(self, id):
+    self.id = id
+  def __str__(self):
+    return "link group %s already exists" % self.id
@@ -0,0 +1,228 @@
+# A stand-in for a serial port connected to an Insteon PowerLinc modem,
+# for exercising and benchmarking modem.py without the hardware.
+
+# FakeInsteonModem is a file-like object with the parts of the
+# serial.Serial interface that InsteonModem uses, so it can be passed to
+# InsteonModem in place of a port path:
+#
+#   fake = fake_modem.FakeInsteonModem(devices=[0x0f838f, 0x0f829e])
+#   im = modem.InsteonModem(fake)
+#
+# It implements enough of the modem's protocol to answer the commands
+# that this package sends.  Everything happens on the threads that read
+# from and write to it; it has no thread of its own.  Replies that are
+# due after a delay, and spontaneous traffic from the devices, are
+# delivered when they're read.
+
+import heapq
+import random
+import threading
+import time
+from translator import *
+
+
+# The address, category, subcategory and firmware version that
+# GetModemInfo reports.
+MODEM_ADDRESS = 0x448511
+MODEM_INFO = (0x03, 0x15, 0x9b)
+
+# How long, in seconds, a device takes to reply to a SendMessageCommand
+# sent to it.
+DEVICE_LATENCY = 0.05
+
+# Flags of a device's direct ACK and of a group broadcast.
+DIRECT_ACK_FLAGS = MessageFlags(response=True, max_hops=3, hops_remaining=2)
+BROADCAST_FLAGS = MessageFlags(broadcast_NACK=True, group=True,
+                               max_hops=3, hops_remaining=2)
+
+
+def _address_bytes(address):
+  return bytes(((address >> 16) & 0xff, (address >> 8) & 0xff, address & 0xff))
+
+
+def link_record(group, address, modem_is_controller=True):
+  '''Returns a LinkDBRecord for the FakeInsteonModem's link_db.'''
+  return LinkDBRecord(
+    LinkDBRecordFlags(in_use=True, modem_is_controller=modem_is_controller,
+                      not_high_water_mark=True),
+    LinkGroup(group), InsteonAddress(*_address_bytes(address)),
+    LinkData1(0), LinkData2(0), LinkData3(0))
+
+
+class FakeInsteonModem(object):
+  '''FakeInsteonModem behaves like a serial port connected to an
+  Insteon modem and to the devices whose addresses, as ints, are
+  listed in devices.
+
+  Each command written to it is echoed, followed by an ACK, or by a NAK
+  with probability nak_probability.  Only Echoed commands are NAKed,
+  since the modem's NAK of any other command, e.g. 02 60 15 for
+  GetModemInfo, is shorter than the response that its message code
+  announces and can't be framed.  GetModemInfo and the
+  GetIMConfigurationCommand are answered.  Get1stLinkCommand and
+  GetNextLinkCommand step through link_db, a list of LinkDBRecords,
+  which by default links each device in group 1.  A SendMessageCommand
+  to one of the devices gets the device's reply, a
+  StandardMessageReceived, device_latency seconds later.  The devices
+  keep track of their on levels.  Each device also sends a group On or
+  Off broadcast now and then, traffic_rate times a second in all.
+  Every command written is appended to commands.'''
+
+  def __init__(self, devices=(), link_db=None, nak_probability=0.0,
+               echo_latency=0.0, device_latency=DEVICE_LATENCY,
+               traffic_rate=0.0, address=MODEM_ADDRESS, seed=None):
+    self.address = address
+    # Maps each device's address to its on level.
+    self.levels = dict((device, 0) for device in devices)
+    if link_db is None:
+      link_db = [link_record(1, device) for device in devices]
+    self.link_db = list(link_db)
+    self.link_index = 0
+    self.nak_probability = nak_probability
+    self.echo_latency = echo_latency
+    self.device_latency = device_latency
+    self.traffic_rate = traffic_rate
+    self.random = random.Random(seed)
+    self.commands = []
+    # The serial.Serial attributes that InsteonModem sets.
+    self.timeout = None
+    self.bytesize = 8
+    self.baudrate = 19200
+    self.parser = FrameParser(Command)
+    # Bytes that can be read now, and (due, sequence, bytes) for those
+    # that can be read later.
+    self.output = bytearray()
+    self.scheduled = []
+    self.sequence = 0
+    self.next_traffic = self._traffic_delay(time.monotonic())
+    self.lock = threading.Condition()
+
+  def __repr__(self):
+    return 'FakeInsteonModem(%s)' % InsteonAddress(
+      *_address_bytes(self.address))
+
+  def close(self):
+    pass
+
+  # Output
+
+  def inject(self, data, delay=0):
+    '''Makes data readable after delay seconds, as if a device had
+    sent it.'''
+    with self.lock:
+      self._schedule(bytes(data), delay)
+      self.lock.notify_all()
+
+  def _schedule(self, data, delay):
+    if delay <= 0:
+      # Whatever became due earlier comes out first.
+      self._deliver(time.monotonic())
+      self.output.extend(data)
+      return
+    self.sequence += 1
+    heapq.heappush(self.scheduled, (time.monotonic() + delay, self.sequence, data))
+
+  def _traffic_delay(self, now):
+    if self.traffic_rate <= 0 or not self.levels:
+      return None
+    return now + self.random.expovariate(self.traffic_rate)
+
+  def _deliver(self, now):
+    # Returns when anything more will become readable, or None.
+    while self.scheduled and self.scheduled[0][0] <= now:
+      self.output.extend(heapq.heappop(self.scheduled)[2])
+    while self.next_traffic is not None and self.next_traffic <= now:
+      self._spontaneous_traffic()
+      self.next_traffic = self._traffic_delay(self.next_traffic)
+    due = [t for t in (self.scheduled and self.scheduled[0][0],
+                       self.next_traffic) if t]
+    return min(due) if due else None
+
+  def _spontaneous_traffic(self):
+    device = self.random.choice(sorted(self.levels))
+    cmd1 = self.random.choice((OnCmd, OffCmd))
+    self.levels[device] = 0xff if cmd1 is OnCmd else 0
+    self.output.extend(StandardMessageReceived(
+      FromAddress(*_address_bytes(device)), ToAddress(0, 0, 1),
+      BROADCAST_FLAGS, cmd1(), Byte(0)).encode())
+
+  @property
+  def in_waiting(self):
+    with self.lock:
+      self._deliver(time.monotonic())
+      return len(self.output)
+
+  def read(self, size=1):
+    deadline = None if self.timeout is None else time.monotonic() + self.timeout
+    with self.lock:
+      while True:
+        now = time.monotonic()
+        due = self._deliver(now)
+        if self.output:
+          break
+        if deadline is not None and now >= deadline:
+          return b''
+        wait = [t - now for t in (due, deadline) if t is not None]
+        self.lock.wait(min(wait) if wait else None)
+      data = bytes(self.output[:size])
+      del self.output[:size]
+      return data
+
+  # Input
+
+  def write(self, data):
+    with self.lock:
+      for frame, command in self.parser.feed_with_frames(data):
+        self.commands.append(frame)
+        self._respond(frame, command)
+      self.lock.notify_all()
+    return len(data)
+
+  def _respond(self, frame, command):
+    if (isinstance(command, Echoed) and
+        self.random.random() < self.nak_probability):
+      self._schedule(frame + bytes((Nack.byte_code,)), self.echo_latency)
+      return
+    if isinstance(command, GetModemInfo):
+      self._schedule(frame + _address_bytes(self.address) +
+                     bytes(MODEM_INFO + (Ack.byte_code,)),
+                     self.echo_latency)
+      return
+    if isinstance(command, GetIMConfigurationCommand):
+      self._schedule(frame + bytes((0, 0, 0, Ack.byte_code)),
+                     self.echo_latency)
+      return
+    if isinstance(command, ReadLinkDBCommand):
+      if isinstance(command, Get1stLinkCommand):
+        self.link_index = 0
+      else:
+        self.link_index += 1
+      if self.link_index >= len(self.link_db):
+        self._schedule(frame + bytes((Nack.byte_code,)), self.echo_latency)
+        return
+      self._schedule(frame + bytes((Ack.byte_code,)), self.echo_latency)
+      record = self.link_db[self.link_index]
+      self._schedule(AllLinkRecordResponse(record).encode(),
+                     self.echo_latency)
+      return
+    self._schedule(frame + bytes((Ack.byte_code,)), self.echo_latency)
+    if isinstance(command, SendMessageCommand):
+      self._device_reply(command)
+
+  def _device_reply(self, command):
+    device = int(command.InsteonAddress)
+    if device not in self.levels:
+      return
+    cmd1 = command.StandardDirectOrExtendedCommand
+    if cmd1 is OnCmd():
+      self.levels[device] = 0xff
+    elif cmd1 is OffCmd():
+      self.levels[device] = 0
+    if cmd1 is StatusRequestCmd():
+      # The reply's cmd1 is the device's link database delta.
+      cmd1 = ZeroCmd()
+    reply = StandardMessageReceived(
+      FromAddress(*_address_bytes(device)),
+      ToAddress(*_address_bytes(self.address)),
+      DIRECT_ACK_FLAGS, cmd1, Byte(self.levels[device]))
+    self._schedule(reply.encode(), self.device_latency)
@@ -1,8 +1,17 @@
 # Log messages sent to and from the Insteon modem.
 
+# Log records are put on a bounded queue by the thread that sends or
+# reads the message and are formatted and written by a QueueListener's
+# thread, so that talking to the modem doesn't wait for the log to be
+# written.  If the queue is full the record is dropped and counted.
+
 import actions
+import builtins
 import logging
+import logging.handlers
 import datetime
+import queue
+import threading
 import config
 import config
 from translator import interpret_all, Pattern, ReadFromModem
@@ -10,11 +19,107 @@ from pydispatch import dispatcher
 
 logging.getLogger(__name__).propagate = True
 
+# The number of log records that can wait to be written.
+LOG_QUEUE_SIZE = 10000
+
+
+class _DeferredFormatQueueHandler(logging.handlers.QueueHandler):
+  '''A QueueHandler that leaves formatting to the listener's thread
+  and counts the records that don't fit in the queue.'''
+
+  def __init__(self, q):
+    super(_DeferredFormatQueueHandler, self).__init__(q)
+    # Guarded by dropped_lock, since records are logged from any
+    # thread.
+    self.dropped = 0
+    self.dropped_lock = threading.Lock()
+
+  def prepare(self, record):
+    # The record stays in this process, so there's no need to format
+    # it before it's queued.
+    return record
+
+  def enqueue(self, record):
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      with self.dropped_lock:
+        self.dropped += 1
+
+
+class _RootForwarder(logging.Handler):
+  '''Passes records to the root logger's handlers, whatever they are
+  by the time the record is written.'''
+
+  def emit(self, record):
+    logging.getLogger().handle(record)
+
+
+class _Listener(logging.handlers.QueueListener):
+  def enqueue_sentinel(self):
+    # Wait for room rather than fail if the queue is full.
+    self.queue.put(self._sentinel)
+
+
+_queue_handler = None
+_listener = None
+
+def start_listener():
+  '''Starts writing this module's log records from a background
+  thread.'''
+  global _queue_handler, _listener
+  if _listener:
+    return
+  q = queue.Queue(LOG_QUEUE_SIZE)
+  _queue_handler = _DeferredFormatQueueHandler(q)
+  _listener = _Listener(q, _RootForwarder())
+  _listener.start()
+  logger = logging.getLogger(__name__)
+  logger.addHandler(_queue_handler)
+  logger.propagate = False
+
+def stop_listener():
+  '''Writes any log records that are still queued and goes back to
+  writing them directly.'''
+  global _queue_handler, _listener
+  if not _listener:
+    return
+  logger = logging.getLogger(__name__)
+  logger.propagate = True
+  logger.removeHandler(_queue_handler)
+  _listener.stop()
+  if _queue_handler.dropped:
+    logger.warning('%d log records were dropped because the log queue was full'
+                   % _queue_handler.dropped)
+  _queue_handler = None
+  _listener = None
+
+def dropped():
+  '''Returns the number of log records dropped because the queue was
+  full.'''
+  handler = _queue_handler
+  return handler.dropped if handler else 0
+
+
+class _Timestamped(object):
+  '''A log message that is prefixed with the time it was logged at.
+  The timestamp is only formatted if the message is written.'''
+  __slots__ = ('timestamp', 'message')
+
+  def __init__(self, message):
+    self.timestamp = config.now()
+    self.message = message
+
+  def __str__(self):
+    return '%s: %s' % (self.timestamp.strftime(config.TIME_FORMAT),
+                       self.message)
+
+
 def info(message):
   '''Add message to the log.'''
-  logging.getLogger(__name__).info('%s: %s' % (
-    config.now().strftime(config.TIME_FORMAT),
-    message))
+  logger = logging.getLogger(__name__)
+  if logger.isEnabledFor(logging.INFO):
+    logger.info(_Timestamped(message))
 
 
 _signal_abbreviations = {
@@ -28,7 +133,9 @@ _signal_translators = {
 }
 
 
-def _log_modem_traffic(sender, signal, timestamp, bytes):
+def format_traffic(timestamp, signal, bytes):
+  '''Returns the log entry for bytes sent to or read from the modem,
+  including their interpretation.'''
   entry_list = ["%s: %s %r" % (
     timestamp.strftime(config.TIME_FORMAT),
     _signal_abbreviations[signal],
@@ -40,11 +147,40 @@ def _log_modem_traffic(sender, signal, timestamp, bytes):
     entry_list.append(str(e))
   finally:
     entry = '\n\t'.join(entry_list + [repr(i) for i in interpreted])
-  logging.getLogger(__name__).info(entry)
+  return entry
+
+class _Traffic(object):
+  '''A log message for bytes sent to or read from the modem.  It's
+  only formatted, and the bytes interpreted, if the message is
+  written.'''
+  __slots__ = ('timestamp', 'signal', 'bytes', '_text')
+
+  def __init__(self, timestamp, signal, bytes):
+    self.timestamp = timestamp
+    self.signal = signal
+    self.bytes = bytes
+    self._text = None
+
+  def __str__(self):
+    if self._text is None:
+      self._text = format_traffic(self.timestamp, self.signal, self.bytes)
+    return self._text
+
+
+def _log_modem_traffic(sender, signal, timestamp, bytes):
+  logger = logging.getLogger(__name__)
+  if not logger.isEnabledFor(logging.INFO):
+    return
+  # Copy bytes since the caller might reuse it.
+  logger.info(_Traffic(timestamp, signal, builtins.bytes(bytes)))
 
 def _do_onShutdown_logging():
+  stop_listener()
   logging.shutdown()
 
+def _do_onStartup_LogListener():
+  start_listener()
+
 def _do_onStartup_DispatchRegistration():
   dispatcher.connect(_log_modem_traffic, signal='MODEM_COMMAND')
   dispatcher.connect(_log_modem_traffic, signal='MODEM_RESPONSE')
@@ -1,3 +1,11 @@
+# Insteon all-link groups that have been read from the Insteon modem's
+# link database.
+
+import translator
+from devices import InsteonDevice
+from errors import GroupExists
+
+
 class InsteonLinkGroup(object):
   groups = {}
 
@@ -10,14 +18,14 @@ class InsteonLinkGroup(object):
       return cls.groups[link_group]
     return None
 
-  def __init__(self, link_group, devices=[]):
+  def __init__(self, link_group, devices=None):
     if isinstance(link_group, int):
       link_group = translator.LinkGroup(link_group)
     assert isinstance(link_group, translator.LinkGroup)
     if self.__class__.lookup(link_group):
       raise GroupExists(link_group)
     self.link_group = link_group
-    self.devices = devices
+    self.devices = devices if devices is not None else []
     self.__class__.groups[self.link_group] = self
 
   def add_device(self, device):
@@ -26,6 +26,9 @@ logging.getLogger(schedule.__name__).addFilter(schedule.ScheduleLogFilter(
 # Command line arguments
 parser = argparse.ArgumentParser(description='Run my home control system.')
 parser.add_argument('--no-web', dest='no_web', default=False, action='store_true')
+parser.add_argument('--show-translators', dest='show_translators',
+                    default=False, action='store_true',
+                    help='write the Translator class hierarchy to translators.txt')
 parsed = parser.parse_args()
 
 
@@ -60,14 +63,13 @@ Event(im.read_link_db,
       "Read link database").schedule()
 
 def on():
-  im.sendCommand(bytearray(SendAllLinkCommand(LinkGroup(1), OnCmd(), Byte(0)).encode()))
+  im.sendCommand(SendAllLinkCommand(LinkGroup(1), OnCmd(), Byte(0)).encode())
 
 def off():
-  im.sendCommand(bytearray(SendAllLinkCommand(LinkGroup(1), OffCmd(), Byte(0)).encode()))
+  im.sendCommand(SendAllLinkCommand(LinkGroup(1), OffCmd(), Byte(0)).encode())
 
-with open("translators.txt", "w") as f:
-  print("This file is written by the show_translators function.\n", file=f)
-  show_translators(f)
+if parsed.show_translators:
+  write_translators()
 
 if not parsed.no_web:
   webserver.run(8000, im)
@@ -9,14 +9,21 @@
 
 
 import actions
+import collections
+import concurrent.futures
 from pydispatch import dispatcher
 import datetime
+import queue
 import serial
+import threading
 import time
 import config
 import translator
 from translator import *
 import insteon_logging
+from devices import InsteonDevice
+from errors import DeviceExists, GroupExists
+from link_groups import InsteonLinkGroup
 
 debug = False
 
@@ -28,13 +35,6 @@ def hexdump(msg):
   return s
 
 
-class DeviceExists(Exception):
-  def __init__(self, id):
-    self.id = id
-  def __str__(self):
-    return "%device %s already exists" % self.id
-
-
 class UnexpectedResponse(Exception):
   def __init__(self, command, response):
     self.command = command
@@ -45,8 +45,80 @@ class UnexpectedResponse(Exception):
       hexdump(self.command))
 
 
-import devices
-import link_groups
+# How long readResponse waits, in seconds, for the first byte of a
+# response.
+RESPONSE_TIMEOUT = 1
+
+# How long readResponse waits, in seconds, for the next byte once a
+# response has started to arrive.  At 19200 baud a byte takes about
+# half a millisecond.
+INTER_BYTE_TIMEOUT = 0.1
+
+# The number of messages that the reader thread will hold for
+# readResponse before it starts dropping the oldest.
+RESPONSE_QUEUE_SIZE = 256
+
+# The command codes of the commands that the modem relays over the
+# power line.  These are the ones that SendRateGovernor limits.
+POWER_LINE_COMMAND_CODES = (AllLinkCmd.byte_code, SendMessageCmd.byte_code)
+
+
+class RetryPolicy(object):
+  '''RetryPolicy determines how many times, and after what delays, a
+  command is resent when the modem NAKs it because it's busy.  The
+  delay starts at initial_delay seconds and is multiplied by multiplier
+  for each further retry, up to max_delay.'''
+
+  def __init__(self, max_attempts=4, initial_delay=0.05,
+               multiplier=2, max_delay=1.0):
+    self.max_attempts = max_attempts
+    self.initial_delay = initial_delay
+    self.multiplier = multiplier
+    self.max_delay = max_delay
+
+  def __repr__(self):
+    return 'RetryPolicy(%r, %r, %r, %r)' % (
+      self.max_attempts, self.initial_delay, self.multiplier, self.max_delay)
+
+  def delays(self):
+    '''Returns the delays to wait before each retry.'''
+    delay = self.initial_delay
+    for i in range(self.max_attempts - 1):
+      yield min(delay, self.max_delay)
+      delay *= self.multiplier
+
+
+class SendRateGovernor(object):
+  '''SendRateGovernor is a token bucket that limits the rate at which
+  commands are sent over the power line to rate per second, while
+  allowing bursts of up to burst commands.'''
+
+  def __init__(self, rate=10.0, burst=10):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def __repr__(self):
+    return 'SendRateGovernor(%r, %r)' % (self.rate, self.burst)
+
+  def acquire(self):
+    '''Waits until a command may be sent.  Returns the number of seconds
+    waited.'''
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.burst,
+                        self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      self.tokens -= 1
+      if self.tokens >= 0:
+        return 0
+      # Sleep while holding the lock so that later callers queue up
+      # behind this one.
+      wait = -self.tokens / self.rate
+      time.sleep(wait)
+      return wait
 
 
 class InsteonModem (object):
@@ -54,35 +126,272 @@ class InsteonModem (object):
   InsteonModem mediates communication with an Insteon serial modem.
   '''
   
-  def __init__(self, port_path):
+  def __init__(self, port_path,
+               response_timeout=RESPONSE_TIMEOUT,
+               inter_byte_timeout=INTER_BYTE_TIMEOUT,
+               read_continuously=False,
+               retry_policy=None,
+               governor=None):
+    # port_path is the path of the modem's serial port, or an object
+    # that stands in for a serial.Serial, e.g. a
+    # fake_modem.FakeInsteonModem.
     self.port_path = port_path
-    self.serial = serial.Serial(port_path)
+    self.response_timeout = response_timeout
+    self.inter_byte_timeout = inter_byte_timeout
+    if isinstance(port_path, str):
+      self.serial = serial.Serial(port_path)
+    else:
+      self.serial = port_path
     self.serial.bytesize = serial.EIGHTBITS
     self.serial.baudrate = 19200
-    self.serial.timeout = 1
+    self.serial.timeout = response_timeout
     self.devices = {}
+    # The InsteonDevice for the modem itself, once modeminfo has been
+    # called.  It gets the modem's ButtonEventReports.
+    self.device = None
+    self.frame_parser = FrameParser(ReadFromModem)
+    # Held for the duration of a command and the reading of its
+    # response so that commands from different threads don't
+    # interleave.
+    self.command_lock = threading.RLock()
+    # When reader is running, it reads everything that the modem
+    # sends and puts each message in responses.
+    self.reader = None
+    self.responses = queue.Queue(RESPONSE_QUEUE_SIZE)
+    # Commands submitted with submit are sent in order by sender,
+    # which sender_lock starts only once.
+    self.sender = None
+    self.sender_lock = threading.Lock()
+    self.submitted = queue.Queue()
+    self.retry_policy = retry_policy or RetryPolicy()
+    self.governor = governor or SendRateGovernor()
+    # Counts of commands_sent, naks, retries and abandoned (commands
+    # that were still NAKed after the last retry), and the total
+    # governor_delay and queue_delay in seconds.  Update them with
+    # count.
+    self.counters = collections.Counter()
+    self.counters_lock = threading.Lock()
+    # The SendAllLinkCommand of each (group number, command class) that
+    # groupOn and groupOff have sent, so it's only encoded once.
+    self.group_commands = {}
+    # Rules added with when, and the thread that runs their actions.
+    self.rules = PatternIndex()
+    self.rule_executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=1, thread_name_prefix='Modem Rule Thread')
     actions.run('onInsteonModemInitialized', modem=self)
+    if read_continuously:
+      self.start_reader()
 
   def __repr__(self):
     return 'InsteonModem(%r)' % (self.port_path,)
 
+  @property
+  def scheduling_lane(self):
+    # Scheduled actions that use the modem are performed one at a time.
+    return self
+
+  def start_reader(self):
+    '''Starts a ModemReader thread to continuously read from the modem.'''
+    if self.reader_running():
+      return
+    self.reader = ModemReader(self)
+    self.reader.start()
+
+  def stop_reader(self):
+    reader = self.reader
+    if not reader:
+      return
+    reader.stop()
+    reader.join()
+    self.reader = None
+
+  def reader_running(self):
+    reader = self.reader
+    return reader is not None and reader.is_alive()
+
+  def _queue_response(self, frame):
+    while True:
+      try:
+        self.responses.put_nowait(frame)
+        return
+      except queue.Full:
+        # Drop the oldest message.  It has already been dispatched.
+        try:
+          self.responses.get_nowait()
+        except queue.Empty:
+          pass
+
+  def _discard_responses(self):
+    while True:
+      try:
+        self.responses.get_nowait()
+      except queue.Empty:
+        return
+
   def sendCommand(self, command):
-    assert isinstance(command, bytearray)
-    # dispatch results are ignored.
-    dispatcher.send(signal='MODEM_COMMAND',
-                    sender=self,
-                    timestamp=config.now(),
-                    bytes=command)
-    if debug: print("sending command    %s" % hexdump(command))
-    self.serial.write(command)
-
-  def readResponse(self):
+    '''Sends command to the modem.  If the reader thread is running,
+    waits for the modem to echo the command and returns the echo, or an
+    empty bytearray if none arrived within response_timeout.
+    Otherwise returns None and the caller should call readResponse.'''
+    assert isinstance(command, (bytes, bytearray))
+    with self.command_lock:
+      # Wait for the governor first so that MODEM_COMMAND is sent, and
+      # timestamped, when the command actually is.
+      if len(command) > 1 and command[1] in POWER_LINE_COMMAND_CODES:
+        self.count('governor_delay', self.governor.acquire())
+      reading = self.reader_running()
+      if reading:
+        # Anything already queued was sent before this command and
+        # has already been dispatched.
+        self._discard_responses()
+      # dispatch results are ignored.
+      dispatcher.send(signal='MODEM_COMMAND',
+                      sender=self,
+                      timestamp=config.now(),
+                      bytes=command)
+      if debug: print("sending command    %s" % hexdump(command))
+      self.count('commands_sent')
+      self.serial.write(command)
+      if reading:
+        return self._await_echo(command)
+
+  def count(self, counter, amount=1):
+    '''Adds amount to counters[counter].'''
+    with self.counters_lock:
+      self.counters[counter] += amount
+
+  def _await_echo(self, command):
+    return self._await_queued(lambda frame: frame[:len(command)] == command)
+
+  def _read_echo(self, command):
+    # Without the reader, messages that were waiting before command was
+    # sent, e.g. a device's late reply, are read ahead of its echo.
+    # readResponse dispatches them like any others.  Returns the
+    # response from the echo on.
+    parser = FrameParser(ReadFromModem)
+    deadline = time.monotonic() + self.response_timeout
+    while time.monotonic() < deadline:
+      response = self.readResponse()
+      if not response:
+        break
+      frames = parser.feed_frames(response)
+      for i, frame in enumerate(frames):
+        if frame[:len(command)] == command:
+          return bytearray(b''.join(frames[i:]))
+    return bytearray()
+
+  def _await_queued(self, matches):
+    deadline = time.monotonic() + self.response_timeout
+    while True:
+      timeout = deadline - time.monotonic()
+      if timeout <= 0:
+        return bytearray()
+      try:
+        frame = self.responses.get(timeout=timeout)
+      except queue.Empty:
+        return bytearray()
+      if matches(frame):
+        return bytearray(frame)
+      # Otherwise it's unsolicited traffic that the reader has
+      # already dispatched.
+
+  def submit(self, command):
+    '''Queues command, a translator.Command, to be sent to the modem
+    and returns a concurrent.futures.Future.  Each command is sent as
+    soon as the modem has echoed the one before it.  The Future's result
+    is the interpreted echo.  If the modem doesn't echo the command the
+    Future's exception is an UnexpectedResponse.'''
+    future = concurrent.futures.Future()
+    self.submitted.put((command, future, time.monotonic()))
+    # Not command_lock, which is held for the whole of an exchange.
+    with self.sender_lock:
+      if not self.sender:
+        self.sender = CommandSender(self)
+        self.sender.start()
+    return future
+
+  def submit_all(self, commands):
+    '''Submits each of commands and returns a list of their Futures.'''
+    return [self.submit(command) for command in commands]
+
+  def exchange(self, command, retry=True):
+    '''Sends command and returns the response that includes its echo.
+    If retry is true and the modem NAKs the command it is resent
+    according to retry_policy.'''
+    with self.command_lock:
+      delays = self.retry_policy.delays() if retry else iter(())
+      while True:
+        echo = self.sendCommand(command)
+        if echo is None:
+          echo = self._read_echo(command)
+        if not self.is_nak(command, echo):
+          return echo
+        self.count('naks')
+        delay = next(delays, None)
+        if delay is None:
+          self.count('abandoned')
+          return echo
+        self.count('retries')
+        time.sleep(delay)
+
+  def is_nak(self, command, response):
+    '''Returns True if the modem NAKed command in response.'''
+    span = self.echo_span(command, response)
+    return span is not None and response[span[1] - 1] == Nack.byte_code
+
+  def echo_span(self, command, response):
+    '''Returns the (start, end) of the message in response that echoes
+    command, or None if there isn't one.  Other messages, e.g. ones left
+    over from before command was sent, can come before it.'''
+    index = 0
+    while index < len(response):
+      try:
+        length = message_length(ReadFromModem, response, index)
+      except NoMatch:
+        index += 1
+        continue
+      if length is None or index + length > len(response):
+        break
+      if response[index:index + len(command)] == command:
+        return index, index + length
+      index += length
+    return None
+
+  def _set_read_timeout(self, timeout):
+    # Changing the timeout reconfigures the port, so only do it when
+    # it actually changes.
+    if self.serial.timeout != timeout:
+      self.serial.timeout = timeout
+
+  def readResponse(self, minimum_frames=1, wait=True):
+    '''Reads a response from the modem.  Whatever bytes are waiting
+    are read at once.  Reading stops as soon as at least minimum_frames
+    complete messages, and no partial message, have been read.  If
+    minimum_frames is None reading continues until the modem goes
+    quiet.  Reading also stops if no byte arrives within
+    response_timeout seconds, or within inter_byte_timeout seconds once
+    the response has started.  If wait is false only bytes that have
+    already arrived are read.'''
+    if self.reader_running():
+      return self._read_queued_responses(minimum_frames, wait)
     msg = bytearray()
+    parser = FrameParser(ReadFromModem)
+    frames = 0
+    timeout = self.response_timeout if wait else 0
     while True:
-      b = self.serial.read(1)
+      self._set_read_timeout(timeout)
+      b = self.serial.read(max(1, self.serial.in_waiting))
       if not b:
         break
-      msg.append(ord(b))
+      msg.extend(b)
+      frames += len(parser.feed_views(b))
+      if (minimum_frames is not None and frames >= minimum_frames
+          and parser.pending() == 0):
+        break
+      if wait:
+        # Between messages wait as long as for the first one.
+        timeout = (self.inter_byte_timeout if parser.pending()
+                   else self.response_timeout)
     if debug: print("receiving response %s" % hexdump(msg))
     if len(msg) > 0:
       # dispatch results are ignored.
@@ -92,25 +401,97 @@ class InsteonModem (object):
                       bytes=msg)
     return msg
 
+  def awaitResponse(self, pattern, response=b'', start=0):
+    '''Reads messages until one matches pattern, a
+    translator.CompiledPattern, and returns its bytes, or an empty
+    bytearray if none arrives within response_timeout.  The messages
+    before it, e.g. other devices' broadcasts, are skipped once they
+    have been dispatched.  The messages in response from start, which
+    have already been read, e.g. along with an echo, are looked at
+    first.'''
+    matches = lambda frame: pattern.match(frame) is not False
+    parser = FrameParser(ReadFromModem)
+    for frame in parser.feed_frames(response[start:]):
+      if matches(frame):
+        return bytearray(frame)
+    if self.reader_running():
+      return self._await_queued(matches)
+    deadline = time.monotonic() + self.response_timeout
+    while time.monotonic() < deadline:
+      response = self.readResponse()
+      if not response:
+        break
+      for frame in parser.feed_frames(response):
+        if matches(frame):
+          return bytearray(frame)
+    return bytearray()
+
+  def _read_queued_responses(self, minimum_frames, wait):
+    # Messages from the reader thread have already been dispatched.
+    msg = bytearray()
+    frames = 0
+    while minimum_frames is None or frames < minimum_frames:
+      try:
+        if wait:
+          frame = self.responses.get(timeout=self.response_timeout)
+        else:
+          frame = self.responses.get_nowait()
+      except queue.Empty:
+        break
+      msg.extend(frame)
+      frames += 1
+    return msg
+
   def process_incoming(self, bytes):
-    messages, end_index, err = interpret_all(bytes, ReadFromModem)
-    if end_index < len(bytes):
-      insteon_logging.info("failed to interpret all of byte array %r"
-                           % bytes)
-    if err:
-      insteon_logging.info("Exception %r while interpreting byte array %r"
-                           % (e, bytes))
-    for msg in messages:
-      for elt in msg:
-        if isinstance(elt, FromAddress):
-          device = InsteonDevice.lookup(elt)
-          if device:
-            device.process_message_from_me(msg)
-          break
+    # Bytes of a message that straddles two reads are kept by
+    # frame_parser until the rest of the message arrives.
+    discarded = self.frame_parser.discarded
+    views = self.frame_parser.feed_views(bytes)
+    if self.frame_parser.discarded > discarded:
+      insteon_logging.info("discarded %d uninterpretable bytes from %r"
+                           % (self.frame_parser.discarded - discarded, bytes))
+    for view in views:
+      # frame is a memoryview of frame_parser's receive buffer.
+      frame = view.frame
+      if self.rules:
+        for action, matches in self.rules.match(frame):
+          self.rule_executor.submit(self._run_rule, action)
+      handler = self.route(frame)
+      if handler:
+        handler(frame)
+
+  def route(self, frame):
+    '''Returns the handler for the message whose bytes are frame: the
+    process_message_from_me method of the device that sent it, or None.
+    The frame isn't interpreted.'''
+    address = sender_address(frame)
+    if address is not None:
+      return InsteonDevice.routes.get(address)
+    if frame[1] == ButtonEventReportCode.byte_code and self.device:
+      return self.device.process_message_from_me
+    return None
+
+  def when(self, pattern, action):
+    '''Arranges for action to be called, with no arguments, whenever
+    a message that matches pattern is read from the modem.  pattern is
+    a translator.Pattern that can include MatchVariables, e.g.
+      im.when(StandardMessageReceived(
+                FromAddress(0x0f, 0x83, 0x8f), MatchVariable("to"),
+                MatchVariable("flags"), OnCmd(), MatchVariable("cmd2")),
+              InsteonCommandAction(im, SendAllLinkCommand(
+                LinkGroup(4), OnCmd(), Byte(0))))
+    Actions are run on their own thread so that they can send commands
+    to the modem.'''
+    self.rules.add(pattern, action)
+
+  def _run_rule(self, action):
+    try:
+      action()
+    except Exception as e:
+      insteon_logging.info("rule action %r failed: %r" % (action, e))
 
   def modeminfo(self):
-    self.sendCommand(bytearray(GetModemInfo().encode()))
-    response = self.readResponse()
+    response = self.exchange(GetModemInfo().encode())
     i, length = ModemInfoResponse.interpret(response, 0)
     device = InsteonDevice.lookup(i.InsteonAddress)
     if not device:
@@ -118,25 +499,30 @@ class InsteonModem (object):
       device.category = i.Category
       device.subcategory = i.Subcategory
       device.firmware_version = i.FirmwareVersion
+    self.device = device
     return device
 
   # Verify that the response echos the command
   def check_echo(self, command, response):
-    for i in range(len(command)):
-      if command[i] != response[i]:
-        raise UnexpectedResponse(command, response)
+    if response[:len(command)] != command:
+      raise UnexpectedResponse(command, response)
 
   def read_link_db(self):
-    links = []
-    self.sendCommand(bytearray(Get1stLinkCommand().encode()))
+    with self.command_lock:
+      self._read_link_db()
 
+  def _read_link_db(self):
+    command = Get1stLinkCommand()
     while True:
-      response = self.readResponse()
+      # Here a NAK means that there are no more records.
+      response = self.exchange(command.encode(), retry=False)
       i, length = ReadFromModem.interpret(response, 0)
       if debug: print("interpreted response: %r" % i)
       if not isinstance(i.AckNack, Ack):
         break
-      interpreted, length = AllLinkRecordResponse.interpret(response, length)
+      # The link record follows the echo, maybe after other messages.
+      reply = self.awaitResponse(LINK_RECORD_PATTERN, response, length)
+      interpreted, length = AllLinkRecordResponse.interpret(reply, 0)
       if debug: print(repr(interpreted))
       record = interpreted.LinkDBRecord
       flags = record.LinkDBRecordFlags
@@ -151,21 +537,99 @@ class InsteonModem (object):
         device = InsteonDevice(address)
       group_obj.add_device(device)
       if debug: print(repr(device))
-      self.sendCommand(bytearray(GetNextLinkCommand().encode()))
+      command = GetNextLinkCommand()
 
   def load_devices(self):
     self.modeminfo()
     self.read_link_db()
 
   def groupOn(self, group_number):
-    command = SendAllLinkCommand(LinkGroup(group_number), OnCmd(), Byte(0))
-    self.sendCommand(bytearray(command.encode()))
-    response = self.readResponse()
+    return self.exchange(self._group_command(group_number, OnCmd).encode())
 
   def groupOff(self, group_number):
-    command = SendAllLinkCommand(LinkGroup(group_number), OffCmd(), Byte(0))
-    self.sendCommand(bytearray(command.encode()))
-    response = self.readResponse()
+    return self.exchange(self._group_command(group_number, OffCmd).encode())
+
+  def _group_command(self, group_number, cmd):
+    key = (group_number, cmd)
+    command = self.group_commands.get(key)
+    if command is None:
+      command = self.group_commands.setdefault(
+        key, SendAllLinkCommand(LinkGroup(group_number), cmd(), Byte(0)))
+    return command
+
+
+class ModemReader(threading.Thread):
+  '''ModemReader is a thread that continuously reads from an
+  InsteonModem, splits what it reads into messages, and puts each one
+  on the modem's responses queue and dispatches it as a MODEM_RESPONSE
+  signal.  This way unsolicited traffic, e.g. from wall switches, is
+  noticed as soon as it arrives.'''
+
+  def __init__(self, modem):
+    super(ModemReader, self).__init__(name='Modem Reader Thread')
+    self.daemon = True
+    self.modem = modem
+    self.frame_parser = FrameParser(ReadFromModem)
+    self.stopping = False
+
+  def stop(self):
+    self.stopping = True
+
+  def run(self):
+    serial_ = self.modem.serial
+    # The timeout only bounds how long stop takes to be noticed.
+    serial_.timeout = self.modem.response_timeout
+    while not self.stopping:
+      try:
+        b = serial_.read(max(1, serial_.in_waiting))
+      except Exception as e:
+        insteon_logging.info("ModemReader read failed: %r" % e)
+        time.sleep(self.modem.response_timeout)
+        continue
+      if not b:
+        continue
+      for frame in self.frame_parser.feed_frames(b):
+        if debug: print("receiving response %s" % hexdump(frame))
+        self.modem._queue_response(frame)
+        # dispatch results are ignored.  A receiver that fails mustn't
+        # stop the reader.
+        try:
+          dispatcher.send(signal='MODEM_RESPONSE',
+                          sender=self.modem,
+                          timestamp=config.now(),
+                          bytes=frame)
+        except Exception as e:
+          insteon_logging.info("MODEM_RESPONSE receiver failed: %r" % e)
+
+
+class CommandSender(threading.Thread):
+  '''CommandSender is a thread that sends the commands that have been
+  submitted to an InsteonModem, one after the other, and resolves their
+  Futures.'''
+
+  def __init__(self, modem):
+    super(CommandSender, self).__init__(name='Modem Command Sender Thread')
+    self.daemon = True
+    self.modem = modem
+
+  def run(self):
+    while True:
+      command, future, submitted = self.modem.submitted.get()
+      if not future.set_running_or_notify_cancel():
+        continue
+      try:
+        future.set_result(self.send(command, submitted))
+      except Exception as e:
+        future.set_exception(e)
+
+  def send(self, command, submitted):
+    encoded = command.encode()
+    with self.modem.command_lock:
+      self.modem.count('queue_delay', time.monotonic() - submitted)
+      response = self.modem.exchange(encoded)
+    self.modem.check_echo(encoded, response)
+    echo, length = ReadFromModem.interpret(response, 0)
+    return echo
 
 
 class InsteonCommandAction(object):
@@ -179,8 +643,41 @@ class InsteonCommandAction(object):
     self.command = command
 
   def __call__(self):
-    self.modem.sendCommand(bytearray(self.command.encode()))
-    self.modem.readResponse()
+    self.modem.exchange(self.command.encode())
+
+  @property
+  def scheduling_lane(self):
+    return self.modem
+
+  # InsteonCommandActions for the same modem that are scheduled for
+  # the same time are sent together.  Of those that turn the same group
+  # or device on or off only the last is sent.
+
+  @property
+  def coalesce_key(self):
+    return self.modem
+
+  @property
+  def coalesce_target(self):
+    command = self.command
+    if (isinstance(command, translator.SendAllLinkCommand) and
+        isinstance(command.StandardDirectCommand, ON_OFF_COMMANDS)):
+      return command.LinkGroup
+    if (isinstance(command, translator.SendMessageCommand) and
+        isinstance(command.StandardDirectOrExtendedCommand, ON_OFF_COMMANDS)):
+      return command.InsteonAddress
+    return command.encode()
+
+  def submit(self):
+    return self.modem.submit(self.command)
 
   def __repr__(self):
     return 'InsteonCommandAction(%r, %r)' % (self.modem, self.command)
+
+
+ON_OFF_COMMANDS = (translator.OnCmd, translator.OffCmd)
+
+# Matches the AllLinkRecordResponse that follows the echo of a
+# Get1stLinkCommand or GetNextLinkCommand.
+LINK_RECORD_PATTERN = compile_pattern(
+  AllLinkRecordResponse(MatchVariable("record")))
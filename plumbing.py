@@ -33,7 +33,10 @@ def _do_onInsteonModemInitialized(modem):
   def read_from_modem_after_writing(
       sender, signal, timestamp, bytes):
     logging.getLogger(__name__).info("read_from_modem_after_writing")
-    modem.readResponse()
+    # This is called before the command is written.  Only pick up
+    # traffic that has already arrived so that it isn't mistaken for
+    # the response to the command.
+    modem.readResponse(wait=False)
   def update_device_status_from_incoming_messages(
       sender, signal, timestamp, bytes):
     logging.getLogger(__name__).info("update_device_status_from_incoming_messages")
@@ -1,61 +1,430 @@
 # Scheduling events for home automation.
 
 import abc
+import collections
+import concurrent.futures
 import datetime
+import heapq
 import logging
 import numbers
-import sched
 import threading
 import time
 import config
-from tzlocal import get_localzone
 from singleton import Singleton
 
 logging.getLogger(__name__).propagate = True
 
-TIME_ZERO = datetime.datetime(1970,1,1, tzinfo=get_localzone())
 
-def schedTime(t=None):
-  if t == None:
-    t = config.now()
-  return (t - TIME_ZERO).total_seconds()
+class ScheduledAction(object):
+  '''ScheduledAction is the handle returned when an action is
+  scheduled.  It can be used to cancel or reschedule the action.'''
+  __slots__ = ('due', 'sequence', 'when', 'action', 'queued', 'cancelled')
+
+  def __init__(self, due, sequence, when, action):
+    # due is when to perform the action, according to time.monotonic().
+    self.due = due
+    self.sequence = sequence
+    self.when = when
+    self.action = action
+    self.queued = True
+    self.cancelled = False
+
+  def __lt__(self, other):
+    if self.due != other.due:
+      return self.due < other.due
+    return self.sequence < other.sequence
+
+  def __repr__(self):
+    return 'ScheduledAction(%r, %r)' % (self.when, self.action)
+
+
+# A change of more than this many seconds in the difference between
+# time.time() and time.monotonic() is taken to mean that the time of
+# day has been set.
+CLOCK_STEP = 1.0
+
+# The longest, in seconds, that ScheduleQueue waits without checking
+# whether the time of day has been set.
+CLOCK_CHECK_INTERVAL = 5.0
+
+
+class ScheduleQueue(object):
+  '''ScheduleQueue performs actions at the times they're scheduled
+  for, on a thread of its own.  The actions are kept in a heap ordered
+  by time.monotonic(), so changes to the time of day don't disturb the
+  waits.  If the time of day is set, e.g. when NTP first syncs, the
+  actions are still performed at the times of day they were scheduled
+  for.  Scheduling an action that's due before all of the others, or
+  cancelling the next one, wakes the thread immediately.
+
+  Each ScheduledAction is passed to dispatch as it comes due.  By
+  default its action is performed on the ScheduleQueue's thread.
+
+  When an action with a coalesce_key comes due, the actions with the
+  same coalesce_key that are due within coalesce_window seconds of it
+  are taken along and all of them are dispatched together as
+  CoalescedActions.'''
+
+  def __init__(self, name='Scheduler Thread', dispatch=None,
+               coalesce_window=0):
+    self.name = name
+    self.dispatch = dispatch or perform
+    self.coalesce_window = coalesce_window
+    self.condition = threading.Condition()
+    self.heap = []
+    self.sequence = 0
+    # The number of cancelled ScheduledActions still in heap.
+    self.cancelled = 0
+    self.running = False
+    self.thread = None
+    self.clock_offset = time.time() - time.monotonic()
+
+  def __repr__(self):
+    return 'ScheduleQueue(%r)' % (self.name,)
+
+  def _check_clock(self):
+    # The dues are when converted to time.monotonic() using
+    # clock_offset.  The difference between the clocks is only updated
+    # when the time of day has been set, so that actions scheduled for
+    # the same time are due at the same time and are performed in the
+    # order they were scheduled.  Then every due is recomputed.
+    # Returns True if they were.
+    offset = time.time() - time.monotonic()
+    if abs(offset - self.clock_offset) <= CLOCK_STEP:
+      return False
+    self.clock_offset = offset
+    for e in self.heap:
+      e.due = e.when.timestamp() - offset
+    heapq.heapify(self.heap)
+    return True
+
+  def start(self):
+    with self.condition:
+      if self.thread:
+        return
+      self.running = True
+      self.thread = threading.Thread(name=self.name, target=self.run,
+                                     daemon=True)
+      self.thread.start()
+
+  def stop(self):
+    '''Stops the thread.  Actions that are still scheduled are kept.'''
+    with self.condition:
+      self.running = False
+      self.condition.notify_all()
+      thread = self.thread
+      self.thread = None
+    if thread and thread is not threading.current_thread():
+      thread.join()
+
+  def schedule(self, when, action):
+    '''Schedules action, a function of no arguments, to be called at
+    when, a datetime.datetime.  Returns a ScheduledAction.'''
+    with self.condition:
+      rebased = self._check_clock()
+      due = when.timestamp() - self.clock_offset
+      self.sequence += 1
+      entry = ScheduledAction(due, self.sequence, when, action)
+      heapq.heappush(self.heap, entry)
+      if rebased or self.heap[0] is entry:
+        self.condition.notify_all()
+    return entry
+
+  def cancel(self, handle):
+    '''Cancels the ScheduledAction handle.  Returns False if it has
+    already been performed or cancelled.'''
+    with self.condition:
+      if handle.cancelled or not handle.queued:
+        return False
+      handle.cancelled = True
+      self.cancelled += 1
+      if self.heap[0] is handle:
+        self.condition.notify_all()
+      elif self.cancelled > len(self.heap) // 2:
+        self._compact()
+      return True
+
+  def reschedule(self, handle, when):
+    '''Cancels handle and schedules its action for when instead.
+    Returns the new ScheduledAction.'''
+    self.cancel(handle)
+    return self.schedule(when, handle.action)
+
+  def queued(self):
+    '''Returns the ScheduledActions that are waiting, earliest first.'''
+    with self.condition:
+      return sorted(e for e in self.heap if not e.cancelled)
+
+  def __len__(self):
+    with self.condition:
+      return len(self.heap) - self.cancelled
+
+  def _compact(self):
+    # Cancelled entries are normally only removed when they reach the
+    # top of the heap.  This keeps them from accumulating.
+    self.heap = [e for e in self.heap if not e.cancelled]
+    heapq.heapify(self.heap)
+    self.cancelled = 0
+
+  def _next(self):
+    # Waits for the next action to come due and returns it, or returns
+    # None once stopped.
+    with self.condition:
+      while self.running:
+        heap = self.heap
+        while heap and heap[0].cancelled:
+          heapq.heappop(heap).queued = False
+          self.cancelled -= 1
+        if not heap:
+          self.condition.wait()
+          continue
+        if self._check_clock():
+          continue
+        delay = heap[0].due - time.monotonic()
+        if delay > 0:
+          self.condition.wait(min(delay, CLOCK_CHECK_INTERVAL))
+          continue
+        entry = heapq.heappop(heap)
+        entry.queued = False
+        if self.coalesce_window > 0:
+          entry = self._coalesce(entry)
+        return entry
+      return None
+
+  def _coalesce(self, entry):
+    key = coalesce_key(entry.action)
+    if key is None:
+      return entry
+    heap = self.heap
+    limit = entry.due + self.coalesce_window
+    batch = [entry.action]
+    others = []
+    while heap and heap[0].due <= limit:
+      e = heapq.heappop(heap)
+      if e.cancelled:
+        self.cancelled -= 1
+        e.queued = False
+      elif coalesce_key(e.action) == key:
+        e.queued = False
+        batch.append(e.action)
+      else:
+        others.append(e)
+    for e in others:
+      heapq.heappush(heap, e)
+    if len(batch) == 1:
+      return entry
+    batched = ScheduledAction(entry.due, entry.sequence, entry.when,
+                              CoalescedActions(batch))
+    batched.queued = False
+    return batched
+
+  def run(self):
+    while True:
+      entry = self._next()
+      if entry is None:
+        return
+      self.dispatch(entry)
+
+
+def perform(entry):
+  '''Performs the action of the ScheduledAction entry.'''
+  try:
+    entry.action()
+  except Exception:
+    _log_scheduler_message(scheduler_operation='SCHEDULED_ACTION_FAILED',
+                           sender=entry,
+                           timestamp=config.now(),
+                           when=entry.when,
+                           action=entry.action)
+
+
+def scheduling_lane(action):
+  '''Returns the lane that action is to be performed in, or None if
+  it can be performed alongside anything else.  The lane is the
+  scheduling_lane attribute of action, or, if action is a bound
+  method, of the object it's bound to.'''
+  lane = getattr(action, 'scheduling_lane', None)
+  if lane is None:
+    lane = getattr(getattr(action, '__self__', None), 'scheduling_lane', None)
+  return lane
+
+
+def _function(action):
+  # The function that performs action, which may be an Event.
+  if isinstance(action, Event):
+    return action.action_function
+  return action
+
+
+def coalesce_key(action):
+  '''Returns the coalesce_key of action, or of the function of an
+  Event, or None.  Actions with the same coalesce_key that come due
+  together are performed as a batch.  Such actions must also have a
+  coalesce_target and a submit method.'''
+  return getattr(_function(action), 'coalesce_key', None)
+
+
+class CoalescedActions(object):
+  '''CoalescedActions performs actions that came due together and have
+  the same coalesce_key.  Each action, or the function of each Event,
+  has a submit method that starts it and returns a
+  concurrent.futures.Future, and a coalesce_target.  Of the actions
+  with the same coalesce_target only the last is performed, so turning
+  a group on and then off just turns it off.  The others are submitted
+  in order without waiting for each to finish.  Events are then
+  rescheduled as usual, including those that were superseded.'''
+
+  def __init__(self, actions):
+    self.actions = actions
+
+  def __repr__(self):
+    return 'CoalescedActions(%r)' % (self.actions,)
+
+  @property
+  def scheduling_lane(self):
+    return scheduling_lane(self.actions[0])
+
+  def __call__(self):
+    last = {}
+    for action in self.actions:
+      last[_function(action).coalesce_target] = action
+    futures = {}
+    for action in self.actions:
+      if last[_function(action).coalesce_target] is action:
+        futures[action] = _function(action).submit()
+    for action in self.actions:
+      future = futures.get(action)
+      wait = future.result if future else _superseded
+      if isinstance(action, Event):
+        action.doAction(perform=wait)
+        continue
+      try:
+        wait()
+      except Exception:
+        _log_scheduler_message(scheduler_operation='SCHEDULED_ACTION_FAILED',
+                               sender=self,
+                               timestamp=config.now(),
+                               action=action)
+
+
+def _superseded():
+  pass
+
+
+# Scheduled modem commands that are due within this many seconds of
+# each other are sent together.
+COALESCE_WINDOW = 1.0
+
+# The number of threads that perform scheduled actions.
+ACTION_WORKERS = 4
+
+# A scheduled action that starts this many seconds or more late is
+# logged.
+LATE_DISPATCH = 10
+
+
+class ActionPool(object):
+  '''ActionPool performs the actions of ScheduledActions on a bounded
+  pool of threads, so that a slow action doesn't hold up the others.
+  Actions in the same scheduling_lane, such as those that use the same
+  InsteonModem, are performed one at a time in the order that they
+  came due.  Actions with no lane are performed in parallel.
+
+  counters records how many actions were performed and the total and
+  maximum dispatch lag, the seconds between when each action was due
+  and when it was started.'''
+
+  def __init__(self, max_workers=ACTION_WORKERS,
+               thread_name_prefix='Scheduled Action Thread'):
+    self.executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+    self.lock = threading.Lock()
+    # Maps each lane that has an action in progress to the
+    # ScheduledActions waiting for it.
+    self.lanes = {}
+    self.counters = collections.Counter()
+
+  def submit(self, entry):
+    lane = scheduling_lane(entry.action)
+    if lane is not None:
+      with self.lock:
+        waiting = self.lanes.get(lane)
+        if waiting is not None:
+          waiting.append(entry)
+          return
+        self.lanes[lane] = collections.deque()
+    self.executor.submit(self._perform, lane, entry)
+
+  def _perform(self, lane, entry):
+    lag = time.monotonic() - entry.due
+    with self.lock:
+      self.counters['performed'] += 1
+      self.counters['total_lag'] += lag
+      if lag > self.counters['max_lag']:
+        self.counters['max_lag'] = lag
+    if lag >= LATE_DISPATCH:
+      _log_scheduler_message(scheduler_operation='SCHEDULED_ACTION_LATE',
+                             sender=self,
+                             timestamp=config.now(),
+                             when=entry.when,
+                             action=entry.action)
+    try:
+      perform(entry)
+    finally:
+      if lane is not None:
+        with self.lock:
+          waiting = self.lanes[lane]
+          if not waiting:
+            del self.lanes[lane]
+            return
+          entry = waiting.popleft()
+        self.executor.submit(self._perform, lane, entry)
+
+  def mean_lag(self):
+    with self.lock:
+      if not self.counters['performed']:
+        return None
+      return self.counters['total_lag'] / self.counters['performed']
+
+  def shutdown(self, wait=True):
+    self.executor.shutdown(wait=wait)
 
-def schedSleep(delay):
-  time.sleep(delay)
 
 class Scheduler(Singleton):
-  empty_queue_wait_time = datetime.timedelta(minutes=5)
-  
   def __init__(self):
-    if 'scheduler' in self.__dict__:
+    if 'queue' in self.__dict__:
       # singleton instance already created.
       return
-    self.scheduler = sched.scheduler(schedTime, schedSleep)
-    self.action_thread = threading.Thread(name='Scheduler Thread',
-                                          target=self)
-    self.action_thread.daemon = True,
-    self.action_thread.start()
+    self.pool = ActionPool()
+    self.queue = ScheduleQueue(dispatch=self.pool.submit,
+                               coalesce_window=COALESCE_WINDOW)
+    _log_scheduler_message(scheduler_operation='SCHEDULER_STARTED',
+                           sender=self,
+                           timestamp=config.now())
+    self.queue.start()
 
   def schedule(self, when, action):
-    '''schedule causes action to be performed according to the specified when.'''
-    self.scheduler.enterabs(schedTime(when), 0, action)
+    '''schedule causes action to be performed according to the specified when.
+    Returns a ScheduledAction.'''
+    handle = self.queue.schedule(when, action)
     _log_scheduler_message(scheduler_operation='EVENT_SCHEDULED',
                            sender=self,
                            timestamp=config.now(),
     	                   when=when,
                            action=action)
+    return handle
 
-  def __call__(self):
-    _log_scheduler_message(scheduler_operation='SCHEDULER_STARTED',
-                           sender=self,
-                           timestamp=config.now())
-    self.scheduler.run(True)
+  def cancel(self, handle):
+    return self.queue.cancel(handle)
+
+  def reschedule(self, handle, when):
+    return self.queue.reschedule(handle, when)
 
   def queued_events(self):
     # *** We're making the assumption here that the scheduler queue
     # *** only has Events as the actions.
-    return [ s.action for s in self.scheduler.queue]
-    
+    return [s.action for s in self.queue.queued()]
+
 
 class NextTimeFunction(object, metaclass=abc.ABCMeta):
   '''NextTimeFunction is an abstract base class to identify objects that
@@ -67,14 +436,15 @@ class NextTimeFunction(object, metaclass=abc.ABCMeta):
     pass
 
   @abc.abstractmethod
-  def __call__(self, now=config.now(), previous=None):
+  def __call__(self, now=None, previous=None):
     '''A NextTimeFunction is called to compute the next time that it's
     associated Event should be scheduled for.
 
     Returns a datetime.Datetime if the associated event is to be
     rescheduled.
 
-    now is a function to return the current time.
+    now is the current time as a datetime.Datetime.  It defaults to
+    config.now().
 
     previous is a datetime.Datetime of the most recent firing of the
     associated Event so that the next firing can be scheduled relative
@@ -95,8 +465,10 @@ class Every(NextTimeFunction):
   def __repr__(self):
     return 'Every(%r)' % self.interval
 
-  def __call__(self, now=config.now(), previous=None):
+  def __call__(self, now=None, previous=None):
     '''Returns the next time that this should occur.'''
+    if now is None:
+      now = config.now()
     if previous:
       next = previous + self.interval
       if next > now:
@@ -116,8 +488,10 @@ class DailyAt(NextTimeFunction):
   def __repr__(self):
     return 'DailyAt(%r, %r)' % (self.hour, self.minute)
 
-  def __call__(self, now=config.now(), previous=None):
+  def __call__(self, now=None, previous=None):
     '''Returns the next time that this should occur.'''
+    if now is None:
+      now = config.now()
     if previous:
       assert previous <= now
     at = datetime.datetime(now.year, now.month, now.day,
@@ -143,7 +517,9 @@ class TimeOffset(NextTimeFunction):
   def __repr__(self):
     return 'TimeOffset(%r, %r' % (self.offset, self.wrapped)
 
-  def __call__(self, now=config.now(), previous=None):
+  def __call__(self, now=None, previous=None):
+    if now is None:
+      now = config.now()
     if isinstance(self.offset, numbers.Number):
       offset = self.offset
     else:
@@ -168,8 +544,19 @@ class Event(object):
     self.next_time_function = next_time_function
     self.when = None
     self.pretty = pretty
+    # The ScheduledAction of the next occurrence.
+    self.handle = None
+    self.cancelled = False
+    # How late, as a datetime.timedelta, the most recent occurrence
+    # started.
+    self.dispatch_lag = None
+
+  @property
+  def scheduling_lane(self):
+    return scheduling_lane(self.action_function)
 
   def schedule(self, previous=None):
+    self.cancelled = False
     # It is expected that the next_time_function will not return a time
     # in the past.
     now_ = config.now()
@@ -184,19 +571,31 @@ class Event(object):
 	                       when=next)
       else:
         self.when = next
-        Scheduler().schedule(next, self)
+        self.handle = Scheduler().schedule(next, self)
+
+  def cancel(self):
+    '''Stops this Event from occurring again, unless it's scheduled again.'''
+    self.cancelled = True
+    if self.handle:
+      Scheduler().cancel(self.handle)
+      self.handle = None
+    self.when = None
 
   def __call__(self):
     self.doAction()
 
-  def doAction(self):
+  def doAction(self, perform=None):
+    '''Performs the action_function, or perform instead if given, and
+    schedules the next occurrence.'''
     _log_scheduler_message(scheduler_operation='EVENT_ACTION',
                            sender=self,
                            timestamp=config.now())
     now_ = config.now()
+    if self.when:
+      self.dispatch_lag = now_ - self.when
     success = False
     try:
-      self.action_function()
+      (perform or self.action_function)()
       success = True
     except Exception as e:
       # TODO Include the error in the log.
@@ -206,7 +605,8 @@ class Event(object):
   	                     when=self.when,
                              action=self)
     finally:
-      self.schedule(previous=self.when)
+      if not self.cancelled:
+        self.schedule(previous=self.when)
     if success:
       _log_scheduler_message(scheduler_operation='SCHEDULED_ACTION_DONE',
                              sender=self,
@@ -224,6 +624,7 @@ SCHEDULE_OPERATION_LOG_LEVEL = {
   'EVENT_SCHEDULED': logging.INFO,
   'SCHEDULED_ACTION_DONE': logging.INFO,
   'SCHEDULED_ACTION_FAILED': logging.ERROR,
+  'SCHEDULED_ACTION_LATE': logging.WARNING,
   'SCHEDULED_NEXT_BEFORE_NOW': logging.WARNING
 }
 
@@ -5,6 +5,8 @@
 # immediately if the singleton instance has already been initialized.
 
 class Singleton(object):
+  __slots__ = ()
+
   def __new__(cls, *args, **kwds):
     it = cls.__dict__.get("__it__")
     if it is not None:
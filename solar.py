@@ -3,7 +3,9 @@
 # The formulas used here come from
 # https://www.mathworks.com/examples/matlab/community/21093-estimating-sunrise-and-sunset
 
+import array
 import datetime
+import functools
 import math
 import config
 from schedule import NextTimeFunction
@@ -30,10 +32,60 @@ def acos(x):
   return math.degrees(math.acos(x))
 
 
+def eot(day):
+  '''Returns the Equation of Time correction in minutes for the given
+  day of the year.'''
+  B = 360 * (day - 81) / 365
+  return 9.87 * sin(2*B)- 7.53 * cos(B) - 1.5 * sin(B)
+
+def declination(day):
+  '''Returns the sun's declination in degrees on the given day of the
+  year.'''
+  return asin(sin(23.45) *
+              sin(((day - 81)
+                   * 360/365)))
+
+def half_day(latitude, day):
+  '''Returns the time in hours between sunrise or sunset and solar
+  noon at latitude on the given day of the year, or NaN if the sun
+  doesn't rise or doesn't set.'''
+  x = -tan(latitude) * tan(declination(day))
+  if not -1 <= x <= 1:
+    return math.nan
+  return acos(x) / 15
+
+
+# Days of the year run from 1 to 366.
+DAYS = range(1, 367)
+
+@functools.lru_cache(maxsize=None)
+def eot_table():
+  '''Returns an array of eot indexed by day of the year.'''
+  return array.array('d', [0.0] + [eot(day) for day in DAYS])
+
+@functools.lru_cache(maxsize=16)
+def half_day_table(latitude):
+  '''Returns an array of half_day at latitude indexed by day of the year.'''
+  return array.array('d', [0.0] + [half_day(latitude, day) for day in DAYS])
+
+
+# The number of dates for which each Solar remembers the times of
+# solar noon, sunrise and sunset.
+DAYS_CACHED = 64
+
+
 class Solar(object):
+  '''Solar computes the times of sunrise, solar noon and sunset at a
+  location.  The parts of the computation that only depend on the day
+  of the year are looked up in tables that are computed once, and the
+  results for recent dates are remembered.'''
+
   def __init__(self, latitude, longitude):
     self.latitude = latitude
     self.longitude = longitude
+    self.eot_table = eot_table()
+    self.half_day_table = half_day_table(latitude)
+    self._times = functools.lru_cache(maxsize=DAYS_CACHED)(self._compute_times)
 
   def __repr__(self):
     return 'Solar(%r, %r)' % (self.latitude, self.longitude)
@@ -52,8 +104,7 @@ class Solar(object):
   def eot_correction(self, t):
     '''Returns the Equation of Time correction in minutes for the given day.'''
     assert isinstance(t, datetime.datetime)
-    B = 360 * (day_of_year(t) - 81) / 365
-    return 9.87 * sin(2*B)- 7.53 * cos(B) - 1.5 * sin(B)
+    return eot(day_of_year(t))
 
   def solar_correction(self, t):
     '''Returns the solar correction in minutes for the given day.'''
@@ -62,9 +113,7 @@ class Solar(object):
 
   def declination(self, t):
     assert isinstance(t, datetime.datetime)
-    return asin(sin(23.45) *
-                sin(((day_of_year(t) - 81)
-                     * 360/365)))
+    return declination(day_of_year(t))
 
   def solar_noon_offset(self, t):
     '''The difference between solar noon and sunrise or sunset.'''
@@ -72,6 +121,26 @@ class Solar(object):
     return datetime.timedelta(hours=acos(-tan(self.latitude) *
                                          tan(self.declination(t))) / 15)
 
+  def times(self, t):
+    '''Returns the times of solar noon, sunrise and sunset on the date
+    of t, in the timezone of t.  Sunrise and sunset are None if the
+    sun doesn't rise and set that day.'''
+    assert isinstance(t, datetime.datetime)
+    return self._times(t.toordinal(), t.tzinfo, self.utc_offset(t))
+
+  def _compute_times(self, ordinal, tzinfo, utc_offset):
+    date = datetime.date.fromordinal(ordinal)
+    day = date.timetuple().tm_yday
+    noon = datetime.datetime(date.year, date.month, date.day,
+                             12, 0, 0, 0, tzinfo)
+    correction = 4 * (self.longitude - 15 * utc_offset) + self.eot_table[day]
+    solar_noon = noon - datetime.timedelta(minutes=correction)
+    hours = self.half_day_table[day]
+    if math.isnan(hours):
+      return solar_noon, None, None
+    offset = datetime.timedelta(hours=hours)
+    return solar_noon, solar_noon - offset, solar_noon + offset
+
   def noon(self, t):
     '''Returns local conventional noon for the given date.'''
     assert isinstance(t, datetime.datetime)
@@ -79,13 +148,68 @@ class Solar(object):
 
   def solar_noon(self, t):
     '''Returns local solar noon for the given date.'''
-    return self.noon(t) - datetime.timedelta(minutes=self.solar_correction(t))
+    return self.times(t)[0]
 
   def sunrise(self, t):
-    return self.solar_noon(t) - self.solar_noon_offset(t)
+    return self._rise_or_set(t, 1)
 
   def sunset(self, t):
-    return self.solar_noon(t) + self.solar_noon_offset(t)
+    return self._rise_or_set(t, 2)
+
+  # The _range methods need numpy, which is imported when they're
+  # first used.  They return numpy datetime64 arrays of UTC times, one
+  # for each date from start up to but not including end.  start and
+  # end can be datetime.dates or anything else numpy.datetime64
+  # accepts.  They use the same tables as the methods above, so the
+  # times agree with theirs to the microsecond.
+
+  def solar_noon_range(self, start, end):
+    days, solar_noon, half_day = self._range(start, end)
+    return solar_noon
+
+  def sunrise_range(self, start, end):
+    '''NaT marks the days when the sun doesn't rise and set.'''
+    days, solar_noon, half_day = self._range(start, end)
+    return solar_noon - half_day
+
+  def sunset_range(self, start, end):
+    '''NaT marks the days when the sun doesn't rise and set.'''
+    days, solar_noon, half_day = self._range(start, end)
+    return solar_noon + half_day
+
+  def _range(self, start, end):
+    import numpy as np
+    days = np.arange(_as_day(start), _as_day(end), dtype='datetime64[D]')
+    day = (days - days.astype('datetime64[Y]')).astype(np.int64) + 1
+    # Noon in UTC is 15 degrees of longitude away from local noon for
+    # each hour of UTC offset, so the offset cancels out.
+    minutes = 4 * self.longitude + np.asarray(self.eot_table)[day]
+    noon = days.astype('datetime64[us]') + np.timedelta64(12, 'h')
+    solar_noon = noon - _microseconds(minutes * 60e6)
+    half_day = _microseconds(np.asarray(self.half_day_table)[day] * 3600e6)
+    return days, solar_noon, half_day
+
+  def _rise_or_set(self, t, index):
+    at = self.times(t)[index]
+    if at is None:
+      raise ValueError('The sun does not rise and set at latitude %r on %s' %
+                       (self.latitude, t.date()))
+    return at
+
+
+def _as_day(d):
+  import numpy as np
+  if isinstance(d, datetime.datetime):
+    d = d.date()
+  return np.datetime64(d, 'D')
+
+def _microseconds(a):
+  # Converts an array of microseconds to timedelta64, rounding like
+  # datetime.timedelta and making NaNs NaT.
+  import numpy as np
+  return np.where(np.isnan(a), np.timedelta64('NaT'),
+                  np.rint(np.nan_to_num(a)).astype(np.int64)
+                  .astype('timedelta64[us]'))
 
 
 class SolarEvent(NextTimeFunction):
@@ -104,8 +228,10 @@ class SolarEvent(NextTimeFunction):
   def __repr__(self):
     return 'SolarEvent(%r, %r)' % (self.solar, self.solar_event)
 
-  def __call__(self, now=config.now(), previous=None):
+  def __call__(self, now=None, previous=None):
     '''Returns the next time that this should occur.'''
+    if now is None:
+      now = config.now()
     at = self.calc(now)
     if at > now:
       return at
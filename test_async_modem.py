@@ -0,0 +1,90 @@
+import asyncio
+import unittest
+import async_modem
+import fake_modem
+import modem
+from translator import *
+
+
+DEVICE = 0x0f829e
+
+
+class TestAsyncInsteonModem (unittest.IsolatedAsyncioTestCase):
+  def setUp(self):
+    self.fake = fake_modem.FakeInsteonModem([DEVICE], seed=1,
+                                            device_latency=0.01)
+    self.im = modem.InsteonModem(self.fake, response_timeout=0.2)
+    self.am = async_modem.AsyncInsteonModem(self.im)
+
+  def tearDown(self):
+    self.am.close()
+    self.im.stop_reader()
+
+  async def test_send(self):
+    echo = await self.am.send(SendAllLinkCommand(LinkGroup(3), OnCmd(), Byte(0)))
+    self.assertEqual(int(echo.Echoed.LinkGroup), 3)
+    self.assertIs(echo.AckNack, Ack())
+
+  async def test_request(self):
+    info = await self.am.request(GetModemInfo(), expect=ModemInfoResponse)
+    self.assertEqual(int(info.InsteonAddress), fake_modem.MODEM_ADDRESS)
+    self.fake.levels[DEVICE] = 0x80
+    reply = await self.am.request(
+      SendMessageCommand(InsteonAddress(*fake_modem._address_bytes(DEVICE)),
+                         MessageFlags(extended=False, max_hops=3,
+                                      hops_remaining=3),
+                         StatusRequestCmd(), Command2(0)),
+      expect=StandardMessageReceived)
+    self.assertEqual(reply.Byte.byte, 0x80)
+
+  async def test_cancel_request(self):
+    self.fake.echo_latency = 0.1
+    with self.assertRaises(asyncio.TimeoutError):
+      await asyncio.wait_for(self.am.send(GetIMConfigurationCommand()), 0.01)
+    # The cancelled command still finishes, and then the modem is free.
+    self.fake.echo_latency = 0
+    echo = await self.am.send(SendAllLinkCommand(LinkGroup(1), OffCmd(), Byte(0)))
+    self.assertEqual(int(echo.Echoed.LinkGroup), 1)
+    self.assertEqual(len(self.fake.commands), 2)
+
+  async def test_status_messages(self):
+    messages = self.am.status_messages()
+    pending = asyncio.ensure_future(messages.__anext__())
+    await asyncio.sleep(0.01)
+    self.assertEqual(len(self.am.subscribers), 1)
+    self.fake.inject(StandardMessageReceived(
+      FromAddress(*fake_modem._address_bytes(DEVICE)), ToAddress(0, 0, 1),
+      fake_modem.BROADCAST_FLAGS, OnCmd(), Byte(0)).encode())
+    msg = await asyncio.wait_for(pending, 5)
+    self.assertEqual(int(msg.FromAddress), DEVICE)
+    # Cancelling a pending await unsubscribes.
+    pending = asyncio.ensure_future(messages.__anext__())
+    await asyncio.sleep(0.01)
+    pending.cancel()
+    with self.assertRaises(asyncio.CancelledError):
+      await pending
+    self.assertEqual(self.am.subscribers, [])
+
+
+  async def test_status_messages_skip_replies(self):
+    messages = self.am.status_messages()
+    pending = asyncio.ensure_future(messages.__anext__())
+    await asyncio.sleep(0.01)
+    reply = await self.am.request(
+      SendMessageCommand(InsteonAddress(*fake_modem._address_bytes(DEVICE)),
+                         MessageFlags(extended=False, max_hops=3,
+                                      hops_remaining=3),
+                         StatusRequestCmd(), Command2(0)),
+      expect=StandardMessageReceived)
+    self.assertEqual(int(reply.FromAddress), DEVICE)
+    # The reply went to request(), so the broadcast comes out first.
+    self.fake.inject(StandardMessageReceived(
+      FromAddress(*fake_modem._address_bytes(DEVICE)), ToAddress(0, 0, 1),
+      fake_modem.BROADCAST_FLAGS, OnCmd(), Byte(0)).encode())
+    msg = await asyncio.wait_for(pending, 5)
+    self.assertEqual(int(msg.ToAddress), 1)
+    await messages.aclose()
+
+
+if __name__ == '__main__':
+  unittest.main()
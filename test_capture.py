@@ -0,0 +1,98 @@
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import capture
+import config
+
+
+SMR_BYTES = bytes([0x02, 0x50, 0x0f, 0x82, 0x9e, 0x49, 0x93, 0xbf,
+                   0x41, 0x13, 0x01])
+COMMAND_BYTES = bytes([0x02, 0x61, 0x01, 0x11, 0x00])
+
+
+class TestCapture (unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'test.capture')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_round_trip(self):
+    writer = capture.CaptureWriter(self.path)
+    writer.write(capture.HOST_TO_MODEM, COMMAND_BYTES)
+    writer.write(capture.MODEM_TO_HOST, COMMAND_BYTES + b'\x06')
+    writer.close()
+    # A second session appends to the same file.
+    writer = capture.CaptureWriter(self.path)
+    writer.write(capture.MODEM_TO_HOST, SMR_BYTES)
+    writer.close()
+    records = list(capture.CaptureReader(self.path))
+    self.assertEqual([(r.direction, r.data) for r in records],
+                     [(capture.HOST_TO_MODEM, COMMAND_BYTES),
+                      (capture.MODEM_TO_HOST, COMMAND_BYTES + b'\x06'),
+                      (capture.MODEM_TO_HOST, SMR_BYTES)])
+    self.assertTrue(records[0].monotonic <= records[1].monotonic)
+    self.assertAlmostEqual(records[0].time, records[2].time, delta=60)
+
+  def test_partial_record(self):
+    writer = capture.CaptureWriter(self.path)
+    writer.write(capture.MODEM_TO_HOST, SMR_BYTES)
+    writer.close()
+    with open(self.path, 'ab') as f:
+      f.write(capture.RECORD.pack(0, capture.MODEM_TO_HOST, 11) + b'\x02')
+    self.assertEqual([r.data for r in capture.CaptureReader(self.path)],
+                     [SMR_BYTES])
+
+  def test_render(self):
+    writer = capture.CaptureWriter(self.path)
+    writer.write(capture.MODEM_TO_HOST, SMR_BYTES)
+    writer.close()
+    out = io.StringIO()
+    capture.render(self.path, out)
+    self.assertIn('StandardMessageReceived', out.getvalue())
+
+  def test_flush_interval(self):
+    writer = capture.CaptureWriter(self.path, flush_interval=0.05)
+    writer.write(capture.MODEM_TO_HOST, SMR_BYTES)
+    # The record is written out without any further writes.
+    deadline = time.monotonic() + 5
+    while os.path.getsize(self.path) == 0 and time.monotonic() < deadline:
+      time.sleep(0.01)
+    records = list(capture.CaptureReader(self.path))
+    writer.close()
+    self.assertEqual([r.data for r in records], [SMR_BYTES])
+
+  def test_rotate(self):
+    writer = capture.CaptureWriter(self.path, max_bytes=100)
+    for i in range(10):
+      writer.write(capture.MODEM_TO_HOST, SMR_BYTES)
+    writer.close()
+    self.assertLessEqual(os.path.getsize(self.path), 100)
+    self.assertLessEqual(os.path.getsize(self.path + '.1'), 100)
+    older = list(capture.CaptureReader(self.path + '.1'))
+    newer = list(capture.CaptureReader(self.path))
+    self.assertTrue(older and newer)
+    self.assertTrue(older[-1].monotonic <= newer[0].monotonic)
+
+  def test_startup(self):
+    saved = config.CAPTURE_PATH
+    try:
+      config.CAPTURE_PATH = None
+      capture._do_onStartup_capture()
+      self.assertIsNone(capture._writer)
+      config.CAPTURE_PATH = self.path
+      capture._do_onStartup_capture()
+      capture._capture_traffic(None, 'MODEM_RESPONSE', None, SMR_BYTES)
+    finally:
+      capture._do_onShutdown_capture()
+      config.CAPTURE_PATH = saved
+    self.assertEqual([r.data for r in capture.CaptureReader(self.path)],
+                     [SMR_BYTES])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,305 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+import fake_modem
+import modem
+import schedule
+from pydispatch import dispatcher
+from translator import *
+
+
+DEVICES = [0x0f838f, 0x0f829e]
+
+
+class FakeModemTestCase (unittest.TestCase):
+  def setUp(self):
+    # Devices and link groups are registered globally.
+    self.saved = (dict(modem.InsteonDevice.devices),
+                  dict(modem.InsteonDevice.routes),
+                  dict(modem.InsteonLinkGroup.groups))
+    modem.InsteonDevice.devices.clear()
+    modem.InsteonDevice.routes.clear()
+    modem.InsteonLinkGroup.groups.clear()
+    self.modems = []
+
+  def tearDown(self):
+    for im in self.modems:
+      im.stop_reader()
+    devices, routes, groups = self.saved
+    modem.InsteonDevice.devices.clear()
+    modem.InsteonDevice.devices.update(devices)
+    modem.InsteonDevice.routes.clear()
+    modem.InsteonDevice.routes.update(routes)
+    modem.InsteonLinkGroup.groups.clear()
+    modem.InsteonLinkGroup.groups.update(groups)
+
+  def make_modem(self, **kwargs):
+    self.fake = fake_modem.FakeInsteonModem(DEVICES, seed=1, **kwargs)
+    im = modem.InsteonModem(self.fake, response_timeout=0.5)
+    self.modems.append(im)
+    return im
+
+
+class TestFakeModem (FakeModemTestCase):
+  def test_modeminfo(self):
+    im = self.make_modem()
+    device = im.modeminfo()
+    self.assertEqual(int(device.address), fake_modem.MODEM_ADDRESS)
+    self.assertIs(im.device, device)
+
+  def test_read_link_db(self):
+    im = self.make_modem()
+    im.read_link_db()
+    group = modem.InsteonLinkGroup.lookup(1)
+    self.assertEqual(sorted(int(d.address) for d in group.devices),
+                     sorted(DEVICES))
+
+  def test_read_link_db_with_traffic(self):
+    for reader in (False, True):
+      modem.InsteonLinkGroup.groups.clear()
+      im = self.make_modem()
+      if reader:
+        im.start_reader()
+      # Another device's broadcast arrives before each link record.
+      broadcast = StandardMessageReceived(
+        FromAddress(0x0f, 0x83, 0x8f), ToAddress(0, 0, 1),
+        fake_modem.BROADCAST_FLAGS, OnCmd(), Byte(0)).encode()
+      schedule = self.fake._schedule
+      def schedule_with_traffic(data, delay):
+        if data[:2] == bytes((0x02, 0x57)):
+          schedule(broadcast, delay)
+        schedule(data, delay)
+      self.fake._schedule = schedule_with_traffic
+      im.read_link_db()
+      group = modem.InsteonLinkGroup.lookup(1)
+      self.assertEqual(sorted(int(d.address) for d in group.devices),
+                       sorted(DEVICES))
+
+  def test_device_commands(self):
+    im = self.make_modem()
+    device = modem.InsteonDevice(InsteonAddress('0f.83.8f'))
+    self.assertTrue(device.on(im)[0])
+    self.assertEqual(self.fake.levels[0x0f838f], 0xff)
+    self.assertTrue(device.off(im)[0])
+    self.assertEqual(self.fake.levels[0x0f838f], 0)
+
+  def test_group_commands(self):
+    im = self.make_modem()
+    im.groupOn(2)
+    on = im.group_commands[(2, OnCmd)]
+    im.groupOff(2)
+    im.groupOn(2)
+    # Each group's commands are built, and so encoded, only once.
+    self.assertIs(im.group_commands[(2, OnCmd)], on)
+    self.assertEqual(len(im.group_commands), 2)
+    self.assertEqual(self.fake.commands, [on.encode(),
+                                          im.group_commands[(2, OffCmd)].encode(),
+                                          on.encode()])
+
+  def test_status(self):
+    im = self.make_modem(device_latency=0.01)
+    device = modem.InsteonDevice(InsteonAddress('0f.82.9e'))
+    self.assertEqual(device.status(im), 0)
+    self.fake.levels[0x0f829e] = 0x80
+    self.assertEqual(device.status(im), 0x80)
+
+  def test_status_with_traffic(self):
+    im = self.make_modem(device_latency=0.05)
+    im.start_reader()
+    device = modem.InsteonDevice(InsteonAddress('0f.82.9e'))
+    self.fake.levels[0x0f829e] = 0x80
+    # Another device's broadcast arrives before the status reply.
+    self.fake.inject(StandardMessageReceived(
+      FromAddress(0x0f, 0x83, 0x8f), ToAddress(0, 0, 1),
+      fake_modem.BROADCAST_FLAGS, OnCmd(), Byte(0)).encode(), 0.01)
+    self.assertEqual(device.status(im), 0x80)
+
+  def test_stale_frame_before_echo(self):
+    for reader in (False, True):
+      im = self.make_modem()
+      if reader:
+        im.start_reader()
+      # A message left over from before the command is read first.
+      self.fake.inject(bytes.fromhex('025806'))
+      command = SendAllLinkCommand(LinkGroup(1), OnCmd(), Byte(0))
+      echo = im.submit(command).result(timeout=5)
+      self.assertIs(echo.AckNack, Ack())
+      self.fake.inject(bytes.fromhex('025806'))
+      response = im.exchange(command.encode())
+      im.check_echo(command.encode(), response)
+
+  def test_nak_retry(self):
+    im = self.make_modem(nak_probability=1.0)
+    im.retry_policy = modem.RetryPolicy(max_attempts=3, initial_delay=0.001)
+    command = SendAllLinkCommand(LinkGroup(1), OnCmd(), Byte(0)).encode()
+    self.assertTrue(im.is_nak(command, im.exchange(command)))
+    self.assertEqual(im.counters['naks'], 3)
+    self.assertEqual(im.counters['abandoned'], 1)
+    self.assertEqual(len(self.fake.commands), 3)
+
+  def test_nak_after_traffic(self):
+    im = self.make_modem(nak_probability=1.0)
+    im.retry_policy = modem.RetryPolicy(max_attempts=3, initial_delay=0.001)
+    command = SendAllLinkCommand(LinkGroup(1), OnCmd(), Byte(0)).encode()
+    stale = bytes.fromhex('025806')
+    nak = command + bytes((Nack.byte_code,))
+    self.assertTrue(im.is_nak(command, stale + nak))
+    self.assertFalse(im.is_nak(command, stale + command + bytes((Ack.byte_code,))))
+    # The NAK still counts, and the command is retried.
+    self.fake.inject(stale)
+    self.assertTrue(im.is_nak(command, im.exchange(command)))
+    self.assertEqual(im.counters['naks'], 3)
+    self.assertEqual(len(self.fake.commands), 3)
+
+  def test_device_command_after_traffic(self):
+    im = self.make_modem()
+    device = modem.InsteonDevice(InsteonAddress('0f.83.8f'))
+    self.fake.inject(bytes.fromhex('025806'))
+    self.assertTrue(device.on(im)[0])
+
+  def test_nak_framing(self):
+    # Every NAK the fake modem sends can be framed, so the reader stays
+    # in step with the messages that follow.
+    im = self.make_modem(nak_probability=1.0)
+    im.retry_policy = modem.RetryPolicy(max_attempts=1)
+    im.start_reader()
+    device = im.modeminfo()
+    self.assertEqual(int(device.address), fake_modem.MODEM_ADDRESS)
+    command = SendAllLinkCommand(LinkGroup(1), OnCmd(), Byte(0)).encode()
+    self.assertTrue(im.is_nak(command, im.exchange(command)))
+    self.assertEqual(im.reader.frame_parser.pending(), 0)
+
+  def test_failing_receiver(self):
+    im = self.make_modem()
+    im.start_reader()
+    def fail(sender, signal, timestamp, bytes):
+      raise RuntimeError('receiver failed')
+    dispatcher.connect(fail, signal='MODEM_RESPONSE', sender=im)
+    command = SendAllLinkCommand(LinkGroup(1), OnCmd(), Byte(0)).encode()
+    try:
+      im.check_echo(command, im.exchange(command))
+      # The reader survives the receiver's failure.
+      self.assertTrue(im.reader_running())
+      im.check_echo(command, im.exchange(command))
+    finally:
+      dispatcher.disconnect(fail, signal='MODEM_RESPONSE', sender=im)
+
+  def test_dead_reader(self):
+    im = self.make_modem()
+    im.start_reader()
+    im.reader.stop()
+    im.reader.join()
+    self.assertFalse(im.reader_running())
+    # Commands are read directly again.
+    command = SendAllLinkCommand(LinkGroup(1), OnCmd(), Byte(0)).encode()
+    im.check_echo(command, im.exchange(command))
+
+  def test_governor(self):
+    im = self.make_modem()
+    im.governor = modem.SendRateGovernor(rate=10, burst=1)
+    dispatched = []
+    def command(sender, signal, timestamp, bytes):
+      dispatched.append(time.monotonic())
+    dispatcher.connect(command, signal='MODEM_COMMAND', sender=im)
+    try:
+      for g in (1, 2):
+        im.exchange(SendAllLinkCommand(LinkGroup(g), OnCmd(), Byte(0)).encode())
+    finally:
+      dispatcher.disconnect(command, signal='MODEM_COMMAND', sender=im)
+    # MODEM_COMMAND is sent after the governor's delay, not before.
+    self.assertGreaterEqual(dispatched[1] - dispatched[0], 0.09)
+    self.assertGreater(im.counters['governor_delay'], 0)
+    self.assertEqual(im.counters['commands_sent'], 2)
+
+  def test_submit_all(self):
+    im = self.make_modem()
+    futures = im.submit_all([SendAllLinkCommand(LinkGroup(g), OnCmd(), Byte(0))
+                             for g in range(1, 6)])
+    echoes = [f.result(timeout=5) for f in futures]
+    self.assertEqual([int(e.Echoed.LinkGroup) for e in echoes], [1, 2, 3, 4, 5])
+
+  def test_submit_during_exchange(self):
+    im = self.make_modem()
+    holding = threading.Event()
+    release = threading.Event()
+    def exchange():
+      with im.command_lock:
+        holding.set()
+        release.wait(5)
+    thread = threading.Thread(target=exchange)
+    thread.start()
+    holding.wait(5)
+    # submit doesn't wait for the exchange in progress.
+    start = time.monotonic()
+    future = im.submit(SendAllLinkCommand(LinkGroup(1), OnCmd(), Byte(0)))
+    self.assertLess(time.monotonic() - start, 1)
+    self.assertFalse(future.done())
+    release.set()
+    thread.join()
+    self.assertIs(future.result(timeout=5).AckNack, Ack())
+
+  def test_coalesced_commands(self):
+    im = self.make_modem()
+    def action(group, cmd):
+      return modem.InsteonCommandAction(
+        im, SendAllLinkCommand(LinkGroup(group), cmd, Byte(0)))
+    schedule.CoalescedActions([action(1, OnCmd()), action(2, OnCmd()),
+                               action(1, OnCmd()), action(1, OffCmd())])()
+    self.assertEqual(self.fake.commands,
+                     [action(2, OnCmd()).command.encode(),
+                      action(1, OffCmd()).command.encode()])
+
+  def test_late_reply_order(self):
+    self.make_modem(device_latency=0.01)
+    status = SendMessageCommand(
+      InsteonAddress(*fake_modem._address_bytes(DEVICES[1])),
+      MessageFlags(extended=False, max_hops=3, hops_remaining=3),
+      StatusRequestCmd(), Command2(0)).encode()
+    group_on = SendAllLinkCommand(LinkGroup(1), OnCmd(), Byte(0)).encode()
+    self.fake.write(status)
+    time.sleep(0.05)
+    # The status reply was due before the second command's echo.
+    self.fake.write(group_on)
+    self.fake.timeout = 0
+    frames = FrameParser(ReadFromModem).feed_frames(
+      self.fake.read(self.fake.in_waiting))
+    self.assertEqual([frame[1] for frame in frames], [0x62, 0x50, 0x61])
+
+  def test_spontaneous_traffic(self):
+    im = self.make_modem(traffic_rate=100)
+    devices = [modem.InsteonDevice(InsteonAddress(*fake_modem._address_bytes(d)))
+               for d in DEVICES]
+    received = []
+    im.when(StandardMessageReceived(
+              MatchVariable("from"), MatchVariable("to"),
+              MatchVariable("flags"), MatchVariable("cmd1"),
+              MatchVariable("cmd2")),
+            lambda: received.append(True))
+    import plumbing
+    plumbing._do_onInsteonModemInitialized(im)
+    im.start_reader()
+    deadline = time.monotonic() + 5
+    while (time.monotonic() < deadline and
+           not all(d.received_timestamp for d in devices)):
+      time.sleep(0.01)
+    for d in devices:
+      self.assertIn(d.cmd1, (OnCmd(), OffCmd()))
+    self.assertTrue(received)
+
+
+class TestImport (unittest.TestCase):
+  def test_each_module(self):
+    # Each module has to import on its own, not only after modem.
+    package = os.path.dirname(os.path.abspath(modem.__file__))
+    for module in ('errors', 'devices', 'link_groups', 'modem'):
+      done = subprocess.run([sys.executable, '-c', 'import ' + module],
+                            cwd=package, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+      self.assertEqual(done.returncode, 0, done.stderr)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,75 @@
+import logging
+import queue
+import threading
+import unittest
+import config
+import insteon_logging
+
+
+ECHO_BYTES = bytes([0x02, 0x61, 0x01, 0x11, 0x00, 0x06])
+
+
+class Collector (logging.Handler):
+  def __init__(self):
+    super(Collector, self).__init__()
+    self.messages = []
+
+  def emit(self, record):
+    self.messages.append(record.getMessage())
+
+
+class TestLogListener (unittest.TestCase):
+  def setUp(self):
+    self.collector = Collector()
+    self.root = logging.getLogger()
+    self.level = self.root.level
+    self.root.addHandler(self.collector)
+    self.root.setLevel(logging.INFO)
+
+  def tearDown(self):
+    insteon_logging.stop_listener()
+    self.root.removeHandler(self.collector)
+    self.root.setLevel(self.level)
+
+  def test_traffic(self):
+    insteon_logging.start_listener()
+    command = bytearray(ECHO_BYTES)
+    insteon_logging._log_modem_traffic(None, 'MODEM_RESPONSE',
+                                       config.now(), command)
+    # The logged bytes were copied.
+    command[2] = 0x02
+    insteon_logging.stop_listener()
+    [message] = self.collector.messages
+    self.assertIn('SendAllLinkCommand', message)
+    self.assertIn('LinkGroup(0x01)', message)
+
+  def test_disabled(self):
+    self.root.setLevel(logging.WARNING)
+    insteon_logging.start_listener()
+    insteon_logging._log_modem_traffic(None, 'MODEM_RESPONSE',
+                                       config.now(), ECHO_BYTES)
+    insteon_logging.stop_listener()
+    self.assertEqual(self.collector.messages, [])
+
+  def test_dropped(self):
+    handler = insteon_logging._DeferredFormatQueueHandler(queue.Queue(1))
+    for i in range(3):
+      handler.handle(logging.makeLogRecord({'msg': 'message %d' % i}))
+    self.assertEqual(handler.dropped, 2)
+    self.assertEqual(handler.queue.get_nowait().getMessage(), 'message 0')
+
+  def test_dropped_threads(self):
+    handler = insteon_logging._DeferredFormatQueueHandler(queue.Queue(1))
+    record = logging.makeLogRecord({'msg': 'message'})
+    def log():
+      for i in range(1000):
+        handler.enqueue(record)
+    threads = [threading.Thread(target=log) for i in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(handler.dropped, 8 * 1000 - 1)
+
+if __name__ == '__main__':
+  unittest.main()
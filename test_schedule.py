@@ -0,0 +1,274 @@
+import concurrent.futures
+import datetime
+import threading
+import time
+import unittest
+import unittest.mock
+import config
+from schedule import *
+
+
+def seconds_from_now(seconds):
+  return config.now() + datetime.timedelta(seconds=seconds)
+
+
+class TestScheduleQueue (unittest.TestCase):
+  def setUp(self):
+    self.queue = ScheduleQueue('Test Scheduler Thread')
+    self.queue.start()
+    self.performed = []
+    self.done = threading.Event()
+
+  def tearDown(self):
+    self.queue.stop()
+
+  def action(self, name, last=False):
+    def perform():
+      self.performed.append(name)
+      if last:
+        self.done.set()
+    return perform
+
+  def test_order(self):
+    self.queue.schedule(seconds_from_now(0.06), self.action('c', True))
+    self.queue.schedule(seconds_from_now(0.02), self.action('a'))
+    self.queue.schedule(seconds_from_now(0.04), self.action('b'))
+    self.assertTrue(self.done.wait(5))
+    self.assertEqual(self.performed, ['a', 'b', 'c'])
+
+  def test_wakeup_on_insert(self):
+    self.queue.schedule(seconds_from_now(3600), self.action('later'))
+    # Let the thread start waiting for the first action.
+    time.sleep(0.02)
+    start = time.monotonic()
+    self.queue.schedule(seconds_from_now(0.01), self.action('soon', True))
+    self.assertTrue(self.done.wait(5))
+    self.assertLess(time.monotonic() - start, 1)
+    self.assertEqual(self.performed, ['soon'])
+    self.assertEqual(len(self.queue), 1)
+
+  def test_cancel(self):
+    handle = self.queue.schedule(seconds_from_now(0.01), self.action('a'))
+    self.queue.schedule(seconds_from_now(0.05), self.action('b', True))
+    self.assertTrue(self.queue.cancel(handle))
+    self.assertFalse(self.queue.cancel(handle))
+    self.assertTrue(self.done.wait(5))
+    self.assertEqual(self.performed, ['b'])
+    self.assertEqual(len(self.queue), 0)
+
+  def test_same_time(self):
+    when = seconds_from_now(0.02)
+    for i in range(20):
+      self.queue.schedule(when, self.action(i, i == 19))
+    self.assertTrue(self.done.wait(5))
+    self.assertEqual(self.performed, list(range(20)))
+
+  def test_reschedule(self):
+    handle = self.queue.schedule(seconds_from_now(3600), self.action('a', True))
+    handle = self.queue.reschedule(handle, seconds_from_now(0.01))
+    self.assertTrue(self.done.wait(5))
+    self.assertEqual(self.performed, ['a'])
+    self.assertFalse(handle.queued)
+
+  def test_queued(self):
+    later = self.queue.schedule(seconds_from_now(7200), self.action('b'))
+    first = self.queue.schedule(seconds_from_now(3600), self.action('a'))
+    cancelled = self.queue.schedule(seconds_from_now(1800), self.action('c'))
+    self.queue.cancel(cancelled)
+    self.assertEqual(self.queue.queued(), [first, later])
+
+  def test_compaction(self):
+    handles = [self.queue.schedule(seconds_from_now(3600 + i), self.action(i))
+               for i in range(100)]
+    for handle in handles[1:]:
+      self.queue.cancel(handle)
+    self.assertEqual(len(self.queue), 1)
+    self.assertLessEqual(len(self.queue.heap), 51)
+
+  def step_clock(self, seconds):
+    # Sets the time of day seconds ahead, as far as the queue can tell.
+    # when.timestamp() doesn't use time.time, so it isn't affected.
+    real = time.time
+    return unittest.mock.patch('time.time', lambda: real() + seconds)
+
+  def test_clock_step_forward(self):
+    with unittest.mock.patch('schedule.CLOCK_CHECK_INTERVAL', 0.01):
+      self.queue.schedule(seconds_from_now(3600), self.action('a', True))
+      time.sleep(0.02)
+      with self.step_clock(3600):
+        self.assertTrue(self.done.wait(5))
+    self.assertEqual(self.performed, ['a'])
+
+  def test_clock_step_back(self):
+    with unittest.mock.patch('schedule.CLOCK_CHECK_INTERVAL', 0.01):
+      self.queue.schedule(seconds_from_now(0.1), self.action('b'))
+      with self.step_clock(-3600):
+        # It's now an hour earlier, so b is due in an hour.
+        self.queue.schedule(seconds_from_now(0.05 - 3600), self.action('a', True))
+        self.assertTrue(self.done.wait(5))
+        time.sleep(0.1)
+    self.assertEqual(self.performed, ['a'])
+
+  def test_failure(self):
+    def fail():
+      raise Exception('failed')
+    self.queue.schedule(seconds_from_now(0.01), fail)
+    self.queue.schedule(seconds_from_now(0.02), self.action('a', True))
+    self.assertTrue(self.done.wait(5))
+    self.assertEqual(self.performed, ['a'])
+
+
+class Lane(object):
+  scheduling_lane = 'lane'
+
+  def __init__(self, action):
+    self.action = action
+
+  def __call__(self):
+    self.action()
+
+
+class TestActionPool (unittest.TestCase):
+  def setUp(self):
+    self.pool = ActionPool(max_workers=4)
+    self.queue = ScheduleQueue('Test Scheduler Thread', self.pool.submit)
+    self.queue.start()
+
+  def tearDown(self):
+    self.queue.stop()
+    self.pool.shutdown()
+
+  def test_parallel(self):
+    # Each action waits for the other, which only works if they run at
+    # the same time.
+    barrier = threading.Barrier(2, timeout=5)
+    results = []
+    for i in range(2):
+      self.queue.schedule(seconds_from_now(0),
+                          lambda: results.append(barrier.wait()))
+    time.sleep(0.05)
+    self.pool.shutdown()
+    self.assertEqual(sorted(results), [0, 1])
+
+  def test_lane(self):
+    running = []
+    order = []
+    overlapped = []
+    done = threading.Event()
+    def action(i):
+      def perform():
+        if running:
+          overlapped.append(i)
+        running.append(i)
+        time.sleep(0.02)
+        order.append(i)
+        running.remove(i)
+        if i == 3:
+          done.set()
+      return Lane(perform)
+    for i in range(4):
+      self.queue.schedule(seconds_from_now(0.005 * i), action(i))
+    self.assertTrue(done.wait(5))
+    self.pool.shutdown()
+    self.assertEqual(order, [0, 1, 2, 3])
+    self.assertEqual(overlapped, [])
+    self.assertEqual(self.pool.lanes, {})
+
+  def test_lag(self):
+    done = threading.Event()
+    self.queue.schedule(seconds_from_now(-1), done.set)
+    self.assertTrue(done.wait(5))
+    self.pool.shutdown()
+    self.assertEqual(self.pool.counters['performed'], 1)
+    self.assertGreaterEqual(self.pool.counters['max_lag'], 1)
+    self.assertGreaterEqual(self.pool.mean_lag(), 1)
+
+  def test_scheduling_lane(self):
+    lane = Lane(lambda: None)
+    self.assertEqual(scheduling_lane(lane), 'lane')
+    self.assertEqual(scheduling_lane(lane.__call__), 'lane')
+    self.assertEqual(scheduling_lane(Event(lane, Every(datetime.timedelta(1)))),
+                     'lane')
+    self.assertIsNone(scheduling_lane(lambda: None))
+
+
+class Command(object):
+  coalesce_key = 'modem'
+
+  def __init__(self, target, name, sent):
+    self.coalesce_target = target
+    self.name = name
+    self.sent = sent
+
+  def __call__(self):
+    self.submit().result()
+
+  def submit(self):
+    self.sent.append(self.name)
+    future = concurrent.futures.Future()
+    future.set_result(self.name)
+    return future
+
+
+class TestCoalescing (unittest.TestCase):
+  def setUp(self):
+    self.dispatched = []
+    self.done = threading.Event()
+    self.queue = ScheduleQueue('Test Scheduler Thread', self.dispatch,
+                               coalesce_window=0.5)
+
+  def tearDown(self):
+    self.queue.stop()
+
+  def dispatch(self, entry):
+    self.dispatched.append(entry.action)
+    self.done.set()
+
+  def test_batch(self):
+    sent = []
+    on1 = Command(1, 'on 1', sent)
+    on2 = Command(2, 'on 2', sent)
+    off1 = Command(1, 'off 1', sent)
+    other = lambda: None
+    when = seconds_from_now(0.05)
+    for action in (on1, other, on2):
+      self.queue.schedule(when, action)
+    self.queue.schedule(when + datetime.timedelta(seconds=0.2), off1)
+    self.queue.schedule(when + datetime.timedelta(seconds=5), Command(3, '', sent))
+    self.queue.start()
+    deadline = time.monotonic() + 5
+    while len(self.dispatched) < 2 and time.monotonic() < deadline:
+      time.sleep(0.01)
+    batch = self.dispatched[0]
+    self.assertIsInstance(batch, CoalescedActions)
+    self.assertEqual(batch.actions, [on1, on2, off1])
+    self.assertIs(self.dispatched[1], other)
+    self.assertEqual(len(self.queue), 1)
+    batch()
+    self.assertEqual(sent, ['on 2', 'off 1'])
+
+  def test_events(self):
+    sent = []
+    events = [Event(Command(1, name, sent), Every(datetime.timedelta(hours=1)))
+              for name in ('on 1', 'off 1')]
+    for event in events:
+      event.when = config.now()
+    CoalescedActions(events)()
+    self.assertEqual(sent, ['off 1'])
+    for event in events:
+      self.assertIn(event, Scheduler().queued_events())
+      event.cancel()
+
+
+class TestEvent (unittest.TestCase):
+  def test_cancel(self):
+    event = Event(lambda: None, Every(datetime.timedelta(hours=1)))
+    event.schedule(previous=config.now())
+    self.assertIn(event, Scheduler().queued_events())
+    event.cancel()
+    self.assertNotIn(event, Scheduler().queued_events())
+    self.assertIsNone(event.when)
+
+
+if __name__ == '__main__':
+  unittest.main()
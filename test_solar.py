@@ -0,0 +1,88 @@
+import datetime
+import unittest
+import solar
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+EST = datetime.timezone(datetime.timedelta(hours=-5), 'EST')
+EDT = datetime.timezone(datetime.timedelta(hours=-4), 'EDT')
+
+
+class TestSolar (unittest.TestCase):
+  def setUp(self):
+    self.sun = solar.Solar(42.37, -71.10)
+
+  def test_formulas(self):
+    # The tables give the same times as the formulas.
+    sun = self.sun
+    t = datetime.datetime(2024, 1, 1, 8, 30, tzinfo=EST)
+    for day in range(366):
+      solar_noon = sun.noon(t) - datetime.timedelta(
+        minutes=sun.solar_correction(t))
+      self.assertEqual(sun.solar_noon(t), solar_noon)
+      self.assertEqual(sun.sunrise(t), solar_noon - sun.solar_noon_offset(t))
+      self.assertEqual(sun.sunset(t), solar_noon + sun.solar_noon_offset(t))
+      t += datetime.timedelta(days=1)
+
+  def test_timezone(self):
+    summer = datetime.datetime(2024, 6, 21, 12, tzinfo=EDT)
+    sunrise = self.sun.sunrise(summer)
+    self.assertEqual(sunrise.tzinfo, EDT)
+    self.assertEqual(sunrise.hour, 5)
+    self.assertEqual(self.sun.sunrise(summer.astimezone(EST)),
+                     sunrise.astimezone(EST))
+
+  def test_polar(self):
+    north = solar.Solar(80, 0)
+    winter = datetime.datetime(2024, 12, 21, tzinfo=datetime.timezone.utc)
+    self.assertIsNotNone(north.solar_noon(winter))
+    with self.assertRaises(ValueError):
+      north.sunrise(winter)
+
+  def test_solar_event(self):
+    sunset = solar.SolarEvent(self.sun, 'sunset')
+    now = datetime.datetime(2024, 3, 1, 12, tzinfo=EST)
+    self.assertEqual(sunset(now=now), self.sun.sunset(now))
+    late = datetime.datetime(2024, 3, 1, 22, tzinfo=EST)
+    self.assertEqual(sunset(now=late),
+                     self.sun.sunset(late + datetime.timedelta(days=1)))
+
+
+@unittest.skipIf(numpy is None, 'requires numpy')
+class TestSolarRanges (unittest.TestCase):
+  def setUp(self):
+    self.sun = solar.Solar(42.37, -71.10)
+
+  def test_scalar(self):
+    # The ranges give the same times as the scalar methods.
+    start = datetime.date(2024, 1, 1)
+    sunrises = self.sun.sunrise_range(start, datetime.date(2025, 1, 1))
+    sunsets = self.sun.sunset_range(start, datetime.date(2025, 1, 1))
+    noons = self.sun.solar_noon_range(start, datetime.date(2025, 1, 1))
+    self.assertEqual(len(sunrises), 366)
+    for i in range(0, 366, 7):
+      d = start + datetime.timedelta(days=i)
+      t = datetime.datetime(d.year, d.month, d.day, 9, tzinfo=EST)
+      for expected, actual in ((self.sun.sunrise(t), sunrises[i]),
+                               (self.sun.sunset(t), sunsets[i]),
+                               (self.sun.solar_noon(t), noons[i])):
+        utc = expected.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        self.assertEqual(numpy.datetime64(utc, 'us'), actual)
+
+  def test_polar(self):
+    north = solar.Solar(80, 0)
+    sunrises = north.sunrise_range('2024-12-20', '2024-12-22')
+    self.assertTrue(numpy.isnat(sunrises).all())
+    self.assertFalse(numpy.isnat(north.solar_noon_range('2024-12-20',
+                                                     '2024-12-22')).any())
+
+  def test_empty(self):
+    self.assertEqual(len(self.sun.sunset_range('2024-01-01', '2024-01-01')), 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from translator import *
+
+try:
+  import numpy
+  import traffic_analysis
+except ImportError:
+  numpy = None
+
+
+SMR_BYTES = bytes([0x02, 0x50, 0x0f, 0x82, 0x9e, 0x49, 0x93, 0xbf,
+                   0x41, 0x13, 0x01])
+ACKED_BYTES = bytes([0x02, 0x61, 0x01, 0x11, 0x00, 0x06])
+NAKED_BYTES = bytes([0x02, 0x61, 0x01, 0x11, 0x00, 0x15])
+LINK_RECORD_BYTES = bytes([0x02, 0x57, 0xe2, 0x01, 0x01, 0x02, 0x03,
+                           0x04, 0x05, 0x06])
+
+
+@unittest.skipIf(numpy is None, 'requires numpy')
+class TestBatchDecode (unittest.TestCase):
+  def setUp(self):
+    records = [(1.0, NAKED_BYTES), (2.0, ACKED_BYTES + SMR_BYTES[:4]),
+               (3.0, SMR_BYTES[4:]), (4.0, bytes([0xff]) + LINK_RECORD_BYTES)]
+    self.decoded = traffic_analysis.batch_decode(records)
+
+  def test_columns(self):
+    smr = self.decoded[StandardMessageReceived]
+    self.assertEqual(len(smr), 1)
+    self.assertEqual(smr['timestamp'][0], 2.0)
+    self.assertEqual(smr['FromAddress'][0], 0x0f829e)
+    self.assertEqual(smr['StandardDirectCommand'][0], OffCmd.byte_code)
+    record = self.decoded[AllLinkRecordResponse]['LinkDBRecord'][0]
+    self.assertEqual(record['InsteonAddress'], 0x010203)
+
+  def test_echoes(self):
+    echoes = self.decoded[SendAllLinkCommand]
+    self.assertEqual(list(echoes['acked']), [False, True])
+    self.assertEqual(traffic_analysis.nak_rate(self.decoded), 0.5)
+    self.assertEqual(traffic_analysis.retransmissions(self.decoded),
+                     {SendAllLinkCommand: 1})
+
+  def test_device_counts(self):
+    self.assertEqual(traffic_analysis.device_counts(self.decoded),
+                     {0x0f829e: 1})
+
+  def test_same_as_interpret_all(self):
+    data = (SMR_BYTES + ACKED_BYTES) * 10
+    decoded = traffic_analysis.batch_decode(data)
+    messages, _, _ = interpret_all(data, ReadFromModem)
+    self.assertEqual(
+      list(decoded[StandardMessageReceived]['ToAddress']),
+      [int(m.ToAddress) for m in messages
+       if isinstance(m, StandardMessageReceived)])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,333 @@
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import unittest
+import translator
+from copy import copy, deepcopy
+from translator import *
+
+
+SMR_BYTES = bytes([0x02, 0x50, 0x0f, 0x82, 0x9e, 0x49, 0x93, 0xbf,
+                   0x41, 0x13, 0x01])
+ECHO_BYTES = bytes([0x02, 0x61, 0x01, 0x11, 0x00, 0x06])
+LINK_RECORD_BYTES = bytes([0x02, 0x57, 0xe2, 0x01, 0x01, 0x02, 0x03,
+                           0x04, 0x05, 0x06])
+
+
+class TestSubclassDispatch (unittest.TestCase):
+  def test_candidates(self):
+    d = translator._dispatch(ReadFromModem)
+    self.assertEqual(d.candidates(SMR_BYTES, 0), (StandardMessageReceived,))
+    self.assertEqual(d.candidates(LINK_RECORD_BYTES, 0),
+                     (AllLinkRecordResponse,))
+    self.assertEqual(d.candidates(bytes([0x04, 0x50]), 0), ())
+
+  def test_fixed_length(self):
+    self.assertEqual(StandardMessageReceived.fixed_length(), 11)
+    self.assertEqual(ExtendedMessageReceived.fixed_length(), 25)
+    self.assertEqual(AllLinkRecordResponse.fixed_length(), 10)
+    self.assertEqual(Echo.fixed_length(), None)
+
+  def test_interpret_all(self):
+    messages, index, err = interpret_all(ECHO_BYTES + SMR_BYTES,
+                                         ReadFromModem)
+    self.assertIsNone(err)
+    self.assertEqual(index, len(ECHO_BYTES) + len(SMR_BYTES))
+    self.assertIsInstance(messages[0], Echo)
+    self.assertIsInstance(messages[0].Echoed, SendAllLinkCommand)
+    self.assertIsInstance(messages[1], StandardMessageReceived)
+    self.assertEqual(messages[1].FromAddress,
+                     InsteonAddress(0x0f, 0x82, 0x9e))
+
+  def test_no_match(self):
+    messages, index, err = interpret_all(bytes([0x02, 0x99]), ReadFromModem)
+    self.assertEqual(messages, [])
+    self.assertIsInstance(err, NoMatch)
+
+
+class TestFrameParser (unittest.TestCase):
+  def test_message_length(self):
+    self.assertEqual(message_length(ReadFromModem, SMR_BYTES), 11)
+    self.assertEqual(message_length(ReadFromModem, ECHO_BYTES), 6)
+    self.assertIsNone(message_length(ReadFromModem, ECHO_BYTES[:1]))
+
+  def test_split_chunks(self):
+    stream = ECHO_BYTES + SMR_BYTES + LINK_RECORD_BYTES
+    for split in range(len(stream) + 1):
+      parser = FrameParser()
+      frames = parser.feed_frames(stream[:split])
+      frames += parser.feed_frames(stream[split:])
+      self.assertEqual(frames, [ECHO_BYTES, SMR_BYTES, LINK_RECORD_BYTES])
+      self.assertEqual(parser.pending(), 0)
+
+  def test_byte_at_a_time(self):
+    parser = FrameParser()
+    messages = []
+    for b in SMR_BYTES + ECHO_BYTES:
+      messages += parser.feed(bytes([b]))
+    self.assertEqual([type(m) for m in messages],
+                     [StandardMessageReceived, Echo])
+
+  def test_resynchronize(self):
+    parser = FrameParser()
+    messages = parser.feed(bytes([0x00, 0xff]) + SMR_BYTES)
+    self.assertEqual(len(messages), 1)
+    self.assertEqual(parser.discarded, 2)
+
+  def test_same_as_interpret_all(self):
+    stream = (SMR_BYTES + ECHO_BYTES + LINK_RECORD_BYTES +
+              bytes([0x02, 0x56, 0x02, 0x01, 0x0f, 0x83, 0x8f]) +
+              bytes([0x02, 0x54, 0x02]))
+    expected, index, e = interpret_all(stream, ReadFromModem)
+    self.assertIsNone(e)
+    for size in range(1, len(stream) + 1):
+      parser = FrameParser()
+      messages = []
+      for i in range(0, len(stream), size):
+        messages += parser.feed(stream[i:i + size])
+      self.assertEqual([repr(m) for m in messages],
+                       [repr(m) for m in expected])
+      self.assertEqual([type(m) for m in messages],
+                       [type(m) for m in expected])
+
+  def test_uninterpretable_message(self):
+    # 0xfe isn't a command, so the whole message is discarded.
+    parser = FrameParser()
+    messages = parser.feed(SMR_BYTES[:9] + bytes([0xfe, 0x01]) + ECHO_BYTES)
+    self.assertEqual([type(m) for m in messages], [Echo])
+    self.assertEqual(parser.discarded, len(SMR_BYTES))
+
+  def test_address_at_end(self):
+    # AllLinkCleanupFailureReport ends with an InsteonAddress.
+    parser = FrameParser()
+    messages = parser.feed(bytes([0x02, 0x56, 0x02, 0x01,
+                                  0x0f, 0x83, 0x8f]))
+    self.assertIsInstance(messages[0], AllLinkCleanupFailureReport)
+    self.assertEqual(messages[0].InsteonAddress,
+                     InsteonAddress(0x0f, 0x83, 0x8f))
+
+  def test_views(self):
+    parser = FrameParser()
+    [view] = parser.feed_views(SMR_BYTES)
+    self.assertIsInstance(view.frame, memoryview)
+    self.assertIs(view.message_class, StandardMessageReceived)
+    self.assertIs(view.FromAddress, FromAddress(0x0f, 0x82, 0x9e))
+    self.assertIs(view.StandardDirectCommand, OffCmd())
+    self.assertEqual(view.tobytes(), SMR_BYTES)
+    self.assertIsInstance(view.message(), StandardMessageReceived)
+    self.assertEqual(compile_pattern(StandardMessageReceived(
+      MatchVariable("from"), MatchVariable("to"), MatchVariable("flags"),
+      OffCmd(), MatchVariable("cmd2"))).match(view.frame)["from"],
+      FromAddress(0x0f, 0x82, 0x9e))
+
+  def test_buffer_reuse(self):
+    parser = FrameParser(capacity=16)
+    kept = parser.feed_views(SMR_BYTES + ECHO_BYTES[:3])[0]
+    frames = parser.feed_frames(ECHO_BYTES[3:] + LINK_RECORD_BYTES * 3)
+    self.assertEqual(frames, [ECHO_BYTES] + [LINK_RECORD_BYTES] * 3)
+    # The buffer grew, so the earlier view still refers to the old one.
+    self.assertEqual(kept.tobytes(), SMR_BYTES)
+
+  def test_no_match_excerpt(self):
+    data = bytes(1000) + bytes([0x02, 0x99])
+    messages, index, err = interpret_all(data, ReadFromModem)
+    self.assertLessEqual(len(err.bytearray), 2 * translator.NO_MATCH_CONTEXT)
+    self.assertEqual(err.start_index, 0)
+
+
+class TestEncode (unittest.TestCase):
+  def test_encode(self):
+    cmd = SendAllLinkCommand(LinkGroup(1), OnCmd(), Byte(0))
+    self.assertEqual(cmd.encode(), bytes([0x02, 0x61, 0x01, 0x11, 0x00]))
+    self.assertIs(cmd.encode(), cmd.encode())
+
+
+class TestInterning (unittest.TestCase):
+  def test_address(self):
+    a = InsteonAddress(0x0f, 0x82, 0x9e)
+    self.assertIs(a, InsteonAddress('0f.82.9e'))
+    self.assertIs(a, InsteonAddress(FromAddress(0x0f, 0x82, 0x9e)))
+    self.assertEqual(int(a), 0x0f829e)
+    self.assertEqual(a, FromAddress(a))
+    self.assertIsNot(a, FromAddress(a))
+    self.assertEqual(hash(a), hash(FromAddress(a)))
+    with self.assertRaises(AttributeError):
+      a.address1 = 0
+
+  def test_decoded_address(self):
+    smr, length = StandardMessageReceived.interpret(SMR_BYTES, 0)
+    self.assertIs(smr.FromAddress, FromAddress(0x0f, 0x82, 0x9e))
+
+  def test_link_group(self):
+    self.assertIs(LinkGroup(4), LinkGroup(4))
+    self.assertNotEqual(LinkGroup(4), OnCmd())
+    self.assertFalse(hasattr(LinkGroup(4), '__dict__'))
+
+  def test_copy(self):
+    for value in (FromAddress(0x0f, 0x82, 0x9e), LinkGroup(4)):
+      self.assertIs(copy(value), value)
+      self.assertIs(deepcopy(value), value)
+      self.assertIs(pickle.loads(pickle.dumps(value)), value)
+    # Containers of them copy too.
+    smr, length = StandardMessageReceived.interpret(SMR_BYTES, 0)
+    self.assertIs(deepcopy(smr).FromAddress, smr.FromAddress)
+
+  def test_match_variable(self):
+    a = InsteonAddress(MatchVariable("a1"), 0x82, 0x9e)
+    self.assertIsNone(a.value)
+    self.assertIsNot(a, InsteonAddress(MatchVariable("a1"), 0x82, 0x9e))
+
+
+class TestCompilePattern (unittest.TestCase):
+  def status_pattern(self, address):
+    return StandardMessageReceived(
+      StartByte(), StandardMessageReceivedCode(),
+      FromAddress(address), MatchVariable("to_address"),
+      MatchVariable("message_flags"),
+      MatchVariable("cmd1"), MatchVariable("cmd2"))
+
+  def test_same_as_match(self):
+    smr, length = StandardMessageReceived.interpret(SMR_BYTES, 0)
+    pattern = self.status_pattern(InsteonAddress(0x0f, 0x82, 0x9e))
+    m = compile_pattern(pattern).match(SMR_BYTES)
+    expected = match(smr, pattern)
+    self.assertEqual(repr(m), repr(expected))
+    self.assertIs(m["cmd1"], OffCmd())
+    self.assertEqual(m["cmd2"].byte, 0x01)
+
+  def test_mismatch(self):
+    compiled = compile_pattern(
+      self.status_pattern(InsteonAddress(0x0f, 0x82, 0x9f)))
+    self.assertFalse(compiled.match(SMR_BYTES))
+    self.assertFalse(compiled.match(SMR_BYTES[:-1]))
+    self.assertFalse(compiled.match(ECHO_BYTES))
+
+  def test_address_bytes(self):
+    compiled = compile_pattern(StandardMessageReceived(
+      FromAddress(MatchVariable("a1"), 0x82, 0x9e),
+      MatchVariable("to"), MatchVariable("flags"), OffCmd(),
+      MatchVariable("cmd2")))
+    self.assertEqual(compiled.match(SMR_BYTES)["a1"], 0x0f)
+
+  def test_repeated_variable(self):
+    compiled = compile_pattern(SendAllLinkCommand(
+      LinkGroup(MatchVariable("x")), OnCmd(), Byte(MatchVariable("x"))))
+    self.assertEqual(compiled.match(bytes([0x02, 0x61, 0x03, 0x11, 0x03])),
+                     {"x": 0x03})
+    self.assertFalse(compiled.match(bytes([0x02, 0x61, 0x03, 0x11, 0x00])))
+
+  def test_decoded_values(self):
+    # Captured tokens are decoded straight from the bytes, but are the
+    # same as their interpretations.
+    compiled = compile_pattern(StandardMessageReceived(
+      MatchVariable("from"), MatchVariable("to"), MatchVariable("flags"),
+      MatchVariable("cmd1"), MatchVariable("cmd2")))
+    smr, length = StandardMessageReceived.interpret(SMR_BYTES, 0)
+    m = compiled.match(memoryview(SMR_BYTES))
+    self.assertIs(m["from"], smr.FromAddress)
+    self.assertIs(m["to"], smr.ToAddress)
+    self.assertIs(type(m["flags"]), type(smr.MessageFlags))
+    self.assertEqual(m["flags"].flags, smr.MessageFlags.flags)
+    self.assertIs(m["cmd1"], smr.StandardDirectCommand)
+    self.assertEqual(repr(m["cmd2"]), repr(smr.Byte))
+    compiled = compile_pattern(SendAllLinkCommand(
+      MatchVariable("group"), MatchVariable("cmd1"), Byte(0)))
+    m = compiled.match(bytes([0x02, 0x61, 0x03, 0x11, 0x00]))
+    self.assertIs(m["group"], LinkGroup(3))
+    self.assertIs(m["cmd1"], OnCmd())
+    self.assertFalse(compiled.match(bytes([0x02, 0x61, 0x03, 0xfe, 0x00])))
+
+
+class TestPatternIndex (unittest.TestCase):
+  def from_address(self, address, cmd1):
+    return StandardMessageReceived(
+      address, MatchVariable("to"), MatchVariable("flags"),
+      cmd1, MatchVariable("cmd2"))
+
+  def test_match(self):
+    index = PatternIndex()
+    index.add(self.from_address(FromAddress(0x0f, 0x82, 0x9e), OffCmd()),
+              'off')
+    index.add(self.from_address(FromAddress(0x0f, 0x82, 0x9e), OnCmd()),
+              'on')
+    index.add(self.from_address(MatchVariable("from"), OffCmd()), 'any off')
+    index.add(Echo(SendAllLinkCommand(MatchVariable("group"), OnCmd(),
+                                      Byte(0)),
+                   Ack()),
+              'echo')
+    self.assertEqual(len(index), 4)
+    found = dict(index.match(SMR_BYTES))
+    self.assertEqual(sorted(found), ['any off', 'off'])
+    self.assertEqual(found['any off']['from'], FromAddress(0x0f, 0x82, 0x9e))
+    self.assertEqual(index.match(LINK_RECORD_BYTES), [])
+    [(subscriber, m)] = index.match(ECHO_BYTES)
+    self.assertEqual(subscriber, 'echo')
+    self.assertIs(m['group'], LinkGroup(1))
+
+  def test_remove(self):
+    index = PatternIndex()
+    index.add(self.from_address(MatchVariable("from"), OffCmd()), 'a')
+    index.add(self.from_address(MatchVariable("from"), OffCmd()), 'b')
+    index.remove('a')
+    self.assertEqual(len(index), 1)
+    self.assertEqual([s for s, m in index.match(SMR_BYTES)], ['b'])
+
+
+class TestSenderAddress (unittest.TestCase):
+  def test_sender_address(self):
+    self.assertEqual(sender_address(SMR_BYTES), 0x0f829e)
+    self.assertEqual(sender_address(bytes([0x02, 0x56, 0x02, 0x01,
+                                           0x0f, 0x83, 0x8f])),
+                     0x0f838f)
+    self.assertEqual(sender_address(bytes([0x02, 0x53, 0x01, 0x01,
+                                           0x0f, 0x83, 0x8f,
+                                           0x02, 0x09, 0x32])),
+                     0x0f838f)
+    self.assertIsNone(sender_address(ECHO_BYTES))
+    self.assertIsNone(sender_address(LINK_RECORD_BYTES))
+
+  def test_button_event(self):
+    msg, length = ButtonEventReport.interpret(bytes([0x02, 0x54, 0x13]), 0)
+    self.assertEqual(msg.ButtonEvent.button_number, 2)
+    self.assertIs(msg.ButtonEvent.button_action, ButtonPressAndHold())
+    self.assertEqual(msg.encode(), bytes([0x02, 0x54, 0x13]))
+    with self.assertRaises(NoMatch):
+      ButtonEventReport.interpret(bytes([0x02, 0x54, 0x33]), 0)
+
+
+class TestSlots (unittest.TestCase):
+  def test_no_instance_dict(self):
+    smr, length = StandardMessageReceived.interpret(SMR_BYTES, 0)
+    for t in [smr] + list(smr):
+      self.assertFalse(hasattr(t, '__dict__'), t)
+
+  def test_accessors(self):
+    smr, length = StandardMessageReceived.interpret(SMR_BYTES, 0)
+    self.assertIsInstance(smr.values, tuple)
+    self.assertIs(smr.FromAddress, smr.values[2])
+    self.assertIs(smr.ToAddress, smr.values[3])
+    with self.assertRaises(AttributeError):
+      smr.FromAddress = None
+
+
+class TestImport (unittest.TestCase):
+  def test_no_files_written(self):
+    package = os.path.dirname(os.path.abspath(translator.__file__))
+    with tempfile.TemporaryDirectory() as directory:
+      subprocess.run([sys.executable, '-c', 'import translator'],
+                     cwd=directory, check=True,
+                     env=dict(os.environ, PYTHONPATH=package))
+      self.assertEqual(os.listdir(directory), [])
+
+  def test_write_translators(self):
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, 'translators.txt')
+      write_translators(path)
+      with open(path) as f:
+        self.assertIn('<StandardMessageReceived>', f.read())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,221 @@
+# Batch decoding of captured modem traffic for offline analysis.
+
+# Decoding days of traffic one message at a time with interpret_all is
+# slow.  Instead the messages are grouped by message code and length,
+# and each group is decoded a column at a time into a numpy structured
+# array, using the field layout declared by the message's pattern.
+
+# This module requires numpy, which the rest of the package doesn't.
+
+import numpy as np
+from translator import *
+
+
+def _as_records(data):
+  if isinstance(data, (bytes, bytearray, memoryview)):
+    return [(np.nan, data)]
+  return data
+
+
+def split_frames(data):
+  '''Returns numpy arrays of the start offset and the length of each
+  message read from the modem in data.  Bytes that can't begin a
+  message are skipped.'''
+  starts = []
+  lengths = []
+  # Maps a message code to the length of its messages if that's fixed.
+  fixed = {}
+  start_byte = StartByte.byte_code
+  index = 0
+  end = len(data)
+  while index < end:
+    length = None
+    if data[index] == start_byte and index + 1 < end:
+      code = data[index + 1]
+      if code not in fixed:
+        fixed[code] = frame_class(ReadFromModem,
+                                  data[index : index + 2]).fixed_length()
+      length = fixed[code]
+    if length is None:
+      try:
+        length = message_length(ReadFromModem, data, index)
+      except NoMatch:
+        index += 1
+        continue
+    if length is None or index + length > end:
+      break
+    starts.append(index)
+    lengths.append(length)
+    index += length
+  return (np.array(starts, dtype=np.int64),
+          np.array(lengths, dtype=np.int64))
+
+
+def _columns(cls):
+  # Returns (name, offset, token type) for each field of cls in order.
+  return sorted(((name, offset, tt)
+                 for name, (offset, tt) in field_layout(cls).items()),
+                key=lambda column: column[1])
+
+
+def _fields(cls):
+  fields = []
+  for name, offset, tt in _columns(cls):
+    length = tt.fixed_length()
+    if issubclass(tt, InsteonAddress):
+      fields.append((name, 'u4'))
+    elif length == 1:
+      fields.append((name, 'u1'))
+    elif field_layout(tt):
+      fields.append((name, np.dtype(_fields(tt))))
+    else:
+      fields.append((name, 'u1', (length,)))
+  return fields
+
+
+def record_dtype(cls, acked=False):
+  '''Returns the numpy dtype that batch_decode uses for messages of
+  the concrete Pattern class cls.  Addresses are uint32, single byte
+  fields are uint8 and a Pattern within the message has a nested
+  dtype.  acked adds a column for echoes.'''
+  fields = [('timestamp', 'f8')] + _fields(cls)
+  if acked:
+    fields.append(('acked', '?'))
+  return np.dtype(fields)
+
+
+def _fill(out, cls, rows, base):
+  for name, offset, tt in _columns(cls):
+    offset += base
+    length = tt.fixed_length()
+    if issubclass(tt, InsteonAddress):
+      out[name] = ((rows[:, offset].astype(np.uint32) << 16) |
+                   (rows[:, offset + 1].astype(np.uint32) << 8) |
+                   rows[:, offset + 2])
+    elif length == 1:
+      out[name] = rows[:, offset]
+    elif field_layout(tt):
+      _fill(out[name], tt, rows, offset)
+    else:
+      out[name] = rows[:, offset : offset + length]
+
+
+def _decode_group(cls, raw, starts, timestamps, acked=False):
+  length = cls.fixed_length()
+  rows = raw[starts[:, None] + np.arange(length)]
+  out = np.empty(len(starts), dtype=record_dtype(cls, acked))
+  out['timestamp'] = timestamps
+  _fill(out, cls, rows, 0)
+  if acked:
+    # An echo's last byte is its Ack or Nack.
+    out['acked'] = raw[starts + length] == Ack.byte_code
+  return out
+
+
+def batch_decode(data):
+  '''Decodes the messages read from the modem in data, which is
+  either bytes or an iterable of (timestamp, bytes) records as read
+  from a capture.  Returns a dict that maps each message class to a
+  numpy structured array of those messages, in the order they were
+  read.  Echoes are keyed by the class of the command that was echoed
+  and have an acked column.  Messages whose class has no fixed length
+  are left out.'''
+  chunks = []
+  chunk_starts = []
+  chunk_times = []
+  size = 0
+  for timestamp, chunk in _as_records(data):
+    chunks.append(chunk)
+    chunk_starts.append(size)
+    chunk_times.append(timestamp)
+    size += len(chunk)
+  data = b''.join(chunks)
+  raw = np.frombuffer(data, dtype=np.uint8)
+  starts, lengths = split_frames(data)
+  if not len(starts):
+    return {}
+  # Each message gets the timestamp of the record it starts in.
+  record = np.searchsorted(np.array(chunk_starts), starts, side='right') - 1
+  timestamps = np.array(chunk_times, dtype='f8')[record]
+  keys = raw[starts + 1].astype(np.int64) * 256 + lengths
+  decoded = {}
+  for key in np.unique(keys):
+    selected = np.nonzero(keys == key)[0]
+    first = starts[selected[0]]
+    length = lengths[selected[0]]
+    try:
+      msg, _ = ReadFromModem.interpret(data[first : first + length], 0)
+    except NoMatch:
+      continue
+    if isinstance(msg, Echo):
+      cls = type(msg.Echoed)
+      acked = True
+    else:
+      cls = type(msg)
+      acked = False
+    if cls.fixed_length() is None:
+      continue
+    group = _decode_group(cls, raw, starts[selected], timestamps[selected],
+                          acked)
+    if cls in decoded:
+      group = np.concatenate((decoded[cls], group))
+      group = group[np.argsort(group['timestamp'], kind='stable')]
+    decoded[cls] = group
+  return decoded
+
+
+def device_counts(decoded):
+  '''Returns a dict that maps each device address, as an int, to the
+  number of messages received from it.'''
+  counts = {}
+  for cls, messages in decoded.items():
+    if 'FromAddress' not in messages.dtype.names:
+      continue
+    addresses, n = np.unique(messages['FromAddress'], return_counts=True)
+    for address, count in zip(addresses.tolist(), n.tolist()):
+      counts[address] = counts.get(address, 0) + count
+  return counts
+
+
+def nak_rate(decoded):
+  '''Returns the fraction of the echoed commands that the modem
+  NAKed, or None if there are no echoes.'''
+  echoes = [messages['acked'] for messages in decoded.values()
+            if 'acked' in messages.dtype.names]
+  if not echoes:
+    return None
+  acked = np.concatenate(echoes)
+  return float(np.count_nonzero(~acked)) / len(acked)
+
+
+def retransmissions(decoded):
+  '''Returns a dict that maps each echoed command class to the number
+  of times that a command was echoed again immediately after an
+  identical one, i.e. resent.'''
+  counts = {}
+  for cls, messages in decoded.items():
+    if 'acked' not in messages.dtype.names:
+      continue
+    names = [name for name in messages.dtype.names
+             if name not in ('timestamp', 'acked')]
+    if not names or len(messages) < 2:
+      counts[cls] = 0
+      continue
+    same = np.ones(len(messages) - 1, dtype=bool)
+    for name in names:
+      column = messages[name]
+      equal = column[1:] == column[:-1]
+      if equal.ndim > 1:
+        equal = equal.all(axis=1)
+      same &= equal
+    counts[cls] = int(np.count_nonzero(same))
+  return counts
+
+
+def decode_capture(path):
+  '''Returns batch_decode of the messages read from the modem in the
+  capture file at path.'''
+  import capture
+  return batch_decode((record.time, record.data)
+                      for record in capture.CaptureReader(path)
+                      if record.direction == capture.MODEM_TO_HOST)
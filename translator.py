@@ -15,6 +15,9 @@
 
 
 import abc
+import builtins
+import operator
+import threading
 from copy import copy
 from sys import stdout
 from singleton import Singleton
@@ -108,19 +111,38 @@ class BitMask(object):
     return value << (self.leftshift) & self.mask
 
 
+# The number of bytes on either side of the failure that NoMatch keeps.
+NO_MATCH_CONTEXT = 32
+
 class NoMatch(Exception):
   '''NoMatch is raised when a Translator.interpret method fails to match
-  the binary data.'''
+  the binary data.  It keeps a copy of the bytes around the failure
+  rather than a reference to the whole buffer, which might be reused.'''
   def __init__(self, trans, bytes, index):
     self.translator = trans   # The class that is failing to interpret the message
-    self.bytearray = bytes
+    # bytearray is bytes[excerpt_start:] up to NO_MATCH_CONTEXT bytes past index.
+    self.excerpt_start = max(0, index - NO_MATCH_CONTEXT)
+    self.bytearray = builtins.bytes(
+      bytes[self.excerpt_start : index + NO_MATCH_CONTEXT])
     self.start_index = index
   def __str__(self):
-    return "%r, %r[%d]" % (self.translator, self.bytearray, self.start_index)
+    return "%r, %r[%d]" % (self.translator, self.bytearray,
+                           self.start_index - self.excerpt_start)
 
 
-class Translator(object):
-  __metaclass__ = abc.ABCMeta
+class _SlottedType(type):
+  '''_SlottedType gives each class that doesn't define __slots__ an
+  empty __slots__, so that Translator instances don't have a __dict__.
+  This includes the classes made by the pattern and bytecodes
+  factories.'''
+  def __new__(mcls, name, bases, namespace, **kwargs):
+    if '__slots__' not in namespace:
+      namespace = dict(namespace, __slots__=())
+    return super().__new__(mcls, name, bases, namespace, **kwargs)
+
+
+class Translator(object, metaclass=_SlottedType):
+  __slots__ = ()
 
   @classmethod
   def _showstr(cls):
@@ -141,6 +163,24 @@ class Translator(object):
     raise Exception("No interpret method")
     pass
 
+  # fixed_length returns the number of bytes that any interpretation
+  # of this class occupies, or None if that varies.
+  @classmethod
+  def fixed_length(cls):
+    return None
+
+  # leading_bytes returns a list of at most count entries describing
+  # the first bytes of any encoding of this class.  Each entry is
+  # either a frozenset of the byte values that can appear at that
+  # position or None if any value can.
+  @classmethod
+  def leading_bytes(cls, count):
+    return [None] * min(count, cls.fixed_length() or 0)
+
+  def __init_subclass__(cls, **kwargs):
+    super().__init_subclass__(**kwargs)
+    _invalidate_decoders()
+
   def description(self):
     return None
 
@@ -162,11 +202,443 @@ class Translator(object):
     return m
 
 
+# The number of leading bytes that the subclass dispatch tables are
+# keyed on.  Two is enough to distinguish the StartByte and message
+# code of every message read from the modem.
+DISPATCH_DEPTH = 2
+
+# Maps each abstract Translator class to its SubclassDispatch.
+_decoders = {}
+
+# Memoized results of Pattern.fixed_length.
+_fixed_lengths = {}
+
+# Memoized results of field_layout.
+_field_layouts = {}
+
+# Memoized results of _message_decoder.
+_message_decoders = {}
+
+# Maps the message code of each StatusMessage that identifies the
+# device that sent it to the offset of that device's address.  Built
+# by _sender_offsets.
+_sender_offset_table = {}
+
+def _invalidate_decoders():
+  _decoders.clear()
+  _fixed_lengths.clear()
+  _field_layouts.clear()
+  _message_decoders.clear()
+  _sender_offset_table.clear()
+
+
+def _is_abstract(cls):
+  '''Returns True if cls interprets bytes by delegating to its subclasses.'''
+  if issubclass(cls, Pattern):
+    return cls.__dict__.get('pattern', None) is None
+  if issubclass(cls, ByteCode):
+    return cls.__dict__.get('byte_code', None) is None
+  return False
+
+
+def _interpretation_leaves(cls):
+  '''Returns the concrete subclasses of the abstract class cls in the
+  order that _interpret_as_subclass would have tried them.'''
+  leaves = []
+  def walk(c):
+    if _is_abstract(c):
+      for sc in c.__subclasses__():
+        walk(sc)
+    else:
+      leaves.append(c)
+  for sc in cls.__subclasses__():
+    walk(sc)
+  return leaves
+
+
+def _leading_bytes_match(leading, key):
+  for i in range(len(leading)):
+    if i >= len(key):
+      return False
+    if leading[i] is not None and key[i] not in leading[i]:
+      return False
+  return True
+
+
+class SubclassDispatch(object):
+  '''SubclassDispatch maps the leading bytes of an encoded message to
+  the concrete subclasses of an abstract Translator class that could
+  interpret it, so that interpretation can go straight to the right
+  class rather than trying each subclass in turn.'''
+
+  def __init__(self, cls):
+    self.translator = cls
+    self.leaves = [(leaf, leaf.leading_bytes(DISPATCH_DEPTH))
+                   for leaf in _interpretation_leaves(cls)]
+    # Memoized candidates, keyed by a tuple of leading bytes.
+    self.table = {}
+
+  def __repr__(self):
+    return 'SubclassDispatch(%s)' % self.translator.__name__
+
+  def candidates(self, bytes, start_index):
+    key = tuple(bytes[start_index : start_index + DISPATCH_DEPTH])
+    found = self.table.get(key)
+    if found is None:
+      found = tuple(leaf for leaf, leading in self.leaves
+                    if _leading_bytes_match(leading, key))
+      self.table[key] = found
+    return found
+
+  def could_start(self, bytes, start_index):
+    '''Returns True if the bytes from start_index to the end of bytes
+    could be the beginning of some message, even if there are fewer
+    than DISPATCH_DEPTH of them.'''
+    key = tuple(bytes[start_index : start_index + DISPATCH_DEPTH])
+    for leaf, leading in self.leaves:
+      if _leading_bytes_match(leading[:len(key)], key):
+        return True
+    return False
+
+
+def _dispatch(cls):
+  d = _decoders.get(cls)
+  if d is None:
+    d = _decoders[cls] = SubclassDispatch(cls)
+  return d
+
+
+def compile_decoders():
+  '''Builds the SubclassDispatch table of every abstract Translator
+  class.  The tables are otherwise built on first use, so calling this
+  is only worthwhile to move that cost to a convenient time.'''
+  def walk(c):
+    if _is_abstract(c):
+      _dispatch(c)
+    for sc in c.__subclasses__():
+      walk(sc)
+  walk(Translator)
+
+
+def message_length(cls, bytes, start_index=0):
+  '''Returns the number of bytes that the cls message starting at
+  start_index of bytes occupies, or None if more bytes are needed to
+  tell.  Raises NoMatch if no cls message can start there.'''
+  length = cls.fixed_length()
+  if length is not None:
+    return length
+  if _is_abstract(cls):
+    d = _dispatch(cls)
+    if len(bytes) - start_index < DISPATCH_DEPTH:
+      if d.could_start(bytes, start_index):
+        return None
+      raise NoMatch(cls, bytes, start_index)
+    candidates = d.candidates(bytes, start_index)
+    if not candidates:
+      raise NoMatch(cls, bytes, start_index)
+    return message_length(candidates[0], bytes, start_index)
+  pattern = cls.__dict__.get('pattern', None)
+  if pattern == None:
+    raise NoMatch(cls, bytes, start_index)
+  index = start_index
+  for tt in pattern:
+    length = message_length(tt, bytes, index)
+    if length is None:
+      return None
+    index += length
+  return index - start_index
+
+
+def field_layout(cls):
+  '''Returns a dict that maps the name of each non-constant token of
+  the concrete Pattern class cls, as it's accessed on an instance, to
+  (offset, token type).  Only tokens at a fixed offset from the start
+  of the message are included.'''
+  layout = _field_layouts.get(cls)
+  if layout is not None:
+    return layout
+  layout = {}
+  pattern = cls.__dict__.get('pattern', None) if issubclass(cls, Pattern) else None
+  offset = 0
+  for tt in pattern or ():
+    if not issubclass(tt, Singleton):
+      layout[tt.__name__] = (offset, tt)
+    length = tt.fixed_length()
+    if length is None:
+      break
+    offset += length
+  _field_layouts[cls] = layout
+  return layout
+
+
+def _message_decoder(cls):
+  '''Returns decode(frame, offset), which returns what
+  cls.interpret(frame, offset)[0] would, given that frame holds at
+  least cls.fixed_length() bytes from offset, or None if cls isn't a
+  concrete Pattern class of fixed length.  Each token is decoded
+  straight from its bytes, as by a CompiledPattern.'''
+  if cls in _message_decoders:
+    return _message_decoders[cls]
+  decode = None
+  pattern = cls.__dict__.get('pattern', None) if issubclass(cls, Pattern) else None
+  if (pattern is not None and cls.fixed_length() is not None and
+      not issubclass(cls, Singleton) and
+      cls.interpret.__func__ is Pattern.interpret.__func__):
+    fields = []
+    offset = 0
+    for tt in pattern:
+      fields.append((offset, _token_decoder(tt)))
+      offset += tt.fixed_length()
+    fields = tuple(fields)
+    def decode(frame, start):
+      return cls(*[decoder(frame, start + offset) for offset, decoder in fields])
+  _message_decoders[cls] = decode
+  return decode
+
+
+def _sender_offsets():
+  if _sender_offset_table:
+    return _sender_offset_table
+  table = {}
+  for leaf in _interpretation_leaves(StatusMessage):
+    codes = leaf.leading_bytes(2)
+    if len(codes) < 2 or codes[1] is None:
+      continue
+    offset = 0
+    for tt in leaf.pattern:
+      # A ToAddress is never the sender.  AllLinkingCompleted and
+      # AllLinkCleanupFailureReport just have an InsteonAddress.
+      if issubclass(tt, InsteonAddress) and not issubclass(tt, ToAddress):
+        for code in codes[1]:
+          table[code] = offset
+        break
+      length = tt.fixed_length()
+      if length is None:
+        break
+      offset += length
+  _sender_offset_table.update(table)
+  return _sender_offset_table
+
+
+def sender_address(frame):
+  '''Returns the address, as an int, of the device that sent the
+  message whose bytes are frame, or None if frame isn't a StatusMessage
+  that identifies its sender.  frame is not otherwise interpreted.'''
+  if len(frame) < 2:
+    return None
+  offset = _sender_offsets().get(frame[1])
+  if offset is None or offset + 3 > len(frame):
+    return None
+  return (frame[offset] << 16) | (frame[offset + 1] << 8) | frame[offset + 2]
+
+
+# The initial size of a FrameParser's receive buffer.  It grows if a
+# chunk doesn't fit.
+RECEIVE_BUFFER_SIZE = 4096
+
+class FrameParser(object):
+  '''FrameParser splits a stream of bytes, fed to it in arbitrary
+  chunks, into complete messages.  The bytes of a message that hasn't
+  been completely received yet are kept until the rest of it arrives.
+  Bytes that can't begin a message are skipped and counted in
+  discarded.
+
+  The bytes are kept in a receive buffer that is reused from one chunk
+  to the next, so feed_views can return messages without copying
+  them.'''
+
+  def __init__(self, translator=None, capacity=RECEIVE_BUFFER_SIZE):
+    if translator is None:
+      translator = ReadFromModem
+    self.translator = translator
+    self.buffer = bytearray(capacity)
+    self.view = memoryview(self.buffer)
+    # The bytes that haven't been parsed yet are buffer[start:end].
+    self.start = 0
+    self.end = 0
+    self.discarded = 0
+
+  def __repr__(self):
+    return 'FrameParser(%s)' % self.translator.__name__
+
+  def pending(self):
+    '''Returns the number of bytes of an incomplete message that are
+    waiting for more data.'''
+    return self.end - self.start
+
+  def _add(self, chunk):
+    size = len(chunk)
+    if self.end + size > len(self.buffer):
+      pending = self.end - self.start
+      if pending + size > len(self.buffer):
+        # The old buffer is left to any views that still refer to it.
+        buffer = bytearray(max(2 * len(self.buffer), pending + size))
+        buffer[:pending] = self.view[self.start:self.end]
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+      else:
+        self.buffer[:pending] = self.buffer[self.start:self.end]
+      self.start = 0
+      self.end = pending
+    self.buffer[self.end:self.end + size] = chunk
+    self.end += size
+
+  def _spans(self, chunk):
+    # Returns the (start, end) of each message that is now complete.
+    self._add(chunk)
+    buffer = self.view[:self.end]
+    spans = []
+    index = self.start
+    while index < self.end:
+      try:
+        length = message_length(self.translator, buffer, index)
+      except NoMatch:
+        index += 1
+        self.discarded += 1
+        continue
+      if length is None or index + length > self.end:
+        break
+      spans.append((index, index + length))
+      index += length
+    self.start = index
+    return spans
+
+  def feed_frames(self, chunk):
+    '''Adds chunk to the stream and returns a list of the raw bytes
+    of each message that is now complete.'''
+    spans = self._spans(chunk)
+    view = self.view
+    return [bytes(view[start:end]) for start, end in spans]
+
+  def feed_views(self, chunk):
+    '''Adds chunk to the stream and returns a MessageView of each
+    message that is now complete.  The views refer to the receive buffer
+    and are only valid until the next chunk is fed.'''
+    spans = self._spans(chunk)
+    view = self.view
+    views = []
+    for start, end in spans:
+      frame = view[start:end]
+      views.append(MessageView(frame_class(self.translator, frame), frame))
+    return views
+
+  def feed_with_frames(self, chunk):
+    '''Adds chunk to the stream and returns a (frame, interpretation)
+    pair for each message that is now complete.'''
+    pairs = []
+    for frame in self.feed_frames(chunk):
+      try:
+        interpreted, length = self.translator.interpret(frame, 0)
+      except NoMatch:
+        self.discarded += len(frame)
+        continue
+      pairs.append((frame, interpreted))
+    return pairs
+
+  def feed(self, chunk):
+    '''Adds chunk to the stream and returns the interpretation of
+    each message that is now complete.'''
+    # This does what feed_views and MessageView.message would, but
+    # looks up each message's class once and uses it both to tell the
+    # message's length and to interpret it in place in the buffer.  A
+    # message's interpretation never reads past the length that
+    # message_length gives it.  Messages of fixed length, most of them,
+    # are decoded field by field without going through interpret.
+    self._add(chunk)
+    translator = self.translator
+    dispatch = _dispatch(translator) if _is_abstract(translator) else None
+    buffer = self.view[:self.end]
+    end = self.end
+    index = self.start
+    messages = []
+    while index < end:
+      cls = translator
+      if dispatch is not None:
+        candidates = dispatch.candidates(buffer, index)
+        if len(candidates) == 1:
+          cls = candidates[0]
+      length = cls.fixed_length()
+      decode = None
+      if length is None:
+        try:
+          length = message_length(cls, buffer, index)
+        except NoMatch:
+          index += 1
+          self.discarded += 1
+          continue
+        if length is None:
+          break
+      else:
+        decode = _message_decoder(cls)
+      if index + length > end:
+        break
+      try:
+        if decode is None:
+          messages.append(cls.interpret(buffer, index)[0])
+        else:
+          messages.append(decode(buffer, index))
+      except NoMatch:
+        self.discarded += length
+      index += length
+    self.start = index
+    return messages
+
+
+def frame_class(translator, frame):
+  '''Returns the concrete subclass of translator that the message
+  whose bytes are frame would be interpreted as, going only by its
+  leading bytes, or translator itself if that can't be told.'''
+  if not _is_abstract(translator):
+    return translator
+  candidates = _dispatch(translator).candidates(frame, 0)
+  if len(candidates) == 1:
+    return candidates[0]
+  return translator
+
+
+class MessageView(object):
+  '''A MessageView is a message that hasn't been interpreted.  frame
+  is the message's bytes, often a memoryview.  Accessing a field of
+  the message, e.g. view.FromAddress, interprets just that field.
+  message() interprets the whole message.'''
+  __slots__ = ('message_class', 'frame', '_message')
+
+  def __init__(self, message_class, frame):
+    self.message_class = message_class
+    self.frame = frame
+    self._message = None
+
+  def __repr__(self):
+    return 'MessageView(%s, %s)' % (self.message_class.__name__,
+                                    dump(self.frame))
+
+  def __len__(self):
+    return len(self.frame)
+
+  def tobytes(self):
+    '''Returns a copy of the message's bytes that stays valid after
+    the receive buffer is reused.'''
+    return bytes(self.frame)
+
+  def message(self):
+    '''Returns the interpretation of the message.'''
+    if self._message is None:
+      self._message, length = self.message_class.interpret(self.frame, 0)
+    return self._message
+
+  def __getattr__(self, name):
+    field = field_layout(self.message_class).get(name)
+    if field is None:
+      return getattr(self.message(), name)
+    offset, tt = field
+    return tt.interpret(self.frame, offset)[0]
+
+
 # See if the data can be interpreted as sone subclass of cls.
 def _interpret_as_subclass(cls, bytes, start_index):
   debug_interpretation("_interpret_as_subclass", cls.__name__, start_index)
   best_failure = None
-  for sc in cls.__subclasses__():
+  for sc in _dispatch(cls).candidates(bytes, start_index):
     debug_interpretation("  subclass", sc)
     try:
       return sc.interpret(bytes, start_index)
@@ -174,7 +646,8 @@ def _interpret_as_subclass(cls, bytes, start_index):
       if best_failure is None or e.start_index >= best_failure.start_index:
         best_failure = e
   debug_interpretation("_interpret_as_subclass no match", best_failure)
-  assert best_failure
+  if best_failure is None:
+    raise NoMatch(cls, bytes, start_index)
   raise best_failure
 
 
@@ -187,6 +660,14 @@ def show_translators(to=stdout):
       walk(sc, level + 1)
   walk(Translator, 0)
 
+TRANSLATORS_FILE = 'translators.txt'
+
+def write_translators(path=TRANSLATORS_FILE):
+  '''Writes the output of show_translators to the file at path.'''
+  with open(path, "w") as f:
+    print("This file is written by the show_translators function.\n", file=f)
+    show_translators(f)
+
 def _showstr_name(cls):
   if issubclass(cls, Singleton):
     return cls.__name__
@@ -197,6 +678,7 @@ def _showstr_name(cls):
 class Byte(Translator):
   '''Byte represents a single byte of any value.'''
   MATCH_SLOTS = ["byte"]
+  __slots__ = ('byte',)
 
   def __init__(self, value):
     self.byte = value
@@ -212,9 +694,15 @@ class Byte(Translator):
   def encode(self):
     return (self.byte,)
 
+  @classmethod
+  def fixed_length(cls):
+    return 1
+
   @classmethod
   def interpret(cls, bytes, start_index):
     debug_interpretation("interpret", cls.__name__, start_index)
+    if start_index >= len(bytes):
+      raise NoMatch(cls, bytes, start_index)
     return cls(bytes[start_index]), 1
 
 
@@ -234,6 +722,16 @@ class ByteCode(Translator):
   def encode(self):
     return (self.__class__.byte_code,)
 
+  @classmethod
+  def fixed_length(cls):
+    return 1
+
+  @classmethod
+  def leading_bytes(cls, count):
+    if count < 1:
+      return []
+    return [frozenset(cls.acceptable_bytes())]
+
   @classmethod
   def byte_code_match(cls, byte_code):
     ### Maybe this should use acceptable_bytes
@@ -287,6 +785,7 @@ def bytecodes(family, **bytecodes):
     c = type(name, (Singleton, superclass), {})
     globals()[name] = c
     c.byte_code = bytecode
+  _invalidate_decoders()
 
 bytecodes(None, StartByte=0x02)
 
@@ -379,7 +878,12 @@ bytecodes('ButtonAction',
           ButtonReleased=0x04)
 
 class ButtonEvent(Translator):
+  '''ButtonEvent is a press or release of one of the modem's own
+  buttons.  Button 1 is the SET button.  The high nibble of the byte
+  is the button number less one and the low nibble is the
+  ButtonAction.'''
   button_numbers = (1, 2, 3)
+  __slots__ = ('button_number', 'button_action')
 
   MATCH_SLOTS = ["button_number", "button_action"]
 
@@ -395,25 +899,100 @@ class ButtonEvent(Translator):
       self.button_number,
       self.button_action.__class__.__name__)
 
+  def __repr__(self):
+    return '%s(%d, %r)' % (self.__class__.__name__,
+                           self.button_number, self.button_action)
+
   def encode(self):
-    return ((self.button_number << 4) | (self.button_action.byte_code),)
+    return (((self.button_number - 1) << 4) | (self.button_action.byte_code),)
+
+  @classmethod
+  def fixed_length(cls):
+    return 1
 
   @classmethod
   def interpret(cls, bytes, start_index):
     debug_interpretation("interpret", cls.__name__, start_index)
+    if start_index >= len(bytes):
+      raise NoMatch(cls, bytes, start_index)
     b = bytes[start_index]
-    bn = b >> 4
-    act = b and 0x0F
-    if bn in self.__class__.button_numbers:
+    bn = (b >> 4) + 1
+    if bn not in cls.button_numbers:
       raise NoMatch(cls, bytes, start_index)
-    # TODO: serify that act is a valid ButtonAction
-    return ButtonEvent(bn, act), 1
+    try:
+      action, _ = ButtonAction.interpret((b & 0x0F,), 0)
+    except NoMatch:
+      raise NoMatch(cls, bytes, start_index)
+    return cls(bn, action), 1
+
+
+def _immutable_setattr(self, name, value):
+  raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+
+# Maps (class, value) to the canonical instance of an InsteonAddress
+# or LinkGroup class having that value.
+_interned = {}
+
+def _intern(cls, value, initialize):
+  key = (cls, value)
+  it = _interned.get(key)
+  if it is None:
+    it = object.__new__(cls)
+    initialize(it)
+    it = _interned.setdefault(key, it)
+  return it
 
 
 class InsteonAddress(Translator):
+  '''InsteonAddress is the three byte address of an Insteon device.
+  InsteonAddresses are immutable.  There is only one instance of each
+  subclass of InsteonAddress for each address, so comparing and
+  hashing them is cheap.  The exception is an InsteonAddress with a
+  MatchVariable for one of its bytes.'''
   MATCH_SLOTS = ["address1", "address2", "address3"]
+  # value is the address as a 24 bit integer, or None if the address
+  # has MatchVariables.
+  __slots__ = ('address1', 'address2', 'address3', 'value')
+
+  def __new__(cls, *args):
+    if len(args) == 1 and type(args[0]) is cls and args[0].value is not None:
+      return args[0]
+    address1, address2, address3 = cls._address_bytes(args)
+    value = None
+    if (isinstance(address1, int) and isinstance(address2, int) and
+        isinstance(address3, int)):
+      value = (((address1 << 8) | address2) << 8) | address3
+    def initialize(it):
+      object.__setattr__(it, 'address1', address1)
+      object.__setattr__(it, 'address2', address2)
+      object.__setattr__(it, 'address3', address3)
+      object.__setattr__(it, 'value', value)
+    if value is None:
+      it = object.__new__(cls)
+      initialize(it)
+      return it
+    return _intern(cls, value, initialize)
 
   def __init__(self, *args):
+    # Everything was done by __new__.
+    pass
+
+  __setattr__ = _immutable_setattr
+
+  # Copies are the instance itself, and unpickling goes through __new__
+  # so that it returns the interned instance.
+  def __copy__(self):
+    return self
+
+  def __deepcopy__(self, memo):
+    return self
+
+  def __reduce__(self):
+    return (self.__class__, (self.address1, self.address2, self.address3))
+
+  @staticmethod
+  def _address_bytes(args):
     if len(args) == 1:
       if isinstance(args[0], InsteonAddress):
         # From an InsteonAddress.  This is used, for example to
@@ -434,9 +1013,7 @@ class InsteonAddress(Translator):
     else:
       raise Exception("Bad initialization arguments %r for InstepnAddress"
                       % args)
-    self.address1 = address1
-    self.address2 = address2
-    self.address3 = address3
+    return address1, address2, address3
 
   def address_string(self):
     return "%02x.%02x.%02x" % (
@@ -455,18 +1032,30 @@ class InsteonAddress(Translator):
   def encode(self):
     return (self.address1, self.address2, self.address3)
 
+  @classmethod
+  def fixed_length(cls):
+    return 3
+
   @classmethod
   def interpret(cls, bytes, start_index):
     debug_interpretation("interpret", cls.__name__, start_index)
-    if start_index + 3 >= len(bytes):
+    if start_index + 3 > len(bytes):
       raise NoMatch(cls, bytes, start_index)
     return cls(bytes[start_index],
                bytes[start_index + 1],
                bytes[start_index + 2]), 3
 
+  def __int__(self):
+    return self.value
+
   def __eq__(self, other):
-    return (isinstance(other, InsteonAddress) and
-            self.address1 == other.address1 and
+    if self is other:
+      return True
+    if not isinstance(other, InsteonAddress):
+      return False
+    if self.value is not None:
+      return self.value == other.value
+    return (self.address1 == other.address1 and
             self.address2 == other.address2 and
             self.address3 == other.address3)
 
@@ -474,11 +1063,15 @@ class InsteonAddress(Translator):
     return not (self == other)
 
   def __hash__(self):
-    return (((self.address1<<8) | self.address2)<<8) | self.address3
+    if self.value is not None:
+      return self.value
+    return hash((self.address1, self.address2, self.address3))
 
 
 class Pattern(Translator):
-  __metaclass__ = abc.ABCMeta
+  '''A Pattern is a sequence of Translators.  values is a tuple of
+  them, one per element of the class's pattern.'''
+  __slots__ = ('values', '_encoded')
 
   @classmethod
   def _showstr(cls):
@@ -488,18 +1081,51 @@ class Pattern(Translator):
     return '%s: \t %s' % (_showstr_name(cls), ', '.join(
       [_showstr_name(p) for p in pat]))
 
-  def __init__(self, *tokens):
-    for i in range(len(self.__class__.pattern)):
-      tt = self.__class__.pattern[i]
-      if i > len(tokens) and issubclass(tt, Singleton):
-        v = tt()
-      else:
-        v = tokens[i]
-      assert isinstance(v, tt)
-      if not issubclass(tt, Singleton):
-        self.__dict__[tt.__name__] = a
-    self.values = tokens
-  
+  @classmethod
+  def fixed_length(cls):
+    if cls in _fixed_lengths:
+      return _fixed_lengths[cls]
+    pattern = cls.__dict__.get('pattern', None)
+    if pattern == None:
+      lengths = set(leaf.fixed_length()
+                    for leaf in _interpretation_leaves(cls))
+      length = lengths.pop() if len(lengths) == 1 else None
+    else:
+      length = 0
+      for tt in pattern:
+        l = tt.fixed_length()
+        if l is None:
+          length = None
+          break
+        length += l
+    _fixed_lengths[cls] = length
+    return length
+
+  @classmethod
+  def leading_bytes(cls, count):
+    pattern = cls.__dict__.get('pattern', None)
+    if pattern == None:
+      # Merge the leading bytes of the subclasses position by position.
+      merged = None
+      for leaf in _interpretation_leaves(cls):
+        leading = leaf.leading_bytes(count)
+        if merged is None:
+          merged = leading
+          continue
+        merged = [None if m is None or l is None else m | l
+                  for m, l in zip(merged, leading)]
+      return merged or []
+    leading = []
+    for tt in pattern:
+      if len(leading) >= count:
+        break
+      tt_leading = tt.leading_bytes(count - len(leading))
+      leading.extend(tt_leading)
+      if len(tt_leading) != tt.fixed_length():
+        # We don't know where the following tokens start.
+        break
+    return leading
+
   def __str__(self):
     return "%s-()%s" % (self.__class__.__name__,
                         ",".join([ str(v) for v in self.values ]))
@@ -532,10 +1158,20 @@ class Pattern(Translator):
     return m
 
   def encode(self):
-    msg = []
+    '''Returns the encoding of this Pattern as bytes.  The encoding is
+    remembered, since a scheduled command is sent over and over again,
+    so a Pattern and its values must not be changed once it has been
+    encoded.'''
+    try:
+      return self._encoded
+    except AttributeError:
+      pass
+    msg = bytearray()
     for tt in self.values:
       msg.extend(tt.encode())
-    return msg
+    encoded = bytes(msg)
+    self._encoded = encoded
+    return encoded
 
   @classmethod
   def interpret(cls, bytes, start_index):
@@ -553,6 +1189,10 @@ class Pattern(Translator):
     return cls(*values), index - start_index
 
 
+def _value_property(index):
+  return property(lambda self: self.values[index])
+
+
 def pattern(name, superclasses, token_types):
   if len(superclasses) == 0:
     superclasses = (Pattern,)
@@ -574,30 +1214,259 @@ def pattern(name, superclasses, token_types):
   pat.nonconstant_token_types = nonconstant_token_types
   def _init(self, *args):
     if len(args) == len(pat.pattern):
-      self.values = args
+      self.values = tuple(args)
     elif len(args) == len(pat.nonconstant_token_types):
-      self.values = []
+      values = []
       argindex = 0
       for tt in self.pattern:
-        if argindex < len(args) and (
-            isinstance(args[argindex], tt) or
-            isinstance(args[argindex], MatchVariable)):
+        if issubclass(tt, Singleton):
+          v = tt()
+        else:
           v = args[argindex]
+          assert isinstance(v, (tt, MatchVariable)), '%r is not a %s' % (v, tt.__name__)
           argindex += 1
-        else:
-          assert issubclass(tt, Singleton), '%r is not a subclass of Singleton' % tt
-          v = tt()
-        self.values.append(v)
+        values.append(v)
+      self.values = tuple(values)
     else:
       raise Exception("Wrong number of arguments to __init__.  Expected %d or %d" % (
         len(pat.nonconstant_token_types), len(pat.pattern)))
-    for i in range(len(self.pattern)):
-      tt = self.pattern[i]
-      v = self.values[i]
-      if not issubclass(tt, Singleton):
-        self.__dict__[tt.__name__] = v
   pat.__init__ = _init
+  # Each non-constant token is also readable as an attribute named
+  # for its type.  If a type appears more than once the last one wins.
+  for i, tt in enumerate(token_types):
+    if not issubclass(tt, Singleton):
+      setattr(pat, tt.__name__, _value_property(i))
   globals()[name] = pat
+  _invalidate_decoders()
+
+
+class CompiledPattern(object):
+  '''A CompiledPattern matches the raw bytes of a single message
+  against a Pattern, as translator.match would match the interpretation
+  of those bytes, but without interpreting them.  Only the captured
+  values are interpreted.  Use compile_pattern to make one.'''
+  __slots__ = ('pattern', 'length', 'checks', 'memberships', 'captures',
+               '_checked', '_expected')
+
+  def __init__(self, pattern, length, checks, memberships, captures):
+    self.pattern = pattern
+    self.length = length
+    # (offset, byte) for each byte whose value is known.
+    self.checks = tuple(checks)
+    # (offset, frozenset of acceptable bytes) for each captured ByteCode.
+    self.memberships = tuple(memberships)
+    # (name, offset, decode) for each MatchVariable.
+    # decode(frame, offset) returns the value that the name is bound to.
+    self.captures = tuple(captures)
+    # Fetch all of the checked bytes with a single call.
+    offsets = [offset for offset, byte in self.checks]
+    expected = tuple(byte for offset, byte in self.checks)
+    if len(offsets) == 1:
+      expected = expected[0]
+    self._checked = operator.itemgetter(*offsets) if offsets else tuple
+    self._expected = expected if offsets else ()
+
+  def __repr__(self):
+    return 'compile_pattern(%r)' % (self.pattern,)
+
+  def match(self, frame):
+    '''Returns False or a dictionary associating MatchVariable names
+    with values iff frame, the bytes of one message, matches.'''
+    if len(frame) != self.length:
+      return False
+    if self.checks and self._checked(frame) != self._expected:
+      return False
+    for offset, acceptable in self.memberships:
+      if frame[offset] not in acceptable:
+        return False
+    matches = {}
+    for name, offset, decode in self.captures:
+      try:
+        value = decode(frame, offset)
+      except NoMatch:
+        return False
+      if name in matches:
+        if value != matches[name]:
+          return False
+      else:
+        matches[name] = value
+    return matches
+
+
+def _byte_value(frame, offset):
+  return frame[offset]
+
+
+def _token_decoder(tt):
+  # Returns decode(frame, offset), which returns what
+  # tt.interpret(frame, offset)[0] would.  The lengths of the frames
+  # that it's given have already been checked, so the common fixed
+  # width tokens are built straight from their bytes.
+  interpret = tt.interpret.__func__
+  if issubclass(tt, ByteCode):
+    # ByteCodes are Singletons, so each byte has one interpretation.
+    interpretations = {}
+    for b in tt.acceptable_bytes():
+      try:
+        interpretations[b] = tt.interpret(bytes((b,)), 0)[0]
+      except NoMatch:
+        pass
+    def decode(frame, offset):
+      try:
+        return interpretations[frame[offset]]
+      except KeyError:
+        raise NoMatch(tt, frame, offset)
+    return decode
+  if interpret is Byte.interpret.__func__:
+    def decode(frame, offset):
+      return tt(frame[offset])
+    return decode
+  if interpret is Flags.interpret.__func__:
+    def decode(frame, offset):
+      flags = tt.__new__(tt)
+      flags.flags = frame[offset]
+      return flags
+    return decode
+  if interpret is InsteonAddress.interpret.__func__:
+    def decode(frame, offset):
+      a1 = frame[offset]
+      a2 = frame[offset + 1]
+      a3 = frame[offset + 2]
+      address = _interned.get((tt, (a1 << 16) | (a2 << 8) | a3))
+      if address is None:
+        address = tt(a1, a2, a3)
+      return address
+    return decode
+  def decode(frame, offset):
+    return tt.interpret(frame, offset)[0]
+  return decode
+
+
+def compile_pattern(pattern):
+  '''compile_pattern returns a CompiledPattern for pattern, a Pattern
+  whose values may include MatchVariables.  Each MatchVariable must
+  stand for a Translator of fixed length.'''
+  assert isinstance(pattern, Pattern)
+  checks = []
+  memberships = []
+  captures = []
+  def capture(name, offset, tt):
+    length = tt.fixed_length()
+    if length is None:
+      raise ValueError("Can't compile a MatchVariable for %s, whose length varies"
+                       % tt.__name__)
+    if issubclass(tt, ByteCode):
+      memberships.append((offset, frozenset(tt.acceptable_bytes())))
+    captures.append((name, offset, _token_decoder(tt)))
+    return length
+  def walk(value, tt, offset):
+    # Returns the number of bytes that value occupies.
+    if isinstance(value, MatchVariable):
+      return capture(value.name, offset, tt)
+    if isinstance(value, Pattern):
+      start = offset
+      for tt, v in zip(value.pattern, value.values):
+        offset += walk(v, tt, offset)
+      return offset - start
+    if isinstance(value, InsteonAddress):
+      parts = (value.address1, value.address2, value.address3)
+    elif isinstance(value, Byte):
+      parts = (value.byte,)
+    else:
+      parts = value.encode()
+    for i, part in enumerate(parts):
+      if isinstance(part, MatchVariable):
+        captures.append((part.name, offset + i, _byte_value))
+      else:
+        checks.append((offset + i, part))
+    return len(parts)
+  length = walk(pattern, type(pattern), 0)
+  return CompiledPattern(pattern, length, checks, memberships, captures)
+
+
+# The offsets of the bytes that PatternIndex is keyed on by default:
+# the message code, the three bytes of the FromAddress and the command 1
+# byte of a StandardMessageReceived.
+INDEX_KEY_OFFSETS = (1, 2, 3, 4, 9)
+
+class PatternIndex(object):
+  '''PatternIndex holds any number of (CompiledPattern, subscriber)
+  pairs and finds every one whose pattern matches a message in a single
+  pass.  The pairs are kept in a trie keyed on the message bytes at
+  key_offsets.  A pattern that doesn't require a particular value at
+  one of those offsets is kept under None at that level, which is
+  followed for any byte.'''
+
+  def __init__(self, key_offsets=INDEX_KEY_OFFSETS):
+    assert len(key_offsets) > 0
+    self.key_offsets = tuple(key_offsets)
+    # Nested dicts, one level per key offset.  The last level's values
+    # are lists of (CompiledPattern, subscriber).
+    self.root = {}
+    self.size = 0
+    self.lock = threading.Lock()
+
+  def __repr__(self):
+    return 'PatternIndex(%r)' % (self.key_offsets,)
+
+  def __len__(self):
+    return self.size
+
+  def add(self, pattern, subscriber):
+    '''Adds subscriber to be returned by match for any message that
+    matches pattern, a Pattern or a CompiledPattern.'''
+    if not isinstance(pattern, CompiledPattern):
+      pattern = compile_pattern(pattern)
+    checks = dict(pattern.checks)
+    with self.lock:
+      node = self.root
+      for offset in self.key_offsets[:-1]:
+        node = node.setdefault(checks.get(offset), {})
+      node.setdefault(checks.get(self.key_offsets[-1]), []).append(
+        (pattern, subscriber))
+      self.size += 1
+
+  def remove(self, subscriber):
+    '''Removes every pattern that was added for subscriber.'''
+    def prune(node, depth):
+      for key in list(node):
+        if depth == len(self.key_offsets) - 1:
+          entries = [e for e in node[key] if e[1] is not subscriber]
+          self.size -= len(node[key]) - len(entries)
+          node[key] = entries
+        else:
+          prune(node[key], depth + 1)
+        if not node[key]:
+          del node[key]
+    with self.lock:
+      prune(self.root, 0)
+
+  def match(self, frame):
+    '''Returns a list of (subscriber, matches) for each pattern that
+    frame, the bytes of one message, matches.  matches is as returned by
+    CompiledPattern.match.'''
+    nodes = [self.root]
+    length = len(frame)
+    for offset in self.key_offsets:
+      following = []
+      for node in nodes:
+        child = node.get(None)
+        if child is not None:
+          following.append(child)
+        if offset < length:
+          child = node.get(frame[offset])
+          if child is not None:
+            following.append(child)
+      if not following:
+        return []
+      nodes = following
+    results = []
+    for entries in nodes:
+      for pattern, subscriber in entries:
+        m = pattern.match(frame)
+        if m is not False:
+          results.append((subscriber, m))
+    return results
 
 
 class Command(Pattern):
@@ -643,6 +1512,8 @@ pattern('ProductDataResponse', (ReadFromModem,), (
   FirmwareVersion))
 
 class Flags (Translator):
+  __slots__ = ('flags',)
+
   def __init__(self, **args):
     self.flags = 0
     for key, val in args.items():
@@ -678,21 +1549,61 @@ class Flags (Translator):
   def encode(self):
     return (self.flags,)
 
+  @classmethod
+  def fixed_length(cls):
+    return 1
+
   @classmethod
   def interpret(cls, bytes, start_index):
     debug_interpretation("interpret", cls.__name__, start_index)
+    if start_index >= len(bytes):
+      raise NoMatch(cls, bytes, start_index)
     i = cls()
     i.flags = bytes[start_index]
     return i, 1
 
   
 class LinkGroup(Byte):
+  '''LinkGroup is an Insteon all-link group number.  Like
+  InsteonAddress, LinkGroups are immutable and there is only one
+  LinkGroup for each group number.'''
+  __slots__ = ()
+
+  def __new__(cls, value):
+    def initialize(it):
+      object.__setattr__(it, 'byte', value)
+    if isinstance(value, int):
+      return _intern(cls, value, initialize)
+    it = object.__new__(cls)
+    initialize(it)
+    return it
+
+  def __init__(self, value):
+    # Everything was done by __new__.
+    pass
+
+  __setattr__ = _immutable_setattr
+
+  # As for InsteonAddress.
+  def __copy__(self):
+    return self
+
+  def __deepcopy__(self, memo):
+    return self
+
+  def __reduce__(self):
+    return (self.__class__, (self.byte,))
+
+  def __int__(self):
+    return self.byte
+
   def __eq__(self, other):
-    return self.byte == other.byte
+    return self is other or (isinstance(other, LinkGroup) and
+                             self.byte == other.byte)
   def __ne__(self, other):
     return not (self == other)
   def __hash__(self):
-    return self.byte
+    return hash(self.byte)
 
 
 class LinkData1 (Byte): pass
@@ -808,7 +1719,8 @@ pattern('SendMessageCommand', (Echoed,), (
   StartByte, SendMessageCmd, InsteonAddress,
   MessageFlags, StandardDirectOrExtendedCommand, Command2))
 
-class FromAddress(InsteonAddress): pass
+class FromAddress(InsteonAddress):
+  __slots__ = ()
 
 class ToAddress(InsteonAddress):
   # For non-group broadcast messages, this is not a device address but
@@ -817,7 +1729,7 @@ class ToAddress(InsteonAddress):
   #
   # For group broadcast messages the first two bytes are 0 and the third
   # byte is the group number.
-  pass
+  __slots__ = ()
 
 
 class StatusMessage(ReadFromModem):
@@ -882,7 +1794,6 @@ pattern('AllLinkCleanupStatus', (StatusMessage,), (
   ))
 
 
-with open("translators.txt", "w") as f:
-  print("This file is written by the show_translators function.", file=f)
-  show_translators(f)
+if __name__ == '__main__':
+  write_translators()
 